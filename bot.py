@@ -3,12 +3,25 @@ import os
 import json
 import uuid
 import asyncio
-import requests
+import bisect
+import contextvars
+import functools
+import hashlib
+import heapq
+import itertools
+import math
 import re
+import signal
+import sqlite3
+import struct
+import threading
 import time
 import urllib.parse
-from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional, Union
+import zlib
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import List, Dict, Any, NamedTuple, Optional, Union
+import httpx
 import pytz
 
 # --- FIX APSCHEDULER TIMEZONE ---
@@ -43,6 +56,7 @@ from telegram import (
     KeyboardButton
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 from telegram.ext import (
     Application, 
     CommandHandler, 
@@ -58,14 +72,32 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# httpx logga ogni richiesta a livello INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # --- CONFIGURAZIONE ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_PATH = os.path.join(BASE_DIR, "data", "unified.json")
 BIBLIOTECHE_DATA_PATH = os.path.join(BASE_DIR, "data", "biblioteche.json")
-SBA_API_URL = "https://www.sba.unipi.it/it/opening_hours/instances"
+SBA_API_URL = os.environ.get("SBA_API_URL", "https://www.sba.unipi.it/it/opening_hours/instances")
 SBA_CACHE_TTL = 600  # secondi (10 minuti)
-_sba_cache: dict = {}  # key -> (timestamp, data)
+SBA_CACHE_MAX_ENTRIES = int(os.environ.get("SBA_CACHE_MAX_ENTRIES", "512"))
+SBA_CACHE_MAX_BYTES = int(os.environ.get("SBA_CACHE_MAX_BYTES", str(2 * 1024 * 1024)))  # stima della dimensione JSON
+EVENTS_CACHE_TTL = 600  # secondi (10 minuti)
+EVENTS_RANGE_DAYS = int(os.environ.get("EVENTS_RANGE_DAYS", "7"))  # giorni scaricati per ogni chiamata Cineca
+_events_cache: dict = {}  # "calendar_id:YYYY-MM-DD" -> (timestamp, events)
+EVENTS_CACHE_MAX_DAYS = int(os.environ.get("EVENTS_CACHE_MAX_DAYS", "1024"))  # entry calendario-giorno in memoria
+
+# Cache persistente su disco (SQLite) per non ripartire a freddo dopo restart e redeploy.
+# Stringa vuota per disabilitarla.
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH", os.path.join(BASE_DIR, "data", "cache.sqlite3"))
+CACHE_DB_RETENTION = 7 * 24 * 3600  # secondi, le righe più vecchie vengono eliminate all'avvio
+
+# Prefetch in background: più frequente durante l'orario delle lezioni, raro di notte
+PREFETCH_INTERVAL_LECTURES = int(os.environ.get("PREFETCH_INTERVAL_LECTURES", "300"))  # secondi
+PREFETCH_INTERVAL_IDLE = int(os.environ.get("PREFETCH_INTERVAL_IDLE", "3600"))  # secondi
+PREFETCH_LECTURE_HOURS = (7, 20)  # [inizio, fine) in ora di Roma, da lunedì a sabato
+_prefetch_active = False
 
 DEFAULT_COLOR = "808080"
 TZ_ROME = pytz.timezone('Europe/Rome')
@@ -77,6 +109,7 @@ AULE_PER_PAGE = 5
 # API per calendario
 API_URL = os.environ.get("API_URL", "https://apache.prod.up.cineca.it/api/Impegni/getImpegniCalendarioPubblico")
 CLIENT_ID = os.environ.get("CLIENT_ID", "628de8b9b63679f193b87046")
+UNIPI_PERSONE_URL = os.environ.get("UNIPI_PERSONE_URL", "https://www.unipi.it/wp-json/wp/v2/unipi_persone")
 
 # Varianti codici laboratorio (separate da |). Usa {num} come placeholder.
 LAB_CODE_VARIANTS = os.environ.get("LAB_CODE_VARIANTS", "FIS LAB {num}").split("|")
@@ -126,6 +159,92 @@ def _get_mtime(path: str) -> Optional[float]:
     except Exception:
         return None
 
+def snapshot_cached(func):
+    """Memoizza func (argomenti hashable) finché non cambia lo snapshot dei dati aule (_UNIFIED_MTIME).
+    Usato per i frammenti che leggono i dati aule: nomi, intestazioni, raggruppamenti per piano.
+    Le funzioni pure dei soli argomenti non ne hanno bisogno."""
+    memo = {}
+    snapshot = [object()]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        load_unified_json()  # aggiorna _UNIFIED_MTIME se il file è cambiato, prima del confronto
+        if snapshot[0] != _UNIFIED_MTIME:
+            memo.clear()
+            snapshot[0] = _UNIFIED_MTIME
+        key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+        try:
+            return memo[key]
+        except KeyError:
+            value = memo[key] = func(*args, **kwargs)
+            return value
+
+    wrapper.cache_clear = memo.clear
+    return wrapper
+
+def _resolve_room_prefix(polo_data: dict, edificio: Optional[str] = None) -> str:
+    """Prefisso dei codici Cineca: quello dell'edificio, poi del polo, poi del primo edificio che lo definisce."""
+    edifici = polo_data.get('edificio', {})
+    if edificio and edificio in edifici:
+        return edifici[edificio].get('prefix', polo_data.get('prefix', 'Fib'))
+    if 'prefix' in polo_data:
+        return polo_data['prefix']
+    for ed_data in edifici.values():
+        if 'prefix' in ed_data:
+            return ed_data['prefix']
+    return 'Fib'
+
+@functools.lru_cache(maxsize=4096)
+def strict_match_codes(aula_nome: str, prefix: str = 'Fib') -> frozenset:
+    """Codici/descrizioni aula (upper) che negli eventi Cineca identificano esattamente questa aula."""
+    prefix_upper = prefix.upper()
+    prefix_cap = prefix.capitalize()
+    
+    strict_variants = set()
+    
+    if aula_nome.startswith("Aula "):
+        base = aula_nome[5:]  # "A"
+        strict_variants.add(f"{prefix_upper} {base}")
+        strict_variants.add(f"{prefix_cap} {base}")
+        strict_variants.add(base)  # Solo se il codice è esattamente "A", molto raro ma possibile
+    elif aula_nome.startswith("Laboratorio "):
+        num = aula_nome[12:]
+        strict_variants.add(f"{prefix_upper} LAB {num}")
+        strict_variants.add(f"{prefix_cap} Lab {num}")
+        for template in LAB_CODE_VARIANTS:
+            templ = template.strip()
+            if templ:
+                strict_variants.add(templ.format(num=num))
+    else:
+        strict_variants.add(f"{prefix_upper} {aula_nome}")
+        strict_variants.add(f"{prefix_cap} {aula_nome}")
+        strict_variants.add(aula_nome)
+    
+    return frozenset(v.upper() for v in strict_variants)
+
+def room_match_codes(aula_nome: str, polo: str = "fibonacci", edificio: str = None) -> frozenset:
+    """Codici di match per un'aula nota solo per nome (le aule dello snapshot hanno già 'match_codes')."""
+    polo_data = load_unified_json().get('polo', {}).get(polo or "fibonacci", {})
+    return strict_match_codes(aula_nome, _resolve_room_prefix(polo_data, edificio))
+
+def _polo_center(polygons: dict, id_database: str) -> Optional[tuple]:
+    """Centro (lat, lon) approssimato di un polo: media dei vertici dei suoi poligoni
+    (chiave id_database, o id_database_<parte> per i poli divisi in più poligoni)."""
+    points = []
+    for key, polygon in polygons.items():
+        if not id_database or (key != id_database and not key.startswith(id_database + "_")):
+            continue
+        geometry = polygon.get("geometry") or {}
+        shapes = geometry.get("coordinates") or []
+        if geometry.get("type") == "Polygon":
+            shapes = [shapes]
+        for shape in shapes:
+            if shape:
+                points.extend(p for p in shape[0] if len(p) >= 2)
+    if not points:
+        return None
+    return (sum(p[1] for p in points) / len(points), sum(p[0] for p in points) / len(points))
+
 def load_unified_json() -> dict:
     """Carica il file data/aule2.geojson e lo converte nel formato legacy."""
     global _UNIFIED_CACHE, _UNIFIED_MTIME
@@ -154,6 +273,7 @@ def load_unified_json() -> dict:
                 "apple_maps": links.get("apple_maps", ""),
                 "doveunipi": links.get("doveunipi", ""),
                 "calendar_id": polo_id,
+                "center": _polo_center(geojson.get("polo_polygons", {}), polo_data.get("id_database", "")),
                 "edificio": {}
             }
             
@@ -226,9 +346,19 @@ def load_unified_json() -> dict:
                         "ricerca": poi.get("nome"),
                         "hasStatus": True,
                         "codice": poi.get("codice", ""),
+                        "capienza": poi.get("capienza"),
+                        "servizi": poi.get("servizi") or [],
                         "link-dove-unipi": dove_link
                     })
                     
+        # Codici evento Cineca che corrispondono a ciascuna aula, calcolati una volta per snapshot
+        for polo_data in legacy_data["polo"].values():
+            for edif_key, edif_data in polo_data["edificio"].items():
+                prefix = _resolve_room_prefix(polo_data, edif_key)
+                for rooms in edif_data["piano"].values():
+                    for room in rooms:
+                        room["match_codes"] = strict_match_codes(room.get("nome") or "", prefix)
+
         _UNIFIED_CACHE = legacy_data
         _UNIFIED_MTIME = mtime
         global _GENERATED_DATA_CACHE
@@ -266,33 +396,732 @@ def load_biblioteche_json() -> list:
         logger.error(f"Errore lettura biblioteche2.geojson: {e}")
         return []
 
-def fetch_sba_opening_hours(nid: str, from_date: str, to_date: str) -> list:
-    """Fetch orari SBA per una biblioteca (con cache TTL)."""
+# --- CACHE UPSTREAM ---
+def _prefetch_interval(now: datetime) -> int:
+    """Intervallo di refresh del prefetch: breve durante le lezioni, lungo di notte e la domenica."""
+    if now.weekday() < 6 and PREFETCH_LECTURE_HOURS[0] <= now.hour < PREFETCH_LECTURE_HOURS[1]:
+        return PREFETCH_INTERVAL_LECTURES
+    return PREFETCH_INTERVAL_IDLE
+
+def _cache_ttl(base_ttl: int) -> int:
+    """TTL effettivo delle cache upstream: con il prefetch attivo un'entry resta valida
+    fino al refresh successivo, così gli utenti non attendono mai le API."""
+    if not _prefetch_active:
+        return base_ttl
+    return max(base_ttl, 2 * _prefetch_interval(datetime.now(TZ_ROME)))
+
+class BoundedTTLCache:
+    """Cache LRU in memoria con numero massimo di entry, budget di memoria stimato e scadenza.
+    Ogni entry è (fetched_at, data): get() la restituisce solo se entro il TTL, get_stale() anche
+    se scaduta (ultimo dato noto per quando l'upstream è giù), finché non supera stale_ttl."""
+
+    def __init__(self, name: str, max_entries: int, max_bytes: int, ttl, stale_ttl: int):
+        self.name = name
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self.ttl = ttl  # callable: il TTL effettivo dipende dal prefetch
+        self.stale_ttl = stale_ttl
+        self._entries: Dict[str, tuple] = {}  # key -> (fetched_at, data, size), in ordine LRU
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.hits = self.misses = self.expired = self.evictions = 0
+
+    @staticmethod
+    def _estimate_size(key: str, data) -> int:
+        try:
+            return len(key) + len(json.dumps(data, separators=(',', ':')))
+        except (TypeError, ValueError):
+            return len(key) + 1024
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def get(self, key: str, now: Optional[float] = None):
+        """Dato in cache se ancora valido, altrimenti None. Aggiorna hit rate e ordine LRU."""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if now - entry[0] >= self.ttl():
+                self.expired += 1
+                return None
+            self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+            return entry[1]
+
+    def get_stale(self, key: str, now: Optional[float] = None):
+        """Ultimo dato noto anche se scaduto (None se assente o troppo vecchio), senza toccare le statistiche."""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry[0] >= self.stale_ttl:
+                return None
+            return entry[1]
+
+    def put(self, key: str, fetched_at: float, data):
+        size = self._estimate_size(key, data)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (fetched_at, data, size)
+            self._bytes += size
+            self._evict(time.time())
+
+    def _evict(self, now: float):
+        # Prima le entry inutilizzabili anche come fallback, poi le meno usate di recente
+        for key in [k for k, e in self._entries.items() if now - e[0] >= self.stale_ttl]:
+            self._drop(key)
+            self.evictions += 1
+        while len(self._entries) > self.max_entries or (self._bytes > self.max_bytes and len(self._entries) > 1):
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def summary(self, reset: bool = True) -> Optional[str]:
+        """Riga di log con hit rate, evizioni e occupazione; None se la cache non è stata usata."""
+        lookups = self.hits + self.misses + self.expired
+        line = None
+        if lookups or self.evictions:
+            rate = self.hits / lookups * 100 if lookups else 0.0
+            line = (
+                f"{self.name}: hit {rate:.0f}% ({self.hits}/{lookups}, scadute {self.expired}), "
+                f"evizioni {self.evictions}, {len(self._entries)}/{self.max_entries} entry, "
+                f"{self._bytes / 1024:.0f}/{self.max_bytes / 1024:.0f}KB"
+            )
+        if reset:
+            self._reset_stats()
+        return line
+
+sba_cache = BoundedTTLCache(
+    "cache SBA", SBA_CACHE_MAX_ENTRIES, SBA_CACHE_MAX_BYTES,
+    ttl=lambda: _cache_ttl(SBA_CACHE_TTL), stale_ttl=CACHE_DB_RETENTION,
+)
+
+class PersistentCache:
+    """Cache su disco (SQLite in WAL) per eventi Cineca e orari SBA.
+    Ogni riga è (kind, key, fetched_at, payload) con payload JSON compatto compresso con zlib.
+    La validità non è salvata: al caricamento conta il TTL in memoria (_cache_ttl) rispetto a fetched_at."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        if self._conn is None and self.path:
+            try:
+                conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS cache ("
+                    "kind TEXT NOT NULL, key TEXT NOT NULL, fetched_at REAL NOT NULL, "
+                    "payload BLOB NOT NULL, PRIMARY KEY (kind, key)"
+                    ") WITHOUT ROWID"
+                )
+                self._conn = conn
+            except Exception as e:
+                logger.error(f"Cache persistente non disponibile ({self.path}): {e}")
+                self.path = ""
+        return self._conn
+
+    @staticmethod
+    def _pack(data) -> bytes:
+        return zlib.compress(json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+
+    @staticmethod
+    def _unpack(blob: bytes):
+        return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+    def put_many(self, kind: str, rows: List[tuple]):
+        """Salva righe (key, fetched_at, data); una riga già presente viene sostituita solo da una più recente."""
+        with self._lock:
+            conn = self._connection()
+            if conn is None:
+                return
+            try:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT INTO cache (kind, key, fetched_at, payload) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (kind, key) DO UPDATE SET fetched_at = excluded.fetched_at, payload = excluded.payload "
+                    "WHERE excluded.fetched_at >= cache.fetched_at",
+                    [(kind, key, fetched_at, self._pack(data)) for key, fetched_at, data in rows],
+                )
+                conn.execute("COMMIT")
+            except Exception as e:
+                logger.error(f"Errore scrittura cache persistente: {e}")
+                try:
+                    conn.execute("ROLLBACK")
+                except Exception:
+                    pass
+
+    def put_many_background(self, kind: str, rows: List[tuple]):
+        """put_many in un thread senza attenderlo: serializzazione, compressione e commit non bloccano
+        l'event loop né allungano la risposta all'utente."""
+        if self.path and rows:
+            _run_in_background(asyncio.to_thread(self.put_many, kind, rows))
+
+    def load(self, kind: str) -> List[tuple]:
+        """Restituisce tutte le righe (key, fetched_at, data) di un tipo, eliminando quelle troppo vecchie."""
+        with self._lock:
+            conn = self._connection()
+            if conn is None:
+                return []
+            try:
+                conn.execute("DELETE FROM cache WHERE fetched_at < ?", (time.time() - CACHE_DB_RETENTION,))
+                rows = conn.execute("SELECT key, fetched_at, payload FROM cache WHERE kind = ?", (kind,)).fetchall()
+            except Exception as e:
+                logger.error(f"Errore lettura cache persistente: {e}")
+                return []
+        result = []
+        for key, fetched_at, payload in rows:
+            try:
+                result.append((key, fetched_at, self._unpack(payload)))
+            except Exception:
+                continue
+        return result
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+persistent_cache = PersistentCache(CACHE_DB_PATH)
+
+def warm_caches_from_disk():
+    """Ricarica in memoria eventi e orari salvati su disco, mantenendo il loro timestamp originale:
+    le entry ancora entro il TTL sono servite subito, le altre restano come ultimo dato noto."""
+    started = time.perf_counter()
+    for key, fetched_at, data in persistent_cache.load("event_records"):
+        try:
+            records = [_row_to_record(row) for row in data]
+            _events_cache[key] = (fetched_at, DayEvents(records, _events_fingerprint(data), next(_events_versions)))
+        except Exception:
+            continue
+    prune_events_cache()
+    for key, fetched_at, data in sorted(persistent_cache.load("sba"), key=lambda row: row[1]):
+        sba_cache.put(key, fetched_at, data)
+    logger.info(
+        f"Cache persistente: {len(_events_cache)} giorni di eventi e {len(sba_cache)} orari SBA "
+        f"caricati in {(time.perf_counter() - started) * 1000:.0f}ms"
+    )
+
+# --- CLIENT HTTP UPSTREAM ---
+# Un pool di connessioni keep-alive per host (Cineca, SBA, WP Unipi, self-ping):
+# l'handshake TCP+TLS si paga una volta per connessione e non più per richiesta,
+# e l'I/O non occupa più slot del thread pool di default.
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "10"))  # per host
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE", "5"))  # per host
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "60"))  # secondi
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "3"))  # secondi
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", "2"))
+UPSTREAM_RETRY_BACKOFF = float(os.environ.get("UPSTREAM_RETRY_BACKOFF", "0.3"))  # secondi, raddoppia a ogni tentativo
+
+# Circuit breaker: dopo BREAKER_FAILURE_THRESHOLD errori o chiamate più lente di
+# BREAKER_SLOW_CALL_SECONDS consecutive l'host viene considerato degradato per BREAKER_COOLDOWN secondi
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_SLOW_CALL_SECONDS = float(os.environ.get("BREAKER_SLOW_CALL_SECONDS", "4"))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "30"))
+# Risposte che indicano un host in difficoltà e contano come errori per il breaker, oltre ai 5xx:
+# timeout lato server e rate limiting. Gli altri 4xx sono errori della richiesta, non dell'host.
+BREAKER_FAILURE_STATUSES = frozenset({408, 425, 429})
+
+# Scheduler: al massimo UPSTREAM_HOST_CONCURRENCY richieste in volo per host; le altre
+# aspettano in coda servite per priorità (callback/messaggi, poi inline, poi prefetch)
+UPSTREAM_HOST_CONCURRENCY = int(os.environ.get("UPSTREAM_HOST_CONCURRENCY", "4"))
+UPSTREAM_STATS_INTERVAL = int(os.environ.get("UPSTREAM_STATS_INTERVAL", "900"))  # secondi tra un log delle metriche e l'altro
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_INLINE = 1
+PRIORITY_PREFETCH = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_INLINE: "inline", PRIORITY_PREFETCH: "prefetch"}
+
+# Classe di priorità della richiesta corrente; i task creati (gather, singleflight) la ereditano
+_upstream_priority: contextvars.ContextVar = contextvars.ContextVar("upstream_priority", default=PRIORITY_INTERACTIVE)
+
+def with_upstream_priority(priority: int):
+    """Decoratore per handler e job: le chiamate upstream fatte al loro interno usano questa priorità."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = _upstream_priority.set(priority)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _upstream_priority.reset(token)
+        return wrapper
+    return decorator
+
+class UpstreamUnavailable(Exception):
+    """Sollevata senza contattare l'upstream quando il suo circuit breaker è aperto."""
+
+class CircuitBreaker:
+    """Circuit breaker per host upstream con apertura basata su errori e latenza.
+    Da aperto lascia passare una sola richiesta di prova per cooldown e si richiude se va a buon fine."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"  # closed | open | half_open
+        self.failures = 0
+        self.opened_at = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return self.state != "closed"
+
+    def allow_request(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+            self.state = "half_open"  # questa richiesta è la prova di recupero
+            return True
+        return False
+
+    def record(self, ok: bool, elapsed: float):
+        if ok and elapsed < BREAKER_SLOW_CALL_SECONDS:
+            if self.state != "closed":
+                logger.info(f"Circuit breaker {self.name}: upstream di nuovo disponibile")
+            self.state = "closed"
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= BREAKER_FAILURE_THRESHOLD:
+            if self.state != "open":
+                logger.warning(f"Circuit breaker {self.name}: aperto ({'lento' if ok else 'errore'}, {elapsed:.1f}s)")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+class HostScheduler:
+    """Limita le richieste concorrenti verso un host e assegna gli slot liberi per priorità (poi FIFO).
+    Tiene le metriche del tempo passato in coda per classe di priorità."""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self.active = 0
+        self._queue: list = []  # heap di (priority, seq, future)
+        self._seq = itertools.count()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.stats = {p: [0, 0.0, 0.0] for p in PRIORITY_NAMES}  # priority -> [richieste, attesa totale, attesa max]
+        self.max_queue = 0
+
+    async def acquire(self, priority: int):
+        started = time.monotonic()
+        if self.active < self.limit and not self._queue:
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._queue, (priority, next(self._seq), future))
+            self.max_queue = max(self.max_queue, len(self._queue))
+            try:
+                await future  # lo slot viene passato direttamente da release()
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self.release()  # slot ricevuto ma non più usato
+                else:
+                    future.cancel()
+                raise
+        waited = time.monotonic() - started
+        entry = self.stats.setdefault(priority, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += waited
+        entry[2] = max(entry[2], waited)
+
+    def release(self):
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def summary(self, reset: bool = True) -> Optional[str]:
+        """Riga di log con richieste e attesa media/massima in coda per classe; None se l'host è rimasto inattivo."""
+        parts = []
+        for priority, (count, total, peak) in sorted(self.stats.items()):
+            if count:
+                parts.append(f"{PRIORITY_NAMES.get(priority, priority)} n={count} attesa media {total / count * 1000:.0f}ms max {peak * 1000:.0f}ms")
+        line = f"{self.name}: " + ", ".join(parts) + f", coda max {self.max_queue}" if parts else None
+        if reset:
+            self._reset_stats()
+        return line
+
+class UpstreamClient:
+    """Client HTTP asincrono con un pool di connessioni keep-alive e un circuit breaker per ogni host upstream."""
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._schedulers: Dict[str, HostScheduler] = {}
+
+    def breaker_for(self, url: str) -> CircuitBreaker:
+        host = httpx.URL(url).netloc.decode("ascii")
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = self._breakers[host] = CircuitBreaker(host)
+        return breaker
+
+    def _scheduler_for(self, url: str) -> HostScheduler:
+        host = httpx.URL(url).netloc.decode("ascii")
+        scheduler = self._schedulers.get(host)
+        if scheduler is None:
+            scheduler = self._schedulers[host] = HostScheduler(host, UPSTREAM_HOST_CONCURRENCY)
+        return scheduler
+
+    def _client_for(self, url: str) -> httpx.AsyncClient:
+        host = httpx.URL(url).netloc.decode("ascii")
+        client = self._clients.get(host)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=UPSTREAM_MAX_CONNECTIONS,
+                    max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                    keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+                ),
+                follow_redirects=True,
+            )
+            self._clients[host] = client
+        return client
+
+    async def request(self, method: str, url: str, *, timeout: float = 10, retries: Optional[int] = None, **kwargs) -> httpx.Response:
+        """Esegue la richiesta riprovando su errori di rete e risposte 5xx. Solleva l'ultimo errore,
+        o UpstreamUnavailable subito se il circuit breaker dell'host è aperto.
+        Ogni tentativo attende uno slot dello scheduler dell'host secondo la priorità corrente."""
+        if retries is None:
+            retries = UPSTREAM_RETRIES
+        breaker = self.breaker_for(url)
+        if not breaker.allow_request():
+            raise UpstreamUnavailable(f"{breaker.name}: circuit breaker aperto")
+        client = self._client_for(url)
+        scheduler = self._scheduler_for(url)
+        priority = _upstream_priority.get()
+        timeout_cfg = httpx.Timeout(timeout, connect=min(timeout, UPSTREAM_CONNECT_TIMEOUT))
+        elapsed = 0.0  # solo tempo upstream: l'attesa in coda non conta come lentezza per il breaker
+        ok = False
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    await scheduler.acquire(priority)
+                    started = time.monotonic()
+                    try:
+                        response = await client.request(method, url, timeout=timeout_cfg, **kwargs)
+                    finally:
+                        elapsed += time.monotonic() - started
+                        scheduler.release()
+                    if response.status_code >= 500 and attempt < retries:
+                        await asyncio.sleep(UPSTREAM_RETRY_BACKOFF * (2 ** attempt))
+                        continue
+                    ok = response.status_code < 500 and response.status_code not in BREAKER_FAILURE_STATUSES
+                    response.raise_for_status()
+                    return response
+                except httpx.TransportError:
+                    if attempt >= retries:
+                        raise
+                    await asyncio.sleep(UPSTREAM_RETRY_BACKOFF * (2 ** attempt))
+        finally:
+            breaker.record(ok, elapsed)
+
+    def log_stats(self):
+        for scheduler in self._schedulers.values():
+            line = scheduler.summary()
+            if line:
+                logger.info(f"Upstream {line}")
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+upstream = UpstreamClient()
+
+# --- COALESCING RICHIESTE UPSTREAM ---
+# Richieste concorrenti per la stessa chiave upstream (es. stesso calendario e giorno)
+# condividono un'unica chiamata in volo invece di aprirne una per utente.
+_inflight: Dict[str, asyncio.Future] = {}
+
+async def _singleflight(key: str, factory):
+    """Esegue factory() una sola volta per chiave tra i chiamanti concorrenti e ne condivide il risultato."""
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _inflight[key] = task
+        task.add_done_callback(lambda _t: _inflight.pop(key, None))
+    # shield: se un chiamante viene cancellato la richiesta condivisa prosegue per gli altri
+    return await asyncio.shield(task)
+
+_background_tasks: set = set()
+
+def _run_in_background(coro):
+    """Avvia una coroutine senza attenderla, mantenendo un riferimento fino al termine."""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def fetch_sba_opening_hours(nid: str, from_date: str, to_date: str, refresh: bool = False, raise_errors: bool = False) -> list:
+    """Fetch orari SBA per una biblioteca (con cache TTL). refresh=True ignora la cache; raise_errors=True
+    propaga l'errore invece di ripiegare sull'ultimo dato noto (o su una lista vuota)."""
     cache_key = f"{nid}:{from_date}:{to_date}"
     now_ts = time.time()
-    cached = _sba_cache.get(cache_key)
-    if cached and now_ts - cached[0] < SBA_CACHE_TTL:
-        return cached[1]
+    if not refresh:
+        cached = sba_cache.get(cache_key, now_ts)
+        if cached is not None:
+            return cached
     try:
         params = {
             "from_date": from_date,
             "to_date": to_date,
             "nid": nid
         }
-        response = requests.get(SBA_API_URL, params=params, timeout=5)
-        response.raise_for_status()
+        response = await upstream.request("GET", SBA_API_URL, params=params, timeout=5)
         data = response.json()
         result = data if isinstance(data, list) else []
-        _sba_cache[cache_key] = (now_ts, result)
+        sba_cache.put(cache_key, now_ts, result)
+        persistent_cache.put_many_background("sba", [(cache_key, now_ts, result)])
         return result
     except Exception as e:
-        logger.error(f"Errore API SBA nid={nid}: {e}")
-        return []
+        if not isinstance(e, UpstreamUnavailable):
+            logger.error(f"Errore API SBA nid={nid}: {e}")
+        if raise_errors:
+            raise
+        # Upstream degradato: meglio l'ultimo dato noto che nessun orario
+        stale = sba_cache.get_stale(cache_key)
+        return stale if stale is not None else []
+
+def _sba_week_blocks(from_day: date, to_day: date) -> List[date]:
+    """Lunedì delle settimane (lunedì-domenica) che coprono l'intervallo [from_day, to_day]."""
+    monday = from_day - timedelta(days=from_day.weekday())
+    blocks = []
+    while monday <= to_day:
+        blocks.append(monday)
+        monday += timedelta(weeks=1)
+    return blocks
+
+async def fetch_sba_opening_hours_async(nid: str, from_date: datetime, to_date: datetime, refresh: bool = False, raise_errors: bool = False) -> list:
+    """Orari SBA di una biblioteca tra due date (incluse). L'SBA viene interrogato sempre per settimane
+    intere lunedì-domenica, così giorno singolo, settimana e viste diverse condividono la stessa entry in cache.
+    Con raise_errors=True un fetch fallito solleva l'eccezione (vedi fetch_sba_opening_hours)."""
+    from_day = from_date.date() if isinstance(from_date, datetime) else from_date
+    to_day = to_date.date() if isinstance(to_date, datetime) else to_date
+    blocks = _sba_week_blocks(from_day, to_day)
+
+    async def fetch_block(monday: date) -> list:
+        m_str = monday.strftime("%Y-%m-%d")
+        s_str = (monday + timedelta(days=6)).strftime("%Y-%m-%d")
+        # Chiave separata per chi vuole l'errore: non deve ricevere il dato vecchio di un altro fetch, né viceversa
+        return await _singleflight(
+            f"sba:{nid}:{m_str}:{s_str}" + (":raise" if raise_errors else ""),
+            lambda: fetch_sba_opening_hours(nid, m_str, s_str, refresh=refresh, raise_errors=raise_errors),
+        )
+
+    if len(blocks) == 1:
+        entries = await fetch_block(blocks[0])
+    else:
+        entries = [e for block in await asyncio.gather(*(fetch_block(m) for m in blocks)) for e in block]
+    if from_day == blocks[0] and to_day == blocks[-1] + timedelta(days=6):
+        return entries
+    f_str = from_day.strftime("%Y-%m-%d")
+    t_str = to_day.strftime("%Y-%m-%d")
+    return [e for e in entries if f_str <= (e.get('date') or '') <= t_str]
+
+# --- MOTORE ORARI BIBLIOTECHE ---
+# I dati SBA di una biblioteca sono convertiti una sola volta in intervalli di apertura in minuti,
+# ordinati per giorno: aperta ora / chiude alle / apre alle sono ricerche binarie condivise da
+# /occupazione, /biblioteche, biblio:single, biblio:detail e dalla ricerca inline b:.
+SCHEDULE_MEMO_SIZE = 256
+
+def _parse_hhmm(value: str) -> Optional[int]:
+    try:
+        hours, minutes = value.split(':')[:2]
+        return int(hours) * 60 + int(minutes)
+    except (ValueError, AttributeError):
+        return None
+
+def _format_minute(minute: int) -> str:
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+class DaySchedule(NamedTuple):
+    """Aperture di un giorno: intervalli [inizio, fine) in minuti dalla mezzanotte, fusi e ordinati."""
+    starts: tuple
+    ends: tuple
+    labels: tuple  # "HH:MM-HH:MM" come forniti dall'SBA, per le righe degli orari
+
+    def status(self, minute: int) -> tuple:
+        """(aperta, chiude alle, apre alle) al minuto dato, con gli orari come stringhe HH:MM o None."""
+        index = bisect.bisect_right(self.starts, minute)
+        if index and minute < self.ends[index - 1]:
+            return True, _format_minute(self.ends[index - 1]), None
+        if index < len(self.starts):
+            return False, None, _format_minute(self.starts[index])
+        return False, None, None
 
-async def fetch_sba_opening_hours_async(nid: str, from_date: datetime, to_date: datetime) -> list:
-    f_str = from_date.strftime("%Y-%m-%d")
-    t_str = to_date.strftime("%Y-%m-%d")
-    return await asyncio.to_thread(fetch_sba_opening_hours, nid, f_str, t_str)
+_CLOSED_DAY = DaySchedule((), (), ())
+
+def _day_schedule(entries: list) -> DaySchedule:
+    parsed, unparsed = [], []
+    for entry in entries:
+        start, end = (entry.get('start_time') or '').strip(), (entry.get('end_time') or '').strip()
+        if start and end:
+            minutes = (_parse_hhmm(start), _parse_hhmm(end))
+            if None in minutes:
+                unparsed.append(f"{start}-{end}")
+            else:
+                parsed.append((minutes, f"{start}-{end}"))
+    # Ordinamento sui minuti, non sulle stringhe ("8:30" viene prima di "13:00")
+    parsed.sort()
+    starts, ends = [], []
+    for (start, end), _ in parsed:
+        if end <= start:
+            continue
+        if starts and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)  # intervalli sovrapposti o contigui: un'unica apertura
+        else:
+            starts.append(start)
+            ends.append(end)
+    return DaySchedule(tuple(starts), tuple(ends), tuple(label for _, label in parsed) + tuple(unparsed))
+
+class LibrarySchedule:
+    """Orari SBA di una biblioteca indicizzati per giorno ("YYYY-MM-DD" -> DaySchedule)."""
+    __slots__ = ("days", "key", "_weeks")
+
+    def __init__(self, entries: list):
+        by_day: Dict[str, list] = {}
+        for entry in entries:
+            by_day.setdefault(entry.get('date') or '', []).append(entry)
+        self.days = {day: _day_schedule(day_entries) for day, day_entries in by_day.items() if day}
+        self.key = tuple(sorted((day, schedule.labels) for day, schedule in self.days.items()))
+        self._weeks: Dict[date, tuple] = {}  # lunedì -> righe della settimana, calcolate al primo uso
+
+    def day(self, day: date) -> DaySchedule:
+        return self.days.get(day.isoformat(), _CLOSED_DAY)
+
+    def status(self, now: datetime) -> tuple:
+        """(aperta, chiude alle, apre alle) nel giorno e all'ora di now."""
+        return self.day(now.date()).status(now.hour * 60 + now.minute)
+
+    def day_hours(self, day: date) -> str:
+        """Orari del giorno come "08:30-13:00, 14:00-19:00", stringa vuota se chiusa."""
+        return ", ".join(self.day(day).labels)
+
+    def week_lines(self, monday: date) -> tuple:
+        lines = self._weeks.get(monday)
+        if lines is None:
+            days = [monday + timedelta(days=i) for i in range(7)]
+            lines = self._weeks[monday] = tuple(
+                f"{WEEKDAYS_SHORT[i]} {day.day:02d}/{day.month:02d} {self.day_hours(day) or 'Chiusa'}"
+                for i, day in enumerate(days)
+            )
+        return lines
+
+EMPTY_SCHEDULE = LibrarySchedule([])
+_schedule_memo: Dict[int, tuple] = {}  # id(lista SBA in cache) -> (lista, LibrarySchedule)
+
+def library_schedule(entries: list) -> LibrarySchedule:
+    """LibrarySchedule di una lista SBA, calcolato una volta per lista in cache."""
+    memo = _schedule_memo.get(id(entries))
+    if memo is not None and memo[0] is entries:
+        return memo[1]
+    schedule = LibrarySchedule(entries)
+    if len(_schedule_memo) >= SCHEDULE_MEMO_SIZE:
+        _schedule_memo.pop(next(iter(_schedule_memo)))
+    _schedule_memo[id(entries)] = (entries, schedule)
+    return schedule
+
+# --- ORARI BIBLIOTECHE IN MEMORIA ---
+# Un job in background scarica a intervalli fissi le settimane di tutte le biblioteche in un'unica
+# tabella in memoria: /biblioteche, b: e le righe biblioteca di /occupazione la leggono senza
+# chiamate upstream. Solo le date fuori dalla finestra coperta passano ancora dall'SBA.
+BIBLIO_TIMETABLE_WEEKS = int(os.environ.get("BIBLIO_TIMETABLE_WEEKS", "2"))  # settimana corrente e successive
+BIBLIO_REFRESH_INTERVAL = int(os.environ.get("BIBLIO_REFRESH_INTERVAL", "1800"))  # secondi
+# nid -> (primo giorno, ultimo giorno, orari): ogni biblioteca ha la sua finestra, perché una
+# biblioteca il cui refresh fallisce mantiene gli orari (e la finestra) del refresh precedente
+_biblio_timetable: Dict[str, tuple] = {}
+
+def _biblio_nids() -> List[str]:
+    nids = []
+    for lib in load_biblioteche_json():
+        nid = str(lib.get('nid') or '')
+        if nid and nid not in nids:
+            nids.append(nid)
+    return nids
+
+async def refresh_biblio_timetable(now: Optional[datetime] = None) -> int:
+    """Riscarica le settimane di tutte le biblioteche e sostituisce la tabella in memoria.
+    Una biblioteca il cui fetch fallisce mantiene gli orari precedenti. Ritorna il numero di biblioteche."""
+    global _biblio_timetable
+    today = (now or datetime.now(TZ_ROME)).date()
+    first = today - timedelta(days=today.weekday())
+    last = first + timedelta(weeks=max(1, BIBLIO_TIMETABLE_WEEKS), days=-1)
+    nids = _biblio_nids()
+    fetched = await asyncio.gather(
+        *(fetch_sba_opening_hours_async(nid, first, last, refresh=True, raise_errors=True) for nid in nids),
+        return_exceptions=True,
+    )
+    timetable: Dict[str, tuple] = {}
+    for nid, entries in zip(nids, fetched):
+        if isinstance(entries, Exception):
+            previous = _biblio_timetable.get(nid)
+            if previous is not None and previous[1] >= today:
+                timetable[nid] = previous  # copre ancora oggi: i giorni oltre la sua fine vanno all'SBA
+            continue
+        timetable[nid] = (first, last, LibrarySchedule(entries))
+    _biblio_timetable = timetable
+    return len(nids)
+
+def biblio_schedule_from_memory(nid: str, from_day: date, to_day: date) -> Optional[LibrarySchedule]:
+    """Orari di una biblioteca dalla tabella in memoria, None se l'intervallo non è coperto."""
+    entry = _biblio_timetable.get(nid)
+    if entry is None or from_day < entry[0] or to_day > entry[1]:
+        return None
+    return entry[2]
+
+async def _fetch_biblio_schedule(nid: str, from_day: date, to_day: date) -> LibrarySchedule:
+    blocks = _sba_week_blocks(from_day, to_day)
+    if len(blocks) == 1:
+        # Settimana intera: la lista restituita è quella in cache, quindi il calcolo è memoizzato
+        return library_schedule(await fetch_sba_opening_hours_async(nid, blocks[0], blocks[0] + timedelta(days=6)))
+    return LibrarySchedule(await fetch_sba_opening_hours_async(nid, from_day, to_day))
+
+async def get_biblio_schedule(nid: str, from_date: datetime, to_date: datetime) -> LibrarySchedule:
+    """Orari di una biblioteca che coprono le date richieste: dalla memoria se possibile, altrimenti dall'SBA."""
+    from_day = from_date.date() if isinstance(from_date, datetime) else from_date
+    to_day = to_date.date() if isinstance(to_date, datetime) else to_date
+    schedule = biblio_schedule_from_memory(str(nid), from_day, to_day)
+    if schedule is not None:
+        return schedule
+    return await _fetch_biblio_schedule(str(nid), from_day, to_day)
+
+async def get_biblio_schedules(nids: List[str], from_date: datetime, to_date: datetime) -> Dict[str, LibrarySchedule]:
+    """Come get_biblio_schedule per più biblioteche; solo quelle non coperte dalla memoria vanno all'SBA."""
+    from_day = from_date.date() if isinstance(from_date, datetime) else from_date
+    to_day = to_date.date() if isinstance(to_date, datetime) else to_date
+    result: Dict[str, LibrarySchedule] = {}
+    missing = []
+    for nid in nids:
+        schedule = biblio_schedule_from_memory(str(nid), from_day, to_day)
+        if schedule is None:
+            missing.append(str(nid))
+        else:
+            result[str(nid)] = schedule
+    if missing:
+        fetched = await asyncio.gather(
+            *(_fetch_biblio_schedule(nid, from_day, to_day) for nid in missing),
+            return_exceptions=True,
+        )
+        for nid, schedule in zip(missing, fetched):
+            result[nid] = schedule if not isinstance(schedule, Exception) else EMPTY_SCHEDULE
+    return result
 
 def get_polos() -> List[str]:
     data = load_unified_json()
@@ -743,6 +1572,140 @@ def find_dove_item(items: List[Dict], aula_nome: str, polo: str = None) -> Optio
                 return item
     return None
 
+# --- MINIATURE ---
+# Le thumbnail dei risultati inline (quadrato colorato con la lettera dell'edificio, pallino di stato)
+# sono PNG generati dal bot e serviti dal server del webhook con cache lunga, invece che da
+# placehold.co e ui-avatars. Il nome del file descrive tutto il disegno (stile, colori, etichetta),
+# quindi il server lo rigenera alla richiesta anche dopo un riavvio. Senza server webhook (polling)
+# si usano ancora i generatori esterni.
+THUMBS_ROUTE = "/thumbs"
+THUMB_SIZE = 100
+THUMB_STYLE = "v1"  # da cambiare se cambia il disegno: i client tengono in cache i PNG per un anno
+THUMB_LABEL_MAX_LEN = 4  # i codici di edifici e poli sono di 1-3 caratteri
+THUMB_CACHE_SIZE = 256
+STATUS_COLOR_FREE = "8cacaa"
+STATUS_COLOR_BUSY = "b04859"
+_thumbs_base_url = ""  # impostato da run_webhook_server quando il server delle miniature è in ascolto
+_thumb_pngs: Dict[str, bytes] = {}  # nome file -> PNG già generato (LRU)
+_THUMB_NAME_RE = re.compile(rf"^{THUMB_STYLE}-(?:label-([0-9a-f]{{6}})-([0-9a-f]{{6}})-([A-Z0-9]{{1,{THUMB_LABEL_MAX_LEN}}}|_)|dot-([0-9a-f]{{6}}))\.png$")
+
+# Font bitmap 5x7 per le etichette (solo maiuscole e cifre, come i codici degli edifici)
+_THUMB_FONT = {
+    "A": "01110 10001 10001 11111 10001 10001 10001", "B": "11110 10001 10001 11110 10001 10001 11110",
+    "C": "01110 10001 10000 10000 10000 10001 01110", "D": "11100 10010 10001 10001 10001 10010 11100",
+    "E": "11111 10000 10000 11110 10000 10000 11111", "F": "11111 10000 10000 11110 10000 10000 10000",
+    "G": "01110 10001 10000 10111 10001 10001 01111", "H": "10001 10001 10001 11111 10001 10001 10001",
+    "I": "01110 00100 00100 00100 00100 00100 01110", "J": "00111 00010 00010 00010 00010 10010 01100",
+    "K": "10001 10010 10100 11000 10100 10010 10001", "L": "10000 10000 10000 10000 10000 10000 11111",
+    "M": "10001 11011 10101 10101 10001 10001 10001", "N": "10001 10001 11001 10101 10011 10001 10001",
+    "O": "01110 10001 10001 10001 10001 10001 01110", "P": "11110 10001 10001 11110 10000 10000 10000",
+    "Q": "01110 10001 10001 10001 10101 10010 01101", "R": "11110 10001 10001 11110 10100 10010 10001",
+    "S": "01111 10000 10000 01110 00001 00001 11110", "T": "11111 00100 00100 00100 00100 00100 00100",
+    "U": "10001 10001 10001 10001 10001 10001 01110", "V": "10001 10001 10001 10001 10001 01010 00100",
+    "W": "10001 10001 10001 10101 10101 10101 01010", "X": "10001 10001 01010 00100 01010 10001 10001",
+    "Y": "10001 10001 01010 00100 00100 00100 00100", "Z": "11111 00001 00010 00100 01000 10000 11111",
+    "0": "01110 10001 10011 10101 11001 10001 01110", "1": "00100 01100 00100 00100 00100 00100 01110",
+    "2": "01110 10001 00001 00010 00100 01000 11111", "3": "11111 00010 00100 00010 00001 10001 01110",
+    "4": "00010 00110 01010 10010 11111 00010 00010", "5": "11111 10000 11110 00001 00001 10001 01110",
+    "6": "00110 01000 10000 11110 10001 10001 01110", "7": "11111 00001 00010 00100 01000 01000 01000",
+    "8": "01110 10001 10001 01110 10001 10001 01110", "9": "01110 10001 10001 01111 00001 00010 01100",
+}
+
+def _hex_rgb(color: str) -> tuple:
+    color = (color or DEFAULT_COLOR).lstrip("#")
+    try:
+        return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4))
+    except ValueError:
+        return _hex_rgb(DEFAULT_COLOR)
+
+def _encode_png(width: int, height: int, rgba: bytearray) -> bytes:
+    """PNG RGBA 8 bit senza dipendenze esterne (filtro 0 su ogni riga)."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    stride = width * 4
+    raw = b"".join(b"\x00" + bytes(rgba[y * stride:(y + 1) * stride]) for y in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 9))
+        + chunk(b"IEND", b"")
+    )
+
+def render_label_thumb(background: str, foreground: str, text: str, size: int = THUMB_SIZE) -> bytes:
+    """Quadrato del colore dell'edificio con il testo centrato (font bitmap scalato)."""
+    rgba = bytearray(bytes(_hex_rgb(background) + (255,)) * (size * size))
+    glyphs = [_THUMB_FONT[c] for c in (text or "").upper() if c in _THUMB_FONT]
+    if glyphs:
+        columns = 6 * len(glyphs) - 1
+        scale = max(1, min(6, (size * 7 // 10) // columns))
+        left = (size - columns * scale) // 2
+        top = (size - 7 * scale) // 2
+        pixel = bytes(_hex_rgb(foreground) + (255,)) * scale
+        for index, glyph in enumerate(glyphs):
+            for row, bits in enumerate(glyph.split()):
+                for col, bit in enumerate(bits):
+                    if bit != "1":
+                        continue
+                    x = left + (index * 6 + col) * scale
+                    for y in range(top + row * scale, top + (row + 1) * scale):
+                        offset = (y * size + x) * 4
+                        rgba[offset:offset + 4 * scale] = pixel
+    return _encode_png(size, size, rgba)
+
+def render_dot_thumb(color: str, size: int = THUMB_SIZE) -> bytes:
+    """Cerchio pieno su fondo trasparente, con bordo antialiasing."""
+    r, g, b = _hex_rgb(color)
+    rgba = bytearray(size * size * 4)
+    radius = size / 2
+    for y in range(size):
+        dy = y + 0.5 - radius
+        for x in range(size):
+            dx = x + 0.5 - radius
+            coverage = min(1.0, max(0.0, radius - math.sqrt(dx * dx + dy * dy) + 0.5))
+            if coverage:
+                offset = (y * size + x) * 4
+                rgba[offset:offset + 4] = bytes((r, g, b, int(coverage * 255)))
+    return _encode_png(size, size, rgba)
+
+def thumb_png(name: str) -> Optional[bytes]:
+    """PNG della miniatura `name` (come generato da label_thumb_url/status_thumb_url); None se il nome
+    non è una miniatura valida dello stile corrente."""
+    png = _thumb_pngs.pop(name, None)
+    if png is None:
+        match = _THUMB_NAME_RE.match(name)
+        if not match:
+            return None
+        background, foreground, label, dot = match.groups()
+        if dot:
+            png = render_dot_thumb(dot)
+        else:
+            png = render_label_thumb(background, foreground, "" if label == "_" else label)
+        if len(_thumb_pngs) >= THUMB_CACHE_SIZE:
+            _thumb_pngs.pop(next(iter(_thumb_pngs)))
+    _thumb_pngs[name] = png  # in coda: usata di recente
+    return png
+
+def _local_thumb_url(name: str) -> Optional[str]:
+    """URL pubblico della miniatura `name`, o None se il server delle miniature non è attivo."""
+    if not _thumbs_base_url or not _THUMB_NAME_RE.match(name):
+        return None
+    return f"{_thumbs_base_url}{THUMBS_ROUTE}/{name}"
+
+def label_thumb_url(background: str, foreground: str, text: str) -> str:
+    """Miniatura quadrata con etichetta (edifici e poli)."""
+    label = "".join(c for c in (text or "").upper() if c in _THUMB_FONT)
+    url = _local_thumb_url(f"{THUMB_STYLE}-label-{background.lower()}-{foreground.lower()}-{label or '_'}.png")
+    if url:
+        return url
+    safe_text = urllib.parse.quote(text) if text else "%20"
+    return f"https://placehold.co/100/{background}/{foreground}.png?text={safe_text}&font=montserrat"
+
+def status_thumb_url(is_free: bool) -> str:
+    """Pallino verde (libera/aperta) o rosso (occupata/chiusa) per le card di stato."""
+    color = STATUS_COLOR_FREE if is_free else STATUS_COLOR_BUSY
+    url = _local_thumb_url(f"{THUMB_STYLE}-dot-{color}.png")
+    return url or f"https://ui-avatars.com/api/?name=X&background={color}&color={color}&rounded=true&size=100"
+
 def get_building_thumb(description=None, polo=None, edificio=None):
     unified_data = load_unified_json()
     
@@ -872,9 +1835,7 @@ def get_building_thumb(description=None, polo=None, edificio=None):
         else:
             text = ""
     
-    import urllib.parse
-    safe_text = urllib.parse.quote(text) if text else "%20"
-    return f"https://placehold.co/100/{color}/{fg_color}.png?text={safe_text}&font=montserrat"
+    return label_thumb_url(color, fg_color, text)
 
 def extract_url_from_markdown(markdown_text):
     try:
@@ -921,21 +1882,229 @@ def _extract_surname_from_api_title(title: str) -> str:
     surname_parts = parts[surname_cut:]
     return " ".join(surname_parts).upper()
 
-def fetch_day_events(calendar_id: Union[str, List[str]], day: datetime) -> List[Dict[str, Any]]:
-    """Recupera tutti gli eventi per un giorno specifico."""
+class EventRecord(NamedTuple):
+    """Evento Cineca normalizzato una sola volta al fetch; il payload grezzo viene scartato."""
+    rooms: frozenset  # codici e descrizioni delle aule, strip + upper
+    start: datetime  # aware, ora di Roma
+    end: datetime
+    nome: str  # nome del corso tagliato al primo '-'
+    docenti: str  # "Nome Cognome, ..." come appaiono nel calendario
+
+def _compact_event(event: Dict[str, Any]) -> Optional[EventRecord]:
+    """Converte un evento Cineca grezzo in EventRecord (None se le date non sono valide)."""
+    try:
+        start = datetime.fromisoformat(event['dataInizio'].replace('Z', '+00:00')).astimezone(TZ_ROME)
+        end = datetime.fromisoformat(event['dataFine'].replace('Z', '+00:00')).astimezone(TZ_ROME)
+    except Exception as e:
+        logger.error(f"Errore parsing evento: {e}")
+        return None
+
+    rooms = set()
+    for aula in event.get('aule') or []:
+        for field in ('codice', 'descrizione'):
+            value = (aula.get(field) or '').strip().upper()
+            if value:
+                rooms.add(value)
+
+    docenti_nomi = []
+    for d in event.get('docenti') or []:
+        if d:
+            nome_compl = d.get('cognomeNome')
+            if not nome_compl:
+                nome_compl = f"{d.get('nome', '').strip()} {d.get('cognome', '').strip()}".strip()
+            if nome_compl:
+                docenti_nomi.append(nome_compl)
+
+    return EventRecord(
+        rooms=frozenset(rooms),
+        start=start,
+        end=end,
+        nome=(event.get('nome') or 'N/D').split('-')[0].strip(),
+        docenti=', '.join(docenti_nomi),
+    )
+
+def _compact_events(events: List[Dict[str, Any]]) -> List[EventRecord]:
+    return [r for r in map(_compact_event, events) if r is not None]
+
+def _record_to_row(record: EventRecord) -> list:
+    """Riga compatta per la cache persistente: timestamp interi invece di stringhe ISO."""
+    return [sorted(record.rooms), int(record.start.timestamp()), int(record.end.timestamp()), record.nome, record.docenti]
+
+def _row_to_record(row: list) -> EventRecord:
+    rooms, start_ts, end_ts, nome, docenti = row
+    return EventRecord(
+        frozenset(rooms),
+        datetime.fromtimestamp(start_ts, TZ_ROME),
+        datetime.fromtimestamp(end_ts, TZ_ROME),
+        nome,
+        docenti,
+    )
+
+# Versione dei dati derivati: cambia solo quando cambia l'impronta degli eventi di un (calendario, giorno)
+_events_versions = itertools.count(1)
+
+def _event_sort_key(record: EventRecord):
+    # A parità di orario ordine stabile, indipendente dall'ordine restituito dall'API
+    return (record.start, record.end, record.nome, record.docenti)
+
+class RoomTimeline(NamedTuple):
+    """Eventi di un'aula ordinati per inizio, con gli array per le ricerche binarie."""
+    events: tuple
+    starts: list
+    max_ends: list  # massimo cumulativo delle fine: non decrescente, quindi bisecabile
+
+def _room_timeline(records) -> RoomTimeline:
+    ordered = tuple(sorted(records, key=_event_sort_key))
+    max_ends = []
+    latest = None
+    for record in ordered:
+        latest = record.end if latest is None or record.end > latest else latest
+        max_ends.append(latest)
+    return RoomTimeline(ordered, [record.start for record in ordered], max_ends)
+
+# Bitmap di occupazione: un bit per slot di SLOT_MINUTES minuti (bit 0 = 00:00-00:05), in un int Python
+SLOT_MINUTES = 5
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+
+def _slot_mask(start_minute: int, end_minute: int) -> int:
+    """Bit degli slot che intersecano [start_minute, end_minute) (minuti dalla mezzanotte)."""
+    first = max(0, start_minute // SLOT_MINUTES)
+    last = min(SLOTS_PER_DAY, -(-end_minute // SLOT_MINUTES))
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+def _minute_of_day(dt: datetime) -> int:
+    return dt.hour * 60 + dt.minute
+
+def window_slot_mask(start: datetime, end: datetime) -> int:
+    """Slot della finestra [start, end) nel giorno di start; se end è in un altro giorno arriva a fine giornata."""
+    start_minute = _minute_of_day(start)
+    end_minute = _minute_of_day(end) if end.date() == start.date() else 24 * 60
+    # Finestra vuota o invertita: si controlla almeno lo slot di inizio
+    return _slot_mask(start_minute, max(end_minute, start_minute + 1))
+
+@functools.lru_cache(maxsize=64)
+def _rome_day_bounds(day: date) -> tuple:
+    """Mezzanotte di inizio e fine del giorno a Roma (localize di pytz è costoso, il risultato è riusato)."""
+    return (
+        TZ_ROME.localize(datetime.combine(day, datetime.min.time())),
+        TZ_ROME.localize(datetime.combine(day + timedelta(days=1), datetime.min.time())),
+    )
+
+class DayEvents(list):
+    """Eventi di un (calendario, giorno) con impronta del payload, versione e indice aula -> timeline.
+    Un refresh con payload identico mantiene lo stesso oggetto, quindi anche i derivati restano validi."""
+
+    def __init__(self, records=(), fingerprint: str = "", version=0, by_room: Optional[Dict[str, RoomTimeline]] = None):
+        super().__init__(records)
+        self.fingerprint = fingerprint
+        self.version = version
+        self.by_room = by_room if by_room is not None else _index_by_room(self)
+        self._by_codes: Dict[frozenset, RoomTimeline] = {}
+        self._masks: Dict[tuple, int] = {}
+
+    def timeline_for(self, match_codes: frozenset) -> RoomTimeline:
+        """Timeline dell'aula con questi codici di match; dopo il primo accesso è un solo lookup."""
+        timeline = self._by_codes.get(match_codes)
+        if timeline is None:
+            hits = [self.by_room[code] for code in match_codes if code in self.by_room]
+            if len(hits) == 1:
+                timeline = hits[0]
+            else:
+                # dedup per identità: lo stesso evento può comparire sotto codice e descrizione dell'aula
+                timeline = _room_timeline({id(e): e for t in hits for e in t.events}.values())
+            self._by_codes[match_codes] = timeline
+        return timeline
+
+    def occupancy_mask(self, match_codes: frozenset, day: date) -> int:
+        """Bitmap degli slot occupati dall'aula negli eventi che iniziano in `day` (memoizzata)."""
+        key = (match_codes, day)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = 0
+            for event in self.timeline_for(match_codes).events:
+                if event.start.date() != day:
+                    continue
+                end_minute = _minute_of_day(event.end) if event.end.date() == day else 24 * 60
+                mask |= _slot_mask(_minute_of_day(event.start), end_minute)
+            self._masks[key] = mask
+        return mask
+
+    @classmethod
+    def merge(cls, parts: List[List[EventRecord]]) -> "DayEvents":
+        """Unisce gli eventi di più calendari (es. ingegneria) riusando gli indici per aula di ciascuno."""
+        parts = [p if isinstance(p, DayEvents) else cls(p) for p in parts]
+        merged: Dict[str, list] = {}
+        for part in parts:
+            for room, timeline in part.by_room.items():
+                merged.setdefault(room, []).append(timeline)
+        by_room = {
+            room: timelines[0] if len(timelines) == 1 else _room_timeline(e for t in timelines for e in t.events)
+            for room, timelines in merged.items()
+        }
+        return cls(
+            (event for part in parts for event in part),
+            version=tuple(part.version for part in parts),
+            by_room=by_room,
+        )
+
+def _index_by_room(records: List[EventRecord], previous: Optional[List[EventRecord]] = None) -> Dict[str, RoomTimeline]:
+    """Indice codice aula normalizzato -> timeline. Con la versione precedente ricalcola solo
+    le aule toccate da eventi aggiunti o rimossi (confronto come multiinsieme: due eventi identici
+    contano due volte, quindi sparirne uno è una modifica)."""
+    if not isinstance(previous, DayEvents):
+        by_room: Dict[str, list] = {}
+        for record in records:
+            for room in record.rooms:
+                by_room.setdefault(room, []).append(record)
+        return {room: _room_timeline(room_events) for room, room_events in by_room.items()}
+    before, after = Counter(previous), Counter(records)
+    changed = (before - after) + (after - before)
+    affected = set().union(*(record.rooms for record in changed))
+    by_room = {room: timeline for room, timeline in previous.by_room.items() if room not in affected}
+    for room in affected:
+        room_events = [record for record in records if room in record.rooms]
+        if room_events:
+            by_room[room] = _room_timeline(room_events)
+    return by_room
+
+def _events_fingerprint(rows: list) -> str:
+    """Impronta delle righe compatte di un giorno, indipendente dall'ordine restituito dall'API."""
+    return hashlib.sha1(json.dumps(sorted(rows), separators=(",", ":")).encode("utf-8")).hexdigest()
+
+def _events_window_start(day: date) -> date:
+    """Primo giorno della finestra di EVENTS_RANGE_DAYS giorni che contiene day.
+    Le finestre sono allineate a oggi, così la navigazione ◀ ▶ resta nella stessa finestra."""
+    today = datetime.now(TZ_ROME).date()
+    return today + timedelta(days=((day - today).days // EVENTS_RANGE_DAYS) * EVENTS_RANGE_DAYS)
+
+def prune_events_cache(today: Optional[date] = None, keep: tuple = ()) -> int:
+    """Elimina i giorni passati (prima di ieri) e, oltre EVENTS_CACHE_MAX_DAYS entry, quelli più lontani
+    nel futuro: la finestra avanza ogni giorno e senza pulizia i DayEvents vecchi restano per sempre.
+    Le chiavi in keep (la finestra appena scaricata) non vengono toccate. Ritorna il numero di entry eliminate."""
+    today = today or datetime.now(TZ_ROME).date()
+    cutoff = (today - timedelta(days=1)).isoformat()
+    stale = [key for key in _events_cache if key.rsplit(":", 1)[-1] < cutoff]
+    for key in stale:
+        del _events_cache[key]
+    removed = len(stale)
+    excess = len(_events_cache) - EVENTS_CACHE_MAX_DAYS
+    if excess > 0:
+        candidates = sorted((k for k in _events_cache if k not in keep), key=lambda k: k.rsplit(":", 1)[-1], reverse=True)
+        for key in candidates[:excess]:
+            del _events_cache[key]
+        removed += min(excess, len(candidates))
+    return removed
+
+async def fetch_range_events(calendar_id: str, start_day: date, days: int = EVENTS_RANGE_DAYS) -> bool:
+    """Recupera con una sola chiamata gli eventi di `days` giorni a partire da start_day
+    e li salva in cache giorno per giorno. Ritorna False se la chiamata fallisce."""
     if not calendar_id:
-        return []
-        
-    if isinstance(calendar_id, list):
-        all_events = []
-        for cid in calendar_id:
-            events = fetch_day_events(cid, day)
-            if events:
-                all_events.extend(events)
-        return all_events
-        
-    start = day.replace(hour=0, minute=0, second=0, microsecond=0)
-    end = day.replace(hour=23, minute=59, second=59, microsecond=999999)
+        return False
+
+    start = TZ_ROME.localize(datetime.combine(start_day, datetime.min.time()))
+    end = TZ_ROME.localize(datetime.combine(start_day + timedelta(days=days - 1), datetime.max.time()))
     
     headers = {
         'content-type': 'application/json;charset=UTF-8',
@@ -951,21 +2120,100 @@ def fetch_day_events(calendar_id: Union[str, List[str]], day: datetime) -> List[
     }
     
     try:
-        response = requests.post(API_URL, headers=headers, json=payload, timeout=10)
-        response.raise_for_status()
-        return response.json()
+        response = await upstream.request("POST", API_URL, headers=headers, json=payload, timeout=10)
+        events = response.json()
+    except UpstreamUnavailable:
+        return False
     except Exception as e:
         logger.error(f"Errore fetch eventi: {e}")
-        return []
+        return False
+
+    # Suddivide la finestra in entry per giorno (anche vuote) in base alla data di inizio a Roma
+    by_day: Dict[str, List[EventRecord]] = {
+        (start_day + timedelta(days=i)).isoformat(): [] for i in range(days)
+    }
+    for record in _compact_events(events if isinstance(events, list) else []):
+        by_day.setdefault(record.start.date().isoformat(), []).append(record)
+
+    now_ts = time.time()
+    rows = []
+    for day_iso, day_events in by_day.items():
+        key = f"{calendar_id}:{day_iso}"
+        day_rows = [_record_to_row(r) for r in day_events]
+        fingerprint = _events_fingerprint(day_rows)
+        previous = _events_cache.get(key, (0, None))[1]
+        if isinstance(previous, DayEvents) and previous.fingerprint == fingerprint:
+            # Payload invariato (il caso comune): si aggiorna solo il timestamp
+            day_events = previous
+        else:
+            day_events = DayEvents(day_events, fingerprint, next(_events_versions), _index_by_room(day_events, previous))
+        _events_cache[key] = (now_ts, day_events)
+        rows.append((key, now_ts, day_rows))
+    persistent_cache.put_many_background("event_records", rows)
+    prune_events_cache(keep=tuple(key for key, _, _ in rows))
+    return True
 
-async def fetch_day_events_async(calendar_id: Union[str, List[str]], day: datetime) -> List[Dict[str, Any]]:
-    """Wrapper async per evitare blocchi dell'event loop. Se lista, fetcha in parallelo."""
+async def fetch_day_events_async(calendar_id: Union[str, List[str]], day: datetime, refresh: bool = False) -> List[EventRecord]:
+    """Recupera gli eventi del giorno dalla cache; in caso di miss scarica l'intera finestra
+    che lo contiene, condividendo le richieste in volo. Se lista, fetcha in parallelo.
+    refresh=True ignora la cache."""
     if isinstance(calendar_id, list):
         if not calendar_id:
             return []
-        results = await asyncio.gather(*[asyncio.to_thread(fetch_day_events, cid, day) for cid in calendar_id])
-        return [event for result in results for event in result]
-    return await asyncio.to_thread(fetch_day_events, calendar_id, day)
+        results = await asyncio.gather(*[fetch_day_events_async(cid, day, refresh=refresh) for cid in calendar_id])
+        return DayEvents.merge(results)
+    if not calendar_id:
+        return []
+    day_key = f"{calendar_id}:{day.strftime('%Y-%m-%d')}"
+    cached = _events_cache.get(day_key)
+    if not refresh and cached and time.time() - cached[0] < _cache_ttl(EVENTS_CACHE_TTL):
+        return cached[1]
+    window_start = _events_window_start(day.date())
+
+    def fetch():
+        return _singleflight(
+            f"cineca:{calendar_id}:{window_start.isoformat()}",
+            lambda: fetch_range_events(calendar_id, window_start),
+        )
+
+    if cached and not refresh and upstream.breaker_for(API_URL).is_open:
+        # Cineca degradato: risposta immediata con l'ultimo dato noto, il recupero
+        # viene sondato in background (la richiesta passa solo dopo il cooldown)
+        _run_in_background(fetch())
+        return cached[1]
+    await fetch()
+    # Se la chiamata è fallita resta l'ultimo dato noto (se esiste)
+    return _events_cache.get(day_key, (0, []))[1]
+
+def events_stale_notice(calendar_id: Union[str, List[str], None], day: datetime) -> str:
+    """Avviso Markdown da mostrare se gli eventi del giorno non sono aggiornati o mancano, altrimenti ''."""
+    cids = calendar_id if isinstance(calendar_id, list) else [calendar_id]
+    oldest = None
+    for cid in cids:
+        if not cid:
+            continue
+        cached = _events_cache.get(f"{cid}:{day.strftime('%Y-%m-%d')}")
+        if cached is None:
+            return "_⚠ Calendario non raggiungibile, occupazione non disponibile._\n"
+        if time.time() - cached[0] >= _cache_ttl(EVENTS_CACHE_TTL):
+            oldest = cached[0] if oldest is None else min(oldest, cached[0])
+    if oldest is not None:
+        updated = datetime.fromtimestamp(oldest, TZ_ROME)
+        return f"_⚠ Dati non aggiornati, ultimo aggiornamento {updated.strftime('%d/%m %H:%M')}._\n"
+    return ""
+
+def events_available(calendar_id: Union[str, List[str], None], day: date) -> bool:
+    """True se per tutti i calendari c'è un dato (aggiornato o vecchio) del giorno: un fetch fallito
+    senza dati precedenti restituisce [] e non va scambiato per un giorno senza lezioni."""
+    cids = calendar_id if isinstance(calendar_id, list) else [calendar_id]
+    return all(f"{cid}:{day.isoformat()}" in _events_cache for cid in cids if cid)
+
+def _with_notice(text: str, notice: str) -> str:
+    """Inserisce l'avviso subito dopo la riga del titolo."""
+    if not notice:
+        return text
+    head, sep, tail = text.partition("\n")
+    return f"{head}{sep}{notice}{tail}" if sep else f"{text}\n{notice}"
 
 async def search_unipi_person(name_query: str) -> Optional[Dict[str, str]]:
     """
@@ -975,12 +2223,12 @@ async def search_unipi_person(name_query: str) -> Optional[Dict[str, str]]:
     if not name_query or len(name_query) < 3:
         return None
         
-    url = "https://www.unipi.it/wp-json/wp/v2/unipi_persone"
+    url = UNIPI_PERSONE_URL
     # Cerca intero nome stringa
     params = {"search": name_query, "per_page": 3}
     
     try:
-        response = await asyncio.to_thread(requests.get, url, params=params, timeout=5)
+        response = await upstream.request("GET", url, params=params, timeout=5, retries=0)
         if response.status_code == 200:
             data = response.json()
             if data and isinstance(data, list):
@@ -1002,7 +2250,7 @@ async def search_unipi_person(name_query: str) -> Optional[Dict[str, str]]:
         
     return None
 
-def get_aula_status(aula_nome: str, events: List[Dict], now: datetime, polo: str = "fibonacci", edificio: str = None) -> Dict:
+def get_aula_status(aula_nome: str, events: List[EventRecord], now: datetime, polo: str = "fibonacci", edificio: str = None, match_codes: Optional[frozenset] = None) -> Dict:
     """
     Calcola lo stato di un'aula.
     Returns: {
@@ -1012,128 +2260,52 @@ def get_aula_status(aula_nome: str, events: List[Dict], now: datetime, polo: str
         'next_events': List[Dict]
     }
     """
-    # Genera varianti del nome per strict matching
-    # Usa il prefix del polo o dell'edificio
-    prefix = 'Fib'
-    data = load_unified_json()
-    try:
-        polo_data = data['polo'][polo]
-        if edificio and 'edificio' in polo_data and edificio in polo_data['edificio']:
-            prefix = polo_data['edificio'][edificio].get('prefix', polo_data.get('prefix', 'Fib'))
-        else:
-            prefix = get_polo_prefix(polo)
-    except Exception:
-        prefix = get_polo_prefix(polo)
-        
-    prefix_upper = prefix.upper()
-    prefix_cap = prefix.capitalize()
-    
-    strict_variants = set()
-    
-    if aula_nome.startswith("Aula "):
-        base = aula_nome[5:]  # "A"
-        strict_variants.add(f"{prefix_upper} {base}")
-        strict_variants.add(f"{prefix_cap} {base}")
-        strict_variants.add(base)  # Solo se il codice è esattamente "A", molto raro ma possibile
-    elif aula_nome.startswith("Laboratorio "):
-        num = aula_nome[12:]
-        strict_variants.add(f"{prefix_upper} LAB {num}")
-        strict_variants.add(f"{prefix_cap} Lab {num}")
-        for template in LAB_CODE_VARIANTS:
-            templ = template.strip()
-            if templ:
-                strict_variants.add(templ.format(num=num))
+    if match_codes is None:
+        match_codes = room_match_codes(aula_nome, polo, edificio)
+    if now.tzinfo is None:
+        now = now.astimezone(TZ_ROME)
+
+    # STRICT MATCHING: uguaglianza esatta tra codici/descrizioni delle aule dell'evento e codici dell'aula
+    if isinstance(events, DayEvents):
+        timeline = events.timeline_for(match_codes)
     else:
-        strict_variants.add(f"{prefix_upper} {aula_nome}")
-        strict_variants.add(f"{prefix_cap} {aula_nome}")
-        strict_variants.add(aula_nome)
-    
-    # Aggiungi varianti upper per sicurezza
-    strict_variants_upper = {v.upper() for v in strict_variants}
-    
-    # Filtra eventi per questa aula
-    aula_events = []
-    for event in events:
-        event_aule = event.get('aule', [])
-        for aula in event_aule:
-            codice = aula.get('codice', '').strip()
-            descrizione = aula.get('descrizione', '').strip()
-            
-            # STRICT MATCHING: Uguaglianza esatta invece di 'in'
-            # Controlla se il codice o la descrizione (upper) sono nel set delle varianti attese
-            match_found = (codice.upper() in strict_variants_upper) or (descrizione.upper() in strict_variants_upper)
-            
-            if match_found:
-                try:
-                    # Parsing date as offset-aware (from ISO string with Z)
-                    start = datetime.fromisoformat(event['dataInizio'].replace('Z', '+00:00'))
-                    end = datetime.fromisoformat(event['dataFine'].replace('Z', '+00:00'))
-                    
-                    # Convert to Rome time
-                    start = start.astimezone(TZ_ROME)
-                    end = end.astimezone(TZ_ROME)
-                    
-                    # Estrai docenti (nome completo)
-                    docenti_list = event.get('docenti', [])
-                    # Keep original names as they appear
-                    docenti_nomi = []
-                    for d in docenti_list:
-                        if d:
-                            # Try to get the complete name or construct it
-                            nome_compl = d.get('cognomeNome')
-                            if not nome_compl:
-                                n = d.get('nome', '').strip()
-                                c = d.get('cognome', '').strip()
-                                nome_compl = f"{n} {c}".strip()
-                            
-                            if nome_compl:
-                                docenti_nomi.append(nome_compl)
-                    docenti_str = ', '.join(docenti_nomi) if docenti_nomi else ''
-                    
-                    # Verifica che l'evento sia del giorno corrente
-                    if start.date() == now.date():
-                        aula_events.append({
-                            'nome': event.get('nome', 'N/D').split('-')[0].strip(),
-                            'start': start,
-                            'end': end,
-                            'docenti': docenti_str,
-                        })
-                except Exception as e:
-                    logger.error(f"Errore parsing evento: {e}")
-                break
-    
-    # Ordina per orario
-    aula_events.sort(key=lambda x: x['start'])
-    
+        timeline = _room_timeline(e for e in events if not match_codes.isdisjoint(e.rooms))
+    ordered, starts, max_ends = timeline
+
+    # Solo gli eventi che iniziano nel giorno corrente
+    day_start, day_end = _rome_day_bounds(now.date())
+    lo = bisect.bisect_left(starts, day_start)
+    hi = bisect.bisect_left(starts, day_end, lo)
+    # idx: primo evento che inizia dopo ora; in corso è il primo tra i precedenti che finisce dopo ora
+    idx = bisect.bisect_right(starts, now, lo, hi)
+    current = bisect.bisect_left(max_ends, now, lo, idx)
+    while current < idx and ordered[current].end < now:
+        current += 1  # solo se il giorno è preceduto da eventi di altri giorni
+
+    def as_dict(event: EventRecord) -> Dict:
+        return {'nome': event.nome, 'start': event.start, 'end': event.end, 'docenti': event.docenti}
+
     # Determina stato attuale
     is_free = True
     free_until = None
     busy_until = None
     current_event = None
-    
-    for event in aula_events:
-        # Ensure now is comparable (aware vs aware)
-        if now.tzinfo is None:
-             now = now.astimezone(TZ_ROME)
-             
-        if event['start'] <= now <= event['end']:
-            is_free = False
-            busy_until = event['end']
-            current_event = event
-            break
-        elif event['start'] > now:
-            free_until = event['start']
-            break
-    
+    if current < idx:
+        is_free = False
+        busy_until = ordered[current].end
+        current_event = as_dict(ordered[current])
+    elif idx < hi:
+        free_until = ordered[idx].start
+
     # Prossimi eventi (dopo ora)
-    next_events = [e for e in aula_events if e['start'] > now]
+    next_events = [as_dict(e) for e in ordered[idx:min(hi, idx + 5)]]
     
     return {
         'is_free': is_free,
         'free_until': free_until,
         'busy_until': busy_until,
         'current_event': current_event,
-        'next_events': next_events[:5]  # Max 5 prossimi
+        'next_events': next_events  # Max 5 prossimi
     }
 
 # --- FUNZIONI AULE ---
@@ -1159,30 +2331,9 @@ def _has_live_status(room: Dict) -> bool:
     """Returns True if this room has real-time calendar status."""
     return bool(room.get('hasStatus', False))
 
-def _compute_biblio_live_status(hours_today: List[Dict], now: datetime):
-    """Returns (is_open: bool, closes_at: str|None, opens_at: str|None) from SBA hours for today."""
-    now_str = now.strftime('%H:%M')
-    times = sorted(
-        [(e['start_time'].strip(), e['end_time'].strip()) for e in hours_today
-         if e.get('start_time') and e.get('end_time')],
-        key=lambda x: x[0]
-    )
-    if not times:
-        return False, None, None
-    for start, end in times:
-        if now_str >= start and now_str < end:
-            return True, end, None
-    for start, end in times:
-        if start > now_str:
-            return False, None, start
-    return False, None, None
-
-async def _fetch_scope_biblio_hours(rooms: List[Dict], target_date: datetime) -> Dict[str, List]:
-    """Fetch SBA opening hours for biblioteca rooms (hasStatus=False) in the given list."""
-    result: Dict[str, List] = {}
+async def _fetch_scope_biblio_hours(rooms: List[Dict], target_date: datetime) -> Dict[str, LibrarySchedule]:
+    """Orari (LibrarySchedule per nid) delle biblioteche senza stato live (hasStatus=False) tra le stanze date."""
     nids: List[str] = []
-    tasks = []
-    today_iso = target_date.strftime('%Y-%m-%d')
     for room in rooms:
         rtype = room.get('type')
         types = rtype if isinstance(rtype, list) else [rtype]
@@ -1190,12 +2341,9 @@ async def _fetch_scope_biblio_hours(rooms: List[Dict], target_date: datetime) ->
             nid = str(room['nid'])
             if nid not in nids:
                 nids.append(nid)
-                tasks.append(fetch_sba_opening_hours_async(nid, target_date, target_date))
-    if tasks:
-        fetched = await asyncio.gather(*tasks, return_exceptions=True)
-        for nid, res in zip(nids, fetched):
-            result[nid] = [e for e in res if e.get('date') == today_iso] if not isinstance(res, Exception) else []
-    return result
+    if not nids:
+        return {}
+    return await get_biblio_schedules(nids, target_date, target_date)
 
 def _format_room_line(
     aula: Dict,
@@ -1220,7 +2368,7 @@ def _format_room_line(
     # ── Biblioteca ──────────────────────────────────────────────────────────
     if 'biblioteca' in types:
         if has_live:
-            status = get_aula_status(aula['nome'], events, now, polo=polo, edificio=edificio)
+            status = get_aula_status(aula['nome'], events, now, polo=polo, edificio=edificio, match_codes=aula.get('match_codes'))
             if not status['is_free']:
                 # calendar event ongoing = biblioteca OPEN
                 if status['busy_until']:
@@ -1233,7 +2381,7 @@ def _format_room_line(
                 return f"{label} - chiusa\n"
         nid = str(aula.get('nid', ''))
         if biblio_hours and nid in biblio_hours:
-            is_open, closes_at, opens_at = _compute_biblio_live_status(biblio_hours[nid], now)
+            is_open, closes_at, opens_at = biblio_hours[nid].status(now)
             if is_open:
                 suffix = f" - chiude alle {closes_at}" if closes_at else ""
                 return f"{label}{suffix}\n"
@@ -1244,7 +2392,7 @@ def _format_room_line(
 
     # ── Aula with live status (takes priority over studio tag) ───────────────
     if 'aula' in types and has_live:
-        status = get_aula_status(aula['nome'], events, now, polo=polo, edificio=edificio)
+        status = get_aula_status(aula['nome'], events, now, polo=polo, edificio=edificio, match_codes=aula.get('match_codes'))
         symbol = "✓" if status['is_free'] else "✗"
         if status['is_free']:
             if status['free_until']:
@@ -1261,6 +2409,7 @@ def _format_room_line(
 
     return f"• {label}\n"
 
+@snapshot_cached
 def get_edifici(polo: str) -> List[str]:
     """Restituisce lista degli edifici per un polo che hanno aule monitorabili."""
     data = load_unified_json()
@@ -1282,6 +2431,7 @@ def get_edifici(polo: str) -> List[str]:
     except Exception:
         return []
 
+@snapshot_cached
 def get_edificio_display_name(polo: str, edificio: str, short: bool = True) -> str:
     """Restituisce il nome da visualizzare per un edificio (es. il primo alias per ingegneria).
     Se short=True, rimuove 'Polo ' dall'alias (es. 'Polo Porta Nuova' -> 'Porta Nuova').
@@ -1394,29 +2544,51 @@ def _rendered_len(text: str) -> int:
     stripped = _MD_SYNTAX_RE.sub('', stripped)
     return len(stripped)
 
-def _safe_truncate(text: str, max_len: int = 4096) -> str:
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def _safe_truncate(text: str, max_len: int = TELEGRAM_MESSAGE_LIMIT) -> str:
     """Truncate text so its rendered (parsed) length <= max_len.
     Telegram counts message length after entity parsing, so markdown link
-    URLs don't contribute to the limit. Cuts at the last newline."""
-    if _rendered_len(text) <= max_len:
-        return text
-    # Cut line by line until rendered length fits
+    URLs don't contribute to the limit. Cuts at the last newline.
+    Single pass: each line is measured once and the text is returned as is if it fits."""
+    builder = MessageBuilder(max_len)
     lines = text.split('\n')
-    result_lines = []
-    current_rendered = 0
-    for line in lines:
-        line_rendered = _rendered_len(line + '\n')
-        if current_rendered + line_rendered > max_len:
-            break
-        result_lines.append(line)
-        current_rendered += line_rendered
-    return '\n'.join(result_lines)
+    for i, line in enumerate(lines):
+        if not builder.add(line if i == len(lines) - 1 else line + '\n'):
+            kept = builder.text()
+            return kept[:-1] if kept.endswith('\n') else kept
+    return text
+
+class MessageBuilder:
+    """Accumula pezzi di messaggio Markdown tenendo il conto incrementale della lunghezza
+    renderizzata da Telegram, senza rimisurare il testo già aggiunto."""
+
+    def __init__(self, limit: int = TELEGRAM_MESSAGE_LIMIT):
+        self.limit = limit
+        self.length = 0
+        self._parts: List[str] = []
+
+    def fits(self, rendered: int) -> bool:
+        return self.length + rendered <= self.limit
+
+    def add(self, chunk: str, rendered: Optional[int] = None) -> bool:
+        """Aggiunge chunk se ci sta nel limite; rendered evita di rimisurarlo se già noto."""
+        if rendered is None:
+            rendered = _rendered_len(chunk)
+        if not self.fits(rendered):
+            return False
+        self._parts.append(chunk)
+        self.length += rendered
+        return True
+
+    def text(self) -> str:
+        return "".join(self._parts)
 
 def _aula_link_label(aula: Dict) -> str:
     """Returns '[nome](url)' if the room has a LA MAPPA UniPi link, otherwise just 'nome'."""
-    nome = aula.get('nome', 'N/D')
-    aula_id = aula.get('id')
-    
+    return _link_label(aula.get('nome', 'N/D'), aula.get('id'))
+
+def _link_label(nome: str, aula_id: Optional[str]) -> str:
     if aula_id:
         return f"[{nome}](https://unipi.lamappa.org/{aula_id})"
         
@@ -1460,27 +2632,129 @@ def is_aula_free_in_period(
     end_time: datetime,
     polo: str = "fibonacci",
     edificio: str = None,
+    match_codes: Optional[frozenset] = None,
 ) -> bool:
-    """Return True if the aula has no events in [start_time, end_time]."""
-    status = get_aula_status(aula_nome, events, start_time, polo=polo, edificio=edificio)
-    if not status['is_free']:
-        return False
-    for ev in status['next_events']:
-        if ev['start'] < end_time:
-            return False
-    return True
+    """Return True if the aula has no events overlapping the half-open window [start_time, end_time):
+    an event ending exactly at start_time or starting exactly at end_time does not count.
+    With DayEvents the check runs on the 5-minute slot bitmaps (same convention, slot granularity);
+    an empty or inverted window checks the start instant only, as window_slot_mask does."""
+    if match_codes is None:
+        match_codes = room_match_codes(aula_nome, polo, edificio)
+    if isinstance(events, DayEvents):
+        return not events.occupancy_mask(match_codes, start_time.date()) & window_slot_mask(start_time, end_time)
+    _, starts, max_ends = _room_timeline(e for e in events if not match_codes.isdisjoint(e.rooms))
+    end_time = max(end_time, start_time + timedelta(minutes=1))
+    # Eventi che iniziano prima della fine della finestra: occupata se uno finisce dopo l'inizio
+    hi = bisect.bisect_left(starts, end_time)
+    return not hi or max_ends[hi - 1] <= start_time
+
+_free_rooms_cache: dict = {}  # (polo, giorno, slot finestra, versione eventi, snapshot aule) -> frozenset di id aula
+FREE_ROOMS_CACHE_SIZE = 256
+
+def free_rooms_in_window(polo: str, events: List[EventRecord], start_time: datetime, end_time: datetime) -> Optional[frozenset]:
+    """Id delle aule del polo libere in [start_time, end_time], calcolati con un AND di bitmap per aula
+    e messi in cache per (polo, giorno, finestra). None se gli eventi non sono indicizzati (DayEvents)."""
+    if not isinstance(events, DayEvents):
+        return None
+    day = start_time.date()
+    window = window_slot_mask(start_time, end_time)
+    key = (polo, day, window, events.version, _UNIFIED_MTIME)
+    free = _free_rooms_cache.get(key)
+    if free is None:
+        free = frozenset(
+            aula['id'] for aula in get_aule_polo(polo)
+            if not events.occupancy_mask(aula.get('match_codes') or room_match_codes(aula['nome'], polo, aula.get('edificio')), day) & window
+        )
+        if len(_free_rooms_cache) >= FREE_ROOMS_CACHE_SIZE:
+            _free_rooms_cache.pop(next(iter(_free_rooms_cache)))
+        _free_rooms_cache[key] = free
+    return free
+
+def _is_free_in_window(aula: Dict, free_ids: Optional[frozenset], events: List[EventRecord], start_time: datetime, end_time: datetime, polo: str, edificio: str) -> bool:
+    if free_ids is not None:
+        return aula.get('id') in free_ids
+    return is_aula_free_in_period(aula['nome'], events, start_time, end_time, polo=polo, edificio=edificio, match_codes=aula.get('match_codes'))
+
+
+# --- OCCUPAZIONE SETTIMANALE ---
+# Matrice aula × giorno × slot: per ogni aula una tupla di 7 bitmap giornaliere (vedi SLOT_MINUTES).
+# Costruita dalla finestra di EVENTS_RANGE_DAYS giorni già in cache e scaldata dal prefetch,
+# così la vista "settimana" si disegna dalla memoria senza chiamate a Cineca.
+
+WEEK_DAYS = 7
+HEATMAP_HOURS = (8, 20)  # colonne della heatmap, due celle (mezz'ore) per ora
+HEATMAP_CELL_SLOTS = 30 // SLOT_MINUTES
+HEATMAP_LEVELS = "·░▒▓█"  # libero -> completamente occupato
+WEEK_CACHE_SIZE = 32
+
+_week_cache: dict = {}  # (polo, primo giorno) -> (versioni eventi, snapshot aule, {id aula: 7 bitmap})
+
+async def build_week_occupancy(polo: str, start_day: date) -> Dict[str, tuple]:
+    """Bitmap di occupazione dei WEEK_DAYS giorni da start_day per ogni aula del polo.
+    Ricalcolata solo se cambia la versione degli eventi di almeno un giorno."""
+    calendar_id = get_calendar_id(polo)
+    days = [TZ_ROME.localize(datetime.combine(start_day + timedelta(days=i), datetime.min.time())) for i in range(WEEK_DAYS)]
+    day_events = await asyncio.gather(*[fetch_day_events_async(calendar_id, day) for day in days])
+    versions = tuple(getattr(events, 'version', id(events)) for events in day_events)
+    key = (polo, start_day)
+    cached = _week_cache.get(key)
+    if cached and cached[0] == versions and cached[1] == _UNIFIED_MTIME:
+        return cached[2]
+    day_events = [events if isinstance(events, DayEvents) else DayEvents(events) for events in day_events]
+    masks = {}
+    for aula in get_aule_polo(polo):
+        if not _has_live_status(aula) or not aula.get('id'):
+            continue
+        codes = aula.get('match_codes') or room_match_codes(aula['nome'], polo, aula.get('edificio'))
+        masks[aula['id']] = tuple(events.occupancy_mask(codes, day.date()) for events, day in zip(day_events, days))
+    if key not in _week_cache and len(_week_cache) >= WEEK_CACHE_SIZE:
+        _week_cache.pop(next(iter(_week_cache)))
+    _week_cache[key] = (versions, _UNIFIED_MTIME, masks)
+    return masks
+
+def _heatmap_row(masks: List[int]) -> str:
+    """Una riga della heatmap: per ogni mezz'ora la frazione di slot occupati sommata sulle aule."""
+    first_slot = HEATMAP_HOURS[0] * 60 // SLOT_MINUTES
+    cells = (HEATMAP_HOURS[1] - HEATMAP_HOURS[0]) * 60 // 30
+    cell_mask = (1 << HEATMAP_CELL_SLOTS) - 1
+    capacity = max(1, len(masks)) * HEATMAP_CELL_SLOTS
+    row = []
+    for cell in range(cells):
+        shift = first_slot + cell * HEATMAP_CELL_SLOTS
+        busy = sum(bin((mask >> shift) & cell_mask).count("1") for mask in masks)
+        row.append(HEATMAP_LEVELS[-(-busy * (len(HEATMAP_LEVELS) - 1) // capacity)])
+    return "".join(row)
+
+def format_week_heatmap(title: str, rooms: List[Dict], week: Dict[str, tuple], start_day: date) -> str:
+    """Heatmap settimanale (Markdown) per una o più aule: una riga per giorno, una cella per mezz'ora."""
+    rooms = [aula for aula in rooms if aula.get('id') in week]
+    msg = f"*{title}*\n"
+    end_day = start_day + timedelta(days=WEEK_DAYS - 1)
+    msg += f"Occupazione {start_day.strftime('%d/%m')}–{end_day.strftime('%d/%m')}"
+    msg += f" ({len(rooms)} aule)\n" if len(rooms) > 1 else "\n"
+    if not rooms:
+        return msg + "\n_Nessuna aula con calendario disponibile._\n"
+    header = "".join(f"{hour:02d}  " for hour in range(HEATMAP_HOURS[0], HEATMAP_HOURS[1], 2))
+    lines = [" " * 7 + header.rstrip()]
+    for i in range(WEEK_DAYS):
+        day = start_day + timedelta(days=i)
+        row = _heatmap_row([week[aula['id']][i] for aula in rooms])
+        lines.append(f"{WEEKDAYS_SHORT[day.weekday()]} {day.strftime('%d')} {row}")
+    msg += "```\n" + "\n".join(lines) + "\n```\n"
+    if len(rooms) > 1:
+        msg += f"_{HEATMAP_LEVELS[0]} tutte libere … {HEATMAP_LEVELS[-1]} tutte occupate (per mezz'ora)_\n"
+    else:
+        msg += f"_{HEATMAP_LEVELS[0]} libera … {HEATMAP_LEVELS[-1]} occupata (per mezz'ora)_\n"
+    return msg
 
 
 # --- FORMATTAZIONE MESSAGGI ---
 def format_aula_header(aula: Dict) -> str:
     """Formatta l'intestazione standard dell'aula (Nome, Edificio, Piano, Capienza)."""
-    nome = aula.get('nome', 'N/D')
-    edificio = aula.get('edificio', '').strip()
-    piano = aula.get('piano', '?')
-    capienza = aula.get('capienza', 'N/D')
-    polo_key = aula.get('polo', 'fibonacci')
-    polo = get_polo_display_name(polo_key)  # Usa nome display corretto (evita underscore come in "San_rossore")
-    
+    return _aula_header(aula.get('nome', 'N/D'), aula.get('edificio', '').strip(), aula.get('piano', '?'), aula.get('polo', 'fibonacci'))
+
+@snapshot_cached
+def _aula_header(nome: str, edificio: str, piano: str, polo_key: str) -> str:
     display_piano = "terra" if str(piano) == "0" else str(piano)
     
     # Rimuovi prefisso "Aula " se già presente per evitare duplicati
@@ -1577,7 +2851,7 @@ async def format_single_aula_status(aula: Dict, status: Dict, now: datetime, dov
 
 def format_edificio_status(polo: str, edificio: str, events: List[Dict], now: datetime, time_filter: Optional[Dict] = None, biblio_hours: Optional[Dict] = None) -> str:
     """Formatta lo stato di tutte le aule di un edificio."""
-    aule = get_aule_edificio(polo, edificio)
+    aule_per_piano = _aule_per_piano(polo, edificio)
     polo_display = get_polo_display_name(polo)
 
     if not edificio or edificio == '?' or edificio.lower() == polo.lower():
@@ -1593,24 +2867,17 @@ def format_edificio_status(polo: str, edificio: str, events: List[Dict], now: da
     else:
         msg += f"Stato aule alle {now.strftime('%H:%M')} del {now.strftime('%d/%m')}\n\n"
 
-    # Raggruppa per piano
-    aule_per_piano = {}
-    for aula in aule:
-        piano = aula.get('piano', '0')
-        if piano not in aule_per_piano:
-            aule_per_piano[piano] = []
-        aule_per_piano[piano].append(aula)
-
     if time_filter:
         end_time = time_filter.get('end') or now.replace(hour=23, minute=59, second=0, microsecond=0)
+        free_ids = free_rooms_in_window(polo, events, time_filter['start'], end_time)
         any_free = False
-        for piano in sorted(aule_per_piano.keys()):
+        for piano, aule in aule_per_piano.items():
             free_aule = [
-                a for a in aule_per_piano[piano]
-                if _has_live_status(a) and is_aula_free_in_period(a['nome'], events, time_filter['start'], end_time, polo=polo, edificio=edificio)
+                a for a in aule
+                if _has_live_status(a) and _is_free_in_window(a, free_ids, events, time_filter['start'], end_time, polo, edificio)
             ]
             if free_aule:
-                msg += f"*Piano {piano}:*\n"
+                msg += _piano_header(piano)
                 for a in free_aule:
                     msg += f"{_aula_link_label(a)}\n"
                     any_free = True
@@ -1619,9 +2886,9 @@ def format_edificio_status(polo: str, edificio: str, events: List[Dict], now: da
             msg += "_Nessuna aula libera per il periodo richiesto._\n"
         msg += BACK_HINT
     else:
-        for piano in sorted(aule_per_piano.keys()):
-            msg += f"*Piano {piano}:*\n"
-            for aula in aule_per_piano[piano]:
+        for piano, aule in aule_per_piano.items():
+            msg += _piano_header(piano)
+            for aula in aule:
                 msg += _format_room_line(aula, events, now, polo, edificio, biblio_hours=biblio_hours)
             msg += "\n"
         msg += TIME_FILTER_HINT
@@ -1630,8 +2897,7 @@ def format_edificio_status(polo: str, edificio: str, events: List[Dict], now: da
 
 def format_piano_status(polo: str, edificio: str, piano: str, events: List[Dict], now: datetime, time_filter: Optional[Dict] = None, biblio_hours: Optional[Dict] = None) -> str:
     """Formatta lo stato di tutte le aule di un piano."""
-    aule = get_aule_edificio(polo, edificio)
-    aule = [a for a in aule if a.get('piano') == piano]
+    aule = _aule_per_piano(polo, edificio).get(piano, [])
     polo_display = get_polo_display_name(polo)
 
     if not edificio or edificio == '?' or edificio.lower() == polo.lower():
@@ -1649,9 +2915,10 @@ def format_piano_status(polo: str, edificio: str, piano: str, events: List[Dict]
 
     if time_filter:
         end_time = time_filter.get('end') or now.replace(hour=23, minute=59, second=0, microsecond=0)
+        free_ids = free_rooms_in_window(polo, events, time_filter['start'], end_time)
         free_aule = [
             a for a in aule
-            if _has_live_status(a) and is_aula_free_in_period(a['nome'], events, time_filter['start'], end_time, polo=polo, edificio=edificio)
+            if _has_live_status(a) and _is_free_in_window(a, free_ids, events, time_filter['start'], end_time, polo, edificio)
         ]
         if free_aule:
             for a in free_aule:
@@ -1666,78 +2933,21 @@ def format_piano_status(polo: str, edificio: str, piano: str, events: List[Dict]
 
     return msg
 
-def format_polo_status(polo: str, events: List[Dict], now: datetime, time_filter: Optional[Dict] = None, biblio_hours: Optional[Dict] = None) -> str:
-    """Formatta lo stato di tutte le aule di un polo."""
-    polo_display = get_polo_display_name(polo)
-    msg = f"*{polo_display}*\n"
-
-    if time_filter:
-        if time_filter['type'] == 'from':
-            msg += f"Aule libere dalle {time_filter['start'].strftime('%H:%M')} — {now.strftime('%d/%m')}\n\n"
-        else:
-            msg += f"Aule libere {time_filter['start'].strftime('%H:%M')}–{time_filter['end'].strftime('%H:%M')} — {now.strftime('%d/%m')}\n\n"
-    else:
-        msg += f"Stato aule alle {now.strftime('%H:%M')} del {now.strftime('%d/%m')}\n\n"
-
-    edifici = get_edifici(polo)
-    any_free = False
-
-    if time_filter:
-        end_time = time_filter.get('end') or now.replace(hour=23, minute=59, second=0, microsecond=0)
-        for edificio in edifici:
-            if edificio and edificio != '?' and edificio.lower() != polo.lower() and len(edifici) > 1:
-                edificio_header = f"━━━ *{get_edificio_display_name(polo, edificio)}* ━━━\n"
-            else:
-                edificio_header = ""
-
-            aule = get_aule_edificio(polo, edificio)
-            aule_per_piano: Dict[str, List] = {}
-            for aula in aule:
-                p = aula.get('piano', '0')
-                aule_per_piano.setdefault(p, []).append(aula)
-
-            edificio_lines = ""
-            for piano in sorted(aule_per_piano.keys()):
-                piano_lines = ""
-                for aula in aule_per_piano[piano]:
-                    if _has_live_status(aula) and is_aula_free_in_period(aula['nome'], events, time_filter['start'], end_time, polo=polo, edificio=edificio):
-                        piano_lines += f"{_aula_link_label(aula)}\n"
-                        any_free = True
-                if piano_lines:
-                    edificio_lines += f"*Piano {piano}:*\n" + piano_lines + "\n"
-
-            if edificio_lines:
-                msg += edificio_header + edificio_lines
-
-        if not any_free:
-            msg += "_Nessuna aula libera per il periodo richiesto._\n"
-        msg += BACK_HINT
-    else:
-        for edificio in edifici:
-            if edificio and edificio != '?' and edificio.lower() != polo.lower() and len(edifici) > 1:
-                msg += f"━━━ *{get_edificio_display_name(polo, edificio)}* ━━━\n"
-
-            aule = get_aule_edificio(polo, edificio)
-
-            # Raggruppa per piano
-            aule_per_piano: Dict[str, List] = {}
-            for aula in aule:
-                piano = aula.get('piano', '0')
-                aule_per_piano.setdefault(piano, []).append(aula)
-
-            for piano in sorted(aule_per_piano.keys()):
-                msg += f"*Piano {piano}:*\n"
-                for aula in aule_per_piano[piano]:
-                    msg += _format_room_line(aula, events, now, polo, edificio, short=True, biblio_hours=biblio_hours)
-                msg += "\n"
-        msg += TIME_FILTER_HINT
+# Paginazione della vista polo: il piano delle pagine (quali piani in quale pagina) si calcola dalle
+# lunghezze renderizzate delle righe senza generarle, e si disegnano solo i piani della pagina richiesta.
+# Senza filtro orario lo stato di ogni riga è stimato per eccesso (_room_line_bound), quindi una pagina
+# può restare un po' sotto il limite; con il filtro le righe sono solo etichette e il conto è esatto.
+OCCUPANCY_PAGE_LIMIT = min(TELEGRAM_MESSAGE_LIMIT, int(os.environ.get("OCCUPANCY_PAGE_LIMIT", "800")))  # caratteri renderizzati per pagina
+POLO_PLAN_CACHE_SIZE = 64
+_polo_plan_cache: dict = {}  # (polo, budget, aule libere o None, snapshot aule) -> pagine di (edificio, piano, aule)
 
-    # Aggiungi link alla fine
+@snapshot_cached
+def _polo_footer(polo: str) -> str:
     polo_data = load_unified_json().get("polo", {}).get(polo, {})
     polo_id = polo_data.get("id")
     gmaps = polo_data.get("google_maps")
     amaps = polo_data.get("apple_maps")
-    
+
     footer_links = []
     if polo_id:
         footer_links.append(f"[LA MAPPA ↗](https://unipi.lamappa.org/{polo_id})")
@@ -1745,11 +2955,199 @@ def format_polo_status(polo: str, events: List[Dict], now: datetime, time_filter
         footer_links.append(f"[Google Maps ↗]({gmaps})")
     elif amaps:
         footer_links.append(f"[Apple Maps ↗]({amaps})")
-        
-    if footer_links:
-        msg += "\n\n" + " • ".join(footer_links)
 
-    return msg
+    return "\n\n" + " • ".join(footer_links) if footer_links else ""
+
+@snapshot_cached
+def _polo_edificio_header(polo: str, edificio: str) -> str:
+    """Separatore di edificio nella vista polo (vuoto se il polo ha un solo edificio)."""
+    if edificio and edificio != '?' and edificio.lower() != polo.lower() and len(get_edifici(polo)) > 1:
+        return f"━━━ *{get_edificio_display_name(polo, edificio)}* ━━━\n"
+    return ""
+
+def _piano_header(piano: str) -> str:
+    return f"*Piano {piano}:*\n"
+
+@snapshot_cached
+def _aule_per_piano(polo: str, edificio: str) -> Dict[str, List]:
+    """Aule di un edificio raggruppate per piano (piani ordinati). Condiviso: non modificare."""
+    aule_per_piano: Dict[str, List] = {}
+    for aula in get_aule_edificio(polo, edificio):
+        aule_per_piano.setdefault(aula.get('piano', '0'), []).append(aula)
+    return {piano: aule_per_piano[piano] for piano in sorted(aule_per_piano.keys())}
+
+def _room_line_bound(aula: Dict) -> int:
+    """Lunghezza renderizzata massima della riga corta di _format_room_line per l'aula:
+    etichetta esatta più il suffisso di stato più lungo possibile per il suo tipo."""
+    rtype = aula.get('type')
+    types = rtype if isinstance(rtype, list) else [rtype]
+    has_live = aula.get('hasStatus', False)
+    if 'biblioteca' in types:
+        status = " - aperta, chiude alle 00:00" if has_live else " - chiude alle 00:00"
+    elif 'aula' in types and has_live:
+        status = "✓  - fino 00:00"
+    elif 'studio' in types:
+        status = ""
+    else:
+        status = "• "
+    return _rendered_len(_aula_link_label(aula)) + len(status) + 1
+
+def _polo_page_plan(polo: str, budget: int, free_ids: Optional[frozenset] = None) -> List[List[tuple]]:
+    """Pagine della vista polo come liste di (edificio, piano, aule), entro `budget` caratteri renderizzati.
+    Con free_ids (filtro orario) restano solo le aule libere e i piani che ne hanno almeno una.
+    L'intestazione dell'edificio si ripete quando continua nella pagina successiva; un piano che da solo
+    supera il budget occupa una pagina intera (poi troncata da _safe_truncate)."""
+    key = (polo, budget, free_ids, _UNIFIED_MTIME)
+    plan = _polo_plan_cache.get(key)
+    if plan is not None:
+        return plan
+
+    plan = []
+    page: List[tuple] = []
+    used = 0
+    last_edificio = None
+    for edificio in get_edifici(polo):
+        header_len = _rendered_len(_polo_edificio_header(polo, edificio))
+        for piano, aule in _aule_per_piano(polo, edificio).items():
+            if free_ids is not None:
+                aule = [a for a in aule if _has_live_status(a) and a.get('id') in free_ids]
+                if not aule:
+                    continue
+                lines = sum(_rendered_len(_aula_link_label(a)) + 1 for a in aule)
+            else:
+                lines = sum(_room_line_bound(a) for a in aule)
+            body = _rendered_len(_piano_header(piano)) + lines + 1
+            needed = body if page and edificio == last_edificio else header_len + body
+            if page and used + needed > budget:
+                plan.append(page)
+                page, used = [], 0
+                needed = header_len + body
+            page.append((edificio, piano, aule))
+            used += needed
+            last_edificio = edificio
+    if page or not plan:
+        plan.append(page)
+
+    if len(_polo_plan_cache) >= POLO_PLAN_CACHE_SIZE:
+        _polo_plan_cache.pop(next(iter(_polo_plan_cache)))
+    _polo_plan_cache[key] = plan
+    return plan
+
+def format_polo_page(polo: str, events: List[Dict], now: datetime, time_filter: Optional[Dict] = None, biblio_hours: Optional[Dict] = None, page: int = 0, notice: str = "") -> tuple:
+    """Pagina `page` del messaggio di stato delle aule di un polo, entro OCCUPANCY_PAGE_LIMIT caratteri
+    renderizzati compresi titolo, avviso, suggerimento e link finali. Si renderizzano solo i piani della
+    pagina. Restituisce (testo, pagina effettiva, numero di pagine)."""
+    polo_display = get_polo_display_name(polo)
+    free_ids = None
+    if time_filter:
+        if time_filter['type'] == 'from':
+            subtitle = f"Aule libere dalle {time_filter['start'].strftime('%H:%M')} — {now.strftime('%d/%m')}\n\n"
+        else:
+            subtitle = f"Aule libere {time_filter['start'].strftime('%H:%M')}–{time_filter['end'].strftime('%H:%M')} — {now.strftime('%d/%m')}\n\n"
+        hint = BACK_HINT
+        end_time = time_filter.get('end') or now.replace(hour=23, minute=59, second=0, microsecond=0)
+        free_ids = free_rooms_in_window(polo, events, time_filter['start'], end_time)
+        if free_ids is None:
+            free_ids = frozenset(
+                a['id'] for a in get_aule_polo(polo)
+                if a.get('id') and _has_live_status(a)
+                and _is_free_in_window(a, None, events, time_filter['start'], end_time, polo, a.get('edificio'))
+            )
+    else:
+        subtitle = f"Stato aule alle {now.strftime('%H:%M')} del {now.strftime('%d/%m')}\n\n"
+        hint = TIME_FILTER_HINT
+    footer = _polo_footer(polo)
+
+    # Spazio fisso di ogni pagina, con l'indicatore di pagina più lungo plausibile
+    fixed = _rendered_len(f"*{polo_display}* · pagina 99/99\n" + notice + subtitle + hint + footer)
+    plan = _polo_page_plan(polo, max(1, OCCUPANCY_PAGE_LIMIT - fixed), free_ids)
+    page = min(max(page, 0), len(plan) - 1)
+
+    body = ""
+    last_edificio = None
+    for edificio, piano, aule in plan[page]:
+        if edificio != last_edificio:
+            body += _polo_edificio_header(polo, edificio)
+            last_edificio = edificio
+        body += _piano_header(piano)
+        if time_filter:
+            body += "".join(f"{_aula_link_label(a)}\n" for a in aule)
+        else:
+            body += "".join(_format_room_line(a, events, now, polo, edificio, short=True, biblio_hours=biblio_hours) for a in aule)
+        body += "\n"
+    if time_filter and not body:
+        body = "_Nessuna aula libera per il periodo richiesto._\n"
+
+    title = f"*{polo_display}*" + (f" · pagina {page + 1}/{len(plan)}" if len(plan) > 1 else "") + "\n"
+    return title + notice + subtitle + body + hint + footer, page, len(plan)
+
+def format_polo_status(polo: str, events: List[Dict], now: datetime, time_filter: Optional[Dict] = None, biblio_hours: Optional[Dict] = None, page: int = 0) -> str:
+    """Formatta lo stato delle aule di un polo (la pagina `page`, vedi format_polo_page)."""
+    return format_polo_page(polo, events, now, time_filter=time_filter, biblio_hours=biblio_hours, page=page)[0]
+
+# Cache dei messaggi di occupazione già renderizzati (testo + tastiera), LRU limitata.
+# Chiave: (ambito, pagina, giorno, minuto, offset, filtro orario, versione eventi, orari biblioteche, avviso, snapshot aule):
+# richieste identiche nello stesso minuto riusano il messaggio senza ricalcolare nulla.
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "512"))
+_render_cache: dict = {}
+
+def _time_filter_key(time_filter: Optional[Dict]) -> Optional[tuple]:
+    if not time_filter:
+        return None
+    end = time_filter.get('end')
+    return (time_filter['type'], time_filter['start'].strftime('%H:%M'), end.strftime('%H:%M') if end else None)
+
+def _biblio_hours_key(biblio_hours: Optional[Dict]) -> tuple:
+    return tuple(sorted((nid, schedule.key) for nid, schedule in (biblio_hours or {}).items()))
+
+async def render_occupancy_view(kind: str, polo: str, edificio: Optional[str], piano: Optional[str], target_date: datetime, offset: int = 0, time_filter: Optional[Dict] = None, page: int = 0) -> tuple:
+    """Testo (già troncato) e tastiera del messaggio di occupazione di un polo (pagina `page`), edificio o piano."""
+    calendar_id = get_calendar_id(polo)
+    events = await fetch_day_events_async(calendar_id, target_date)
+    biblio_hours = None
+    if kind != 'polo':
+        page = 0
+    if not time_filter:
+        all_rooms = get_aule_polo(polo) if kind == 'polo' else get_aule_edificio(polo, edificio)
+        biblio_hours = await _fetch_scope_biblio_hours(all_rooms, target_date)
+    notice = events_stale_notice(calendar_id, target_date)
+
+    version = getattr(events, 'version', None)
+    key = None
+    if version is not None or not events:
+        key = (
+            kind, polo, edificio, piano, page, target_date.strftime('%Y-%m-%d %H:%M'), offset,
+            _time_filter_key(time_filter), version, _biblio_hours_key(biblio_hours), notice, _UNIFIED_MTIME,
+        )
+        cached = _render_cache.pop(key, None)
+        if cached is not None:
+            _render_cache[key] = cached  # in coda: usata di recente
+            return cached
+
+    if kind == 'polo':
+        # L'avviso è già dentro le pagine, così conta nel limite di ognuna
+        text, page, pages = format_polo_page(polo, events, target_date, time_filter=time_filter, biblio_hours=biblio_hours, page=page, notice=notice)
+        notice = ""
+        keyboard = get_smart_back_keyboard(offset, f"status:polo:{polo}", f"status:tutti_polo:{polo}", page=page, pages=pages)
+    elif kind == 'edificio':
+        text = format_edificio_status(polo, edificio, events, target_date, time_filter=time_filter, biblio_hours=biblio_hours)
+        keyboard = get_smart_back_keyboard(
+            offset, f"status:edificio:{polo}:{edificio}", f"status:tutti_edificio:{polo}:{edificio}",
+            None if time_filter else f"status:week_edificio:{polo}:{edificio}:0",
+        )
+    else:
+        text = format_piano_status(polo, edificio, piano, events, target_date, time_filter=time_filter, biblio_hours=biblio_hours)
+        keyboard = get_smart_back_keyboard(
+            offset, f"status:piano:{polo}:{edificio}:{piano}", f"status:tutti_piano:{polo}:{edificio}:{piano}",
+            None if time_filter else f"status:week_piano:{polo}:{edificio}:{piano}:0",
+        )
+    rendered = (_safe_truncate(_with_notice(text, notice)), keyboard)
+
+    if key is not None:
+        if len(_render_cache) >= RENDER_CACHE_SIZE:
+            _render_cache.pop(next(iter(_render_cache)))
+        _render_cache[key] = rendered
+    return rendered
 
 async def format_day_schedule(aula: Dict, events: List[Dict], target_date: datetime, show_title: bool = True) -> str:
     """Formatta il programma di una giornata specifica."""
@@ -1763,7 +3161,7 @@ async def format_day_schedule(aula: Dict, events: List[Dict], target_date: datet
     
     # Recupera eventi del giorno
     start_of_day = target_date.replace(hour=0, minute=0, second=0)
-    status_day = get_aula_status(aula['nome'], events, start_of_day, polo=aula.get('polo', 'fibonacci'), edificio=aula.get('edificio'))
+    status_day = get_aula_status(aula['nome'], events, start_of_day, polo=aula.get('polo', 'fibonacci'), edificio=aula.get('edificio'), match_codes=aula.get('match_codes'))
     
     
     if not status_day['next_events'] and not status_day['current_event']:
@@ -1816,10 +3214,70 @@ async def self_ping(context: ContextTypes.DEFAULT_TYPE):
     url = os.environ.get("RENDER_EXTERNAL_URL")
     if url:
         try:
-            await asyncio.to_thread(requests.get, url, timeout=5)
+            await upstream.request("GET", url, timeout=5, retries=0)
         except Exception:
             pass
 
+# --- PREFETCH ---
+def _next_prefetch_delay(now: datetime) -> int:
+    """Secondi fino al prossimo prefetch, senza saltare l'inizio della fascia delle lezioni."""
+    delay = _prefetch_interval(now)
+    if delay == PREFETCH_INTERVAL_LECTURES:
+        return delay
+    for days_ahead in range(8):
+        day = now + timedelta(days=days_ahead)
+        if day.weekday() == 6:
+            continue
+        window_start = day.replace(hour=PREFETCH_LECTURE_HOURS[0], minute=0, second=0, microsecond=0)
+        if window_start > now:
+            return max(1, min(delay, int((window_start - now).total_seconds())))
+    return delay
+
+@with_upstream_priority(PRIORITY_PREFETCH)
+async def prefetch_job(context: ContextTypes.DEFAULT_TYPE):
+    """Tiene calde in cache le occupazioni di oggi e domani di tutti i poli e le heatmap settimanali.
+    Gli orari delle biblioteche sono aggiornati da biblio_timetable_job."""
+    global _prefetch_active
+    now = datetime.now(TZ_ROME)
+    days = [now, now + timedelta(days=1)]
+    started = time.perf_counter()
+    try:
+        calendar_ids = []
+        for polo in get_polos():
+            cid = get_calendar_id(polo)
+            for c in (cid if isinstance(cid, list) else [cid]):
+                if c and c not in calendar_ids:
+                    calendar_ids.append(c)
+        tasks = []
+        for day in days:
+            tasks.extend(fetch_day_events_async(cid, day, refresh=True) for cid in calendar_ids)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Heatmap settimanali: gli eventi della finestra sono già in cache, qui si calcolano solo le bitmap
+        await asyncio.gather(*[build_week_occupancy(polo, now.date()) for polo in get_polos()], return_exceptions=True)
+        _prefetch_active = True
+        logger.info(f"Prefetch: {len(calendar_ids)} calendari aggiornati in {time.perf_counter() - started:.1f}s")
+    except Exception as e:
+        logger.error(f"Errore prefetch: {e}")
+    finally:
+        context.job_queue.run_once(prefetch_job, when=_next_prefetch_delay(datetime.now(TZ_ROME)), name="prefetch")
+
+@with_upstream_priority(PRIORITY_PREFETCH)
+async def biblio_timetable_job(context: ContextTypes.DEFAULT_TYPE):
+    """Aggiorna la tabella in memoria degli orari di tutte le biblioteche."""
+    started = time.perf_counter()
+    try:
+        count = await refresh_biblio_timetable()
+        logger.info(f"Orari biblioteche: {count} biblioteche aggiornate in {time.perf_counter() - started:.1f}s")
+    except Exception as e:
+        logger.error(f"Errore aggiornamento orari biblioteche: {e}")
+
+async def upstream_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    """Logga le metriche di coda dello scheduler upstream e l'hit rate della cache SBA dall'ultimo intervallo."""
+    upstream.log_stats()
+    line = sba_cache.summary()
+    if line:
+        logger.info(line)
+
 # --- FEEDBACK TEXT ---
 FEEDBACK_TEXT = (
     "\n\n<b>Feedback e Supporto</b>\n"
@@ -1899,6 +3357,386 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         disable_web_page_preview=True 
     )
 
+# --- AULE LIBERE (/libere) ---
+# Ricerca di aule libere per durata, posti e luogo su uno o più poli, risolta sulle bitmap
+# di occupazione in cache: a cache calda non fa chiamate upstream.
+LIBERE_DEFAULT_MINUTES = int(os.environ.get("LIBERE_DEFAULT_MINUTES", "60"))
+LIBERE_MAX_RESULTS = int(os.environ.get("LIBERE_MAX_RESULTS", "15"))
+LIBERE_LATENCY_BUDGET = float(os.environ.get("LIBERE_LATENCY_BUDGET", "2.5"))  # secondi
+LIBERE_NEAR_KM = float(os.environ.get("LIBERE_NEAR_KM", "1.0"))  # poli vicini inclusi dopo quelli richiesti
+LIBERE_MAX_DAYS_AHEAD = int(os.environ.get("LIBERE_MAX_DAYS_AHEAD", "28"))
+
+_LIBERE_RE_HOURS = re.compile(r'^(\d{1,2})h(\d{1,2})?$')
+_LIBERE_RE_MINUTES = re.compile(r'^(\d{1,3})(?:m|min)$')
+_LIBERE_RE_SEATS = re.compile(r'^(\d{1,4})(p|posti)?$')
+_LIBERE_RE_RANGE = re.compile(r'^(\d{1,2})(?:[:.](\d{2}))?[-\u2013](\d{1,2})(?:[:.](\d{2}))?$')
+_LIBERE_RE_TIME = re.compile(r'^(\d{1,2})[:.](\d{2})$')
+_LIBERE_RE_DATE = re.compile(r'^(\d{1,2})/(\d{1,2})$')
+_LIBERE_FILLER = {'libere', 'libera', 'aule', 'aula', 'posti', 'per', 'da', 'dalle', 'alle', 'almeno', 'a', 'al', 'il', 'vicino', 'ore'}
+_LIBERE_DAY_WORDS = {'oggi': 0, 'domani': 1, 'dopodomani': 2}
+# Servizi richiedibili (campo "servizi" di aule2.geojson): parola chiave -> (descrizione, valori che la soddisfano)
+_LIBERE_SERVICES = {
+    'proiettore': ('proiettore', {'Proiettore video'}),
+    'accessibile': ('accessibile', {'Accessibile a disabili', 'Accesso disabili'}),
+    'rete': ('rete', {'Rete'}),
+    'wifi': ('wifi', {'Wifi'}),
+    'audio': ('audio', {'Amplificazione audio'}),
+    'telecamera': ('telecamera', {'Telecamera fissa'}),
+    'laboratorio': ('laboratorio', {'Laboratorio'}),
+}
+_LIBERE_SERVICES.update({
+    'proiettori': _LIBERE_SERVICES['proiettore'], 'disabili': _LIBERE_SERVICES['accessibile'],
+    'accessibili': _LIBERE_SERVICES['accessibile'], 'microfono': _LIBERE_SERVICES['audio'],
+    'lab': _LIBERE_SERVICES['laboratorio'],
+})
+_LIBERE_WEEKDAYS = {
+    name: i
+    for i, names in enumerate([
+        ('lun', 'lunedi', 'lunedì'), ('mar', 'martedi', 'martedì'), ('mer', 'mercoledi', 'mercoledì'),
+        ('gio', 'giovedi', 'giovedì'), ('ven', 'venerdi', 'venerdì'), ('sab', 'sabato'), ('dom', 'domenica'),
+    ])
+    for name in names
+}
+
+def _distance_km(a: Optional[tuple], b: Optional[tuple]) -> Optional[float]:
+    if not a or not b:
+        return None
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(h))
+
+def resolve_poli(token: str) -> List[str]:
+    """Poli indicati da un token (es. "fib", "+ing", "sapienza"); lista vuota se non riconosciuto."""
+    token = token.lstrip('+').strip().lower()
+    if len(token) < 2:
+        return []
+    norm = parse_query_modifiers(f"+{token}")['polo_filter'] or token
+    data = load_unified_json().get("polo", {})
+    matches = []
+    for polo_key in get_polos():
+        names = [polo_key] + [n.lower() for n in data.get(polo_key, {}).get('alternative_names', []) if n]
+        if polo_key == norm or polo_key.startswith(norm + "_") or (len(norm) >= 3 and any(n.startswith(norm) for n in names)):
+            matches.append(polo_key)
+    return matches
+
+def _libere_day_offset(token: str, today: date) -> Optional[int]:
+    """Giorni da oggi per "domani", "giovedì", "23/10"; None se il token non è un giorno."""
+    if token in _LIBERE_DAY_WORDS:
+        return _LIBERE_DAY_WORDS[token]
+    if token in _LIBERE_WEEKDAYS:
+        return (_LIBERE_WEEKDAYS[token] - today.weekday()) % 7
+    m = _LIBERE_RE_DATE.match(token)
+    if m:
+        try:
+            day = date(today.year, int(m.group(2)), int(m.group(1)))
+        except ValueError:
+            return None
+        if day < today:
+            day = day.replace(year=today.year + 1)
+        return (day - today).days
+    return None
+
+def _libere_minute(hour: str, minute: Optional[str]) -> Optional[int]:
+    hour, minute = int(hour), int(minute or 0)
+    if hour > 24 or minute > 59 or hour * 60 + minute > 24 * 60:
+        return None
+    return hour * 60 + minute
+
+def _libere_set_time(query: Dict, minute: int) -> bool:
+    """Registra un orario singolo: il primo è l'inizio, il secondo dopo un inizio senza fine è la fine
+    ("dalle 9 alle 11"). False se non è utilizzabile (non successivo all'inizio o fascia già completa)."""
+    start, end = query['start_minute'], query['end_minute']
+    if start is None:
+        query['start_minute'] = minute
+        return True
+    if end is None and minute > start:
+        query['end_minute'] = minute
+        return True
+    return False
+
+def parse_libere_query(text: str, now: Optional[datetime] = None) -> Dict:
+    """Interpreta "2h 50 fib", "90m 30 posti sapienza", "domani 14-16 +fib", "giovedì 9:30 2h +ing proiettore":
+    durata, posti minimi, poli, servizi richiesti, giorno e fascia oraria (start/end in minuti dalla mezzanotte).
+    Un numero da solo tra 0 e 23 è un'ora ("9" = dalle 9:00), un secondo orario ne è la fine ("dalle 9 alle 11");
+    i posti sotto 24 vanno indicati con "20p" o "20 posti". Senza giorno esplicito un orario già passato oggi si riferisce a domani; una fascia in corso
+    parte da adesso; con "oggi" una fascia già finita viene ignorata."""
+    now = now or datetime.now(TZ_ROME)
+    today = now.date()
+    query = {'minutes': LIBERE_DEFAULT_MINUTES, 'min_seats': 0, 'poli': [], 'services': [], 'unknown': [],
+             'past': [], 'day_offset': 0, 'start_minute': None, 'end_minute': None}
+    explicit_day = False
+    time_token = None
+    tokens = text.lower().split()
+    for index, token in enumerate(tokens):
+        if token in _LIBERE_SERVICES:
+            if _LIBERE_SERVICES[token] not in query['services']:
+                query['services'].append(_LIBERE_SERVICES[token])
+            continue
+        day_offset = _libere_day_offset(token, today)
+        if day_offset is not None:
+            if day_offset <= LIBERE_MAX_DAYS_AHEAD:
+                query['day_offset'] = day_offset
+                explicit_day = True
+            else:
+                query['unknown'].append(token)
+            continue
+        m = _LIBERE_RE_RANGE.match(token)
+        if m:
+            start, end = _libere_minute(m.group(1), m.group(2)), _libere_minute(m.group(3), m.group(4))
+            if start is not None and end is not None and end > start:
+                query['start_minute'], query['end_minute'] = start, end
+                time_token = token
+            else:
+                query['unknown'].append(token)
+            continue
+        m = _LIBERE_RE_TIME.match(token)
+        if m:
+            minute = _libere_minute(m.group(1), m.group(2))
+            if minute is not None and minute < 24 * 60 and _libere_set_time(query, minute):
+                time_token = f"{time_token}-{token}" if query['end_minute'] is not None else token
+            else:
+                query['unknown'].append(token)
+            continue
+        m = _LIBERE_RE_HOURS.match(token)
+        if m:
+            query['minutes'] = int(m.group(1)) * 60 + int(m.group(2) or 0)
+            continue
+        m = _LIBERE_RE_MINUTES.match(token)
+        if m:
+            query['minutes'] = int(m.group(1))
+            continue
+        m = _LIBERE_RE_SEATS.match(token)
+        if m:
+            value = int(m.group(1))
+            seats_marker = m.group(2) or (index + 1 < len(tokens) and tokens[index + 1] == 'posti')
+            if value < 24 and not seats_marker:
+                if _libere_set_time(query, value * 60):
+                    time_token = f"{time_token}-{token}" if query['end_minute'] is not None else token
+                else:
+                    query['unknown'].append(token)
+            else:
+                query['min_seats'] = value
+            continue
+        if token in _LIBERE_FILLER:
+            continue
+        poli = resolve_poli(token)
+        if poli:
+            query['poli'].extend(p for p in poli if p not in query['poli'])
+        else:
+            query['unknown'].append(token)
+
+    # Orari già passati di oggi
+    now_minute = _minute_of_day(now)
+    start, end = query['start_minute'], query['end_minute']
+    if query['day_offset'] == 0 and start is not None and start < now_minute:
+        if not explicit_day and (end is None or end <= now_minute):
+            query['day_offset'] = 1
+        elif end is not None and end <= now_minute:
+            query['past'].append(time_token)
+            query['start_minute'] = query['end_minute'] = None
+        else:
+            query['start_minute'] = None if end is None else now_minute
+    if query['end_minute'] is not None:
+        query['minutes'] = query['end_minute'] - query['start_minute']
+    query['minutes'] = max(SLOT_MINUTES, query['minutes'])
+    return query
+
+def libere_window(query: Dict, now: datetime) -> tuple:
+    """(giorno, minuto di inizio) della ricerca: da adesso se il giorno è oggi, altrimenti
+    dall'inizio della fascia delle lezioni, salvo orario esplicito."""
+    day = now.date() + timedelta(days=query.get('day_offset', 0))
+    start_minute = query.get('start_minute')
+    if start_minute is None:
+        start_minute = _minute_of_day(now) if day == now.date() else HEATMAP_HOURS[0] * 60
+    return day, start_minute
+
+def _libere_candidate_poli(requested: List[str]) -> Dict[str, float]:
+    """polo -> distanza in km dai poli richiesti (0 per quelli richiesti); tutti i poli se nessuno è indicato."""
+    if not requested:
+        return {polo: 0.0 for polo in get_polos()}
+    data = load_unified_json().get("polo", {})
+    distances = {polo: 0.0 for polo in requested}
+    for polo in get_polos():
+        if polo in distances:
+            continue
+        nearest = [d for d in (_distance_km(data.get(polo, {}).get('center'), data.get(r, {}).get('center')) for r in requested) if d is not None]
+        if nearest and min(nearest) <= LIBERE_NEAR_KM:
+            distances[polo] = min(nearest)
+    return distances
+
+async def find_free_rooms(query: Dict, now: datetime) -> tuple:
+    """Aule libere nel giorno e dall'orario della query (vedi libere_window) per almeno query['minutes'],
+    con almeno query['min_seats'] posti e i servizi richiesti, ordinate per luogo, durata libera e capienza.
+    Le bitmap vengono dalla matrice settimanale del polo: al più una chiamata Cineca per calendario
+    e settimana. Per una ricerca da adesso lo stato attuale è quello esatto di get_aula_status (lo slot
+    corrente è occupato anche da un evento che inizia tra qualche minuto).
+    Ritorna (risultati, poli non arrivati entro il budget di latenza o senza calendario per il giorno)."""
+    distances = _libere_candidate_poli(query['poli'])
+    day, start_minute = libere_window(query, now)
+    week_index, day_index = divmod((day - now.date()).days, WEEK_DAYS)
+    week_start = now.date() + timedelta(days=week_index * WEEK_DAYS)
+    tasks = {polo: asyncio.ensure_future(build_week_occupancy(polo, week_start)) for polo in distances}
+    # I poli che non rispondono entro il budget vengono saltati; il fetch prosegue e scalda la cache
+    await asyncio.wait(tasks.values(), timeout=LIBERE_LATENCY_BUDGET)
+    # Senza dati del giorno (Cineca irraggiungibile e nessun dato precedente) le bitmap sono vuote:
+    # il polo va segnalato, non mostrato con tutte le aule libere
+    missing = [
+        polo for polo, task in tasks.items()
+        if not task.done() or task.exception() or not events_available(get_calendar_id(polo), day)
+    ]
+
+    start_slot = start_minute // SLOT_MINUTES
+    from_now = day == now.date() and query.get('start_minute') is None
+    services = query.get('services') or []
+    results = []
+    for polo, distance in distances.items():
+        if polo in missing:
+            continue
+        week = tasks[polo].result()
+        # Stessa chiave della matrice settimanale: il giorno è già in cache
+        today_events = await fetch_day_events_async(get_calendar_id(polo), now) if from_now else None
+        for aula in get_aule_polo(polo):
+            if aula.get('id') not in week:
+                continue  # senza calendario
+            capienza = aula.get('capienza') or 0
+            if capienza < query['min_seats']:
+                continue
+            if services and not all(accepted.intersection(aula.get('servizi') or ()) for _, accepted in services):
+                continue
+            if from_now:
+                status = get_aula_status(aula['nome'], today_events, now, polo=polo, edificio=aula.get('edificio'), match_codes=aula.get('match_codes'))
+                if not status['is_free']:
+                    continue
+                free_until = status['free_until']
+                free_until_minute = _minute_of_day(free_until) if free_until else 24 * 60
+            else:
+                rest = week[aula['id']][day_index] >> start_slot
+                if rest & 1:
+                    continue  # occupata all'inizio della finestra
+                if rest:
+                    free_until_minute = (start_slot + (rest & -rest).bit_length() - 1) * SLOT_MINUTES
+                else:
+                    free_until_minute = 24 * 60
+            free_minutes = free_until_minute - start_minute
+            if free_minutes < query['minutes']:
+                continue
+            results.append({
+                'aula': aula,
+                'polo': polo,
+                'distance': distance,
+                'free_minutes': free_minutes,
+                'free_until': None if free_until_minute >= 24 * 60 else f"{free_until_minute // 60:02d}:{free_until_minute % 60:02d}",
+            })
+    results.sort(key=lambda r: (r['distance'], -r['free_minutes'], -(r['aula'].get('capienza') or 0), r['aula'].get('nome', '')))
+    for task in tasks.values():
+        if task.done() and not task.cancelled():
+            task.exception()  # già loggata nel fetch, evita il warning "never retrieved"
+    return results, missing
+
+def _format_minutes(minutes: int) -> str:
+    hours, mins = divmod(minutes, 60)
+    if not hours:
+        return f"{mins}min"
+    return f"{hours}h{mins:02d}" if mins else f"{hours}h"
+
+def _libere_room_line(result: Dict) -> str:
+    aula = result['aula']
+    parts = [_aula_link_label(aula)]
+    if aula.get('capienza'):
+        parts.append(f"{aula['capienza']} posti")
+    parts.append(f"fino alle {result['free_until']}" if result['free_until'] else "fino a fine giornata")
+    return " · ".join(parts)
+
+def _libere_when(query: Dict, now: datetime) -> str:
+    """Descrizione della finestra: "Dalle 11:07 del 19/10", "GIO 22/10, 14:00–16:00"."""
+    day, start_minute = libere_window(query, now)
+    start = f"{start_minute // 60:02d}:{start_minute % 60:02d}"
+    if query.get('end_minute') is not None:
+        end = f"{query['end_minute'] // 60:02d}:{query['end_minute'] % 60:02d}"
+        return f"{WEEKDAYS_SHORT[day.weekday()]} {day.strftime('%d/%m')}, {start}–{end}"
+    return f"Dalle {start} di {WEEKDAYS_SHORT[day.weekday()]} {day.strftime('%d/%m')}"
+
+def format_libere_results(query: Dict, results: List[Dict], missing: List[str], now: datetime) -> str:
+    """Messaggio (Markdown) con le aule libere raggruppate per polo nell'ordine del ranking."""
+    criteria = [] if query.get('end_minute') is not None else [f"per almeno {_format_minutes(query['minutes'])}"]
+    if query['min_seats']:
+        criteria.append(f"con almeno {query['min_seats']} posti")
+    if query.get('services'):
+        criteria.append("con " + ", ".join(label for label, _ in query['services']))
+    msg = f"*Aule libere* {' '.join(criteria)}".rstrip() + "\n"
+    msg += f"{_libere_when(query, now)}\n\n"
+
+    if not results:
+        msg += "_Nessuna aula libera con questi criteri._\n" if not missing else "_Nessuna aula libera tra i poli verificati._\n"
+    current_polo = None
+    for result in results[:LIBERE_MAX_RESULTS]:
+        if result['polo'] != current_polo:
+            if current_polo is not None:
+                msg += "\n"
+            current_polo = result['polo']
+            suffix = f" ({result['distance']:.1f} km)" if result['distance'] else ""
+            msg += f"*{get_polo_display_name(current_polo)}*{suffix}\n"
+        msg += f"{_libere_room_line(result)}\n"
+    if len(results) > LIBERE_MAX_RESULTS:
+        msg += f"\n_…e altre {len(results) - LIBERE_MAX_RESULTS} aule._\n"
+    if missing:
+        msg += f"\n_⚠ Calendario non raggiungibile, aule non verificate: {', '.join(get_polo_display_name(p) for p in missing)}._\n"
+    day, _ = libere_window(query, now)
+    stale = [
+        notice for notice in dict.fromkeys(
+            events_stale_notice(get_calendar_id(polo), day) for polo in dict.fromkeys(r['polo'] for r in results)
+        ) if notice
+    ]
+    if stale:
+        msg += "\n" + "".join(stale)
+    if query.get('past'):
+        msg += f"\n_Fascia oraria già passata oggi, ignorata: {', '.join(query['past'])}._\n"
+    if query['unknown']:
+        msg += f"\n_Ignorati: {', '.join(query['unknown'])}._\n"
+    return msg
+
+async def libere_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /libere [giorno] [orario] [durata] [posti] [poli] - aule libere ordinate per luogo, durata e capienza."""
+    now = datetime.now(TZ_ROME)
+    query = parse_libere_query(" ".join(context.args or []), now)
+    results, missing = await find_free_rooms(query, now)
+    await update.message.reply_text(
+        format_libere_results(query, results, missing, now),
+        parse_mode=ParseMode.MARKDOWN,
+        disable_web_page_preview=True
+    )
+
+async def search_libere_inline(text: str) -> list:
+    """Risultati inline per "libere ...": il riepilogo completo seguito dalle singole aule."""
+    now = datetime.now(TZ_ROME)
+    query = parse_libere_query(text, now)
+    results, missing = await find_free_rooms(query, now)
+    summary = format_libere_results(query, results, missing, now)
+    articles = [
+        InlineQueryResultArticle(
+            id=f"libere_{uuid.uuid4().hex[:8]}",
+            title=f"Aule libere per {_format_minutes(query['minutes'])}" + (f", {query['min_seats']}+ posti" if query['min_seats'] else ""),
+            description=f"{_libere_when(query, now)} • {len(results)} aule trovate" + (f" • {get_polo_display_name(results[0]['polo'])}" if results else "")
+            + (f" • ⚠ {len(missing)} poli non verificati" if missing else ""),
+            input_message_content=InputTextMessageContent(summary, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True),
+        )
+    ]
+    for result in results[:9]:
+        aula = result['aula']
+        articles.append(
+            InlineQueryResultArticle(
+                id=f"libere_{aula.get('id') or uuid.uuid4().hex[:8]}",
+                title=f"{aula.get('nome', 'N/D')} • {get_polo_display_name(result['polo'])}",
+                description=(f"{aula['capienza']} posti • " if aula.get('capienza') else "") + (f"libera fino alle {result['free_until']}" if result['free_until'] else "libera fino a fine giornata"),
+                input_message_content=InputTextMessageContent(
+                    format_aula_header(aula) + f"\n{_libere_when(query, now)}: libera {'fino alle ' + result['free_until'] if result['free_until'] else 'fino a fine giornata'}",
+                    parse_mode=ParseMode.MARKDOWN,
+                    disable_web_page_preview=True,
+                ),
+            )
+        )
+    return articles
+
 async def occupazione_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando /occupazione - mostra menu selezione polo."""
     text = "<b>Stato Aule</b>\n\nSeleziona un polo:"
@@ -1938,6 +3776,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/start - Avvia il bot e mostra il benvenuto\n"
         "/biblioteche - Lista biblioteche e orari\n"
         "/occupazione - Mostra lo stato delle aule navigando per edifici\n"
+        "/libere - Cerca aule libere per giorno, orario, durata, posti e polo (es. <code>/libere 2h 50 fib</code>, <code>/libere domani 14-16 +fib proiettore</code>)\n"
         "/links - Link utili (GitHub, Sito, Social)\n"
         "/help - Mostra questo messaggio\n\n"
         "<b>Tasti Polo</b>\n"
@@ -1979,7 +3818,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "<b>Pulsanti e Navigazione</b>\n"
         "<b>○</b>: Indietro / Menu Superiore\n"
         "<b>↺</b>: Aggiorna dati correnti\n"
-        "<b>◀ ▶</b>: Cambia pagina o giorno\n\n"
+        "<b>◀ ▶</b>: Cambia pagina o giorno\n"
+        "<b>« »</b>: Pagina precedente / successiva dei poli più grandi\n\n"
         "I pulsanti si trovano sempre nella stessa posizione (es. 'Indietro' è sempre al centro, 'Aggiorna' sempre a destra).\n\n"
         "<b>Colori</b>\n"
         "I colori degli edifici e dello stato delle aule corrispondono esattamente a quelli visibili su LA MAPPA UniPi, per un'esperienza visiva coerente." +
@@ -1994,7 +3834,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 def get_occupazione_aula_keyboard(aula_id: str, offset: int, parent_callback: str = None) -> InlineKeyboardMarkup:
-    """Crea la tastiera per navigare tra i giorni (versione /occupazione: avanti/indietro + smart back)."""
+    """Crea la tastiera per navigare tra i giorni (versione /occupazione: avanti/indietro + smart back + settimana)."""
     row = []
     
     # Left Button: Back (Day - 1) solo se non siamo già ad oggi
@@ -2019,7 +3859,7 @@ def get_occupazione_aula_keyboard(aula_id: str, offset: int, parent_callback: st
     
     # Bottone Aggiorna (solo simbolo) su riga separata, allineato a destra
     row_refresh = [
-        InlineKeyboardButton(" ", callback_data="status:noop"),
+        InlineKeyboardButton("SETTIMANA", callback_data=f"status:week_aula:{aula_id}:0"),
         InlineKeyboardButton(" ", callback_data="status:noop"),
         InlineKeyboardButton("↺", callback_data=f"status:day_offset:{aula_id}:{offset}")
     ]
@@ -2049,41 +3889,142 @@ def get_day_navigation_keyboard(aula_id: str, offset: int) -> InlineKeyboardMark
     
     return InlineKeyboardMarkup([row, row_refresh])
 
-def get_smart_back_keyboard(offset: int, parent_callback: str, current_callback_base: str) -> InlineKeyboardMarkup:
-    """Crea la tastiera per navigazione 'Tutti' (avanti/indietro, back smart)."""
+def get_smart_back_keyboard(offset: int, parent_callback: str, current_callback_base: str, week_callback: Optional[str] = None, page: int = 0, pages: int = 1) -> InlineKeyboardMarkup:
+    """Crea la tastiera per navigazione 'Tutti' (avanti/indietro, back smart). Con week_callback aggiunge SETTIMANA,
+    con più pagine una riga « n/N » (la pagina resta nel callback: <base>:<offset>:<pagina>)."""
+    suffix = f":{page}" if pages > 1 else ""
     row_nav = []
     
     # Left: Back (Day - 1) solo se non siamo già ad oggi
     if offset > 0:
-        row_nav.append(InlineKeyboardButton("◀", callback_data=f"{current_callback_base}:{offset-1}"))
+        row_nav.append(InlineKeyboardButton("◀", callback_data=f"{current_callback_base}:{offset-1}{suffix}"))
     else:
         row_nav.append(InlineKeyboardButton(" ", callback_data="status:noop"))
     
     # Smart Circle Button (Middle)
     if offset > 0:
         # Back to Today
-        row_nav.append(InlineKeyboardButton("○", callback_data=f"{current_callback_base}:0"))
+        row_nav.append(InlineKeyboardButton("○", callback_data=f"{current_callback_base}:0{suffix}"))
     else:
         # Back to Parent
         row_nav.append(InlineKeyboardButton("○", callback_data=parent_callback))
     
     # Forward Button (Next Day)
-    row_nav.append(InlineKeyboardButton("▶", callback_data=f"{current_callback_base}:{offset+1}"))
+    row_nav.append(InlineKeyboardButton("▶", callback_data=f"{current_callback_base}:{offset+1}{suffix}"))
     
     row_refresh = [
+        InlineKeyboardButton("SETTIMANA", callback_data=week_callback) if week_callback else InlineKeyboardButton(" ", callback_data="status:noop"),
         InlineKeyboardButton(" ", callback_data="status:noop"),
-        InlineKeyboardButton(" ", callback_data="status:noop"),
-        InlineKeyboardButton("↺", callback_data=f"{current_callback_base}:{offset}")
+        InlineKeyboardButton("↺", callback_data=f"{current_callback_base}:{offset}{suffix}")
     ]
 
-    return InlineKeyboardMarkup([row_nav, row_refresh])
+    if pages <= 1:
+        return InlineKeyboardMarkup([row_nav, row_refresh])
+
+    row_pages = [
+        InlineKeyboardButton("«", callback_data=f"{current_callback_base}:{offset}:{page-1}") if page > 0 else InlineKeyboardButton(" ", callback_data="status:noop"),
+        InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="status:noop"),
+        InlineKeyboardButton("»", callback_data=f"{current_callback_base}:{offset}:{page+1}") if page < pages - 1 else InlineKeyboardButton(" ", callback_data="status:noop"),
+    ]
+    return InlineKeyboardMarkup([row_nav, row_pages, row_refresh])
+
+
+# --- EDIT SENZA MODIFICHE ---
+# Impronta compatta (8 byte) dell'ultimo testo + tastiera inviati per ogni messaggio: un ↺ o una
+# navigazione che non cambierebbe nulla riceve un toast, senza chiamare edit_message_text.
+MESSAGE_DIGEST_CACHE_SIZE = int(os.environ.get("MESSAGE_DIGEST_CACHE_SIZE", "4096"))
+_message_digests: dict = {}  # "chat_id:message_id" o inline_message_id -> impronta
+_answered_callbacks: set = set()  # id dei callback già risposti (Telegram accetta una sola risposta)
+
+def _message_digest(text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> bytes:
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8)
+    if reply_markup is not None:
+        for row in reply_markup.inline_keyboard:
+            for button in row:
+                digest.update(f"\x1f{button.text}\x1e{button.callback_data or button.url or ''}".encode('utf-8'))
+            digest.update(b"\x1d")
+    return digest.digest()
+
+def _callback_message_key(query) -> str:
+    if query.inline_message_id:
+        return query.inline_message_id
+    return f"{query.message.chat_id}:{query.message.message_id}"
+
+def remember_message(key: str, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+    """Registra il contenuto appena inviato o modificato di un messaggio."""
+    _message_digests.pop(key, None)
+    if len(_message_digests) >= MESSAGE_DIGEST_CACHE_SIZE:
+        _message_digests.pop(next(iter(_message_digests)))
+    _message_digests[key] = _message_digest(text, reply_markup)
+
+async def answer_callback(query, text: Optional[str] = None, show_alert: bool = False):
+    """Risponde al callback una sola volta: le risposte successive sono ignorate."""
+    if query.id in _answered_callbacks:
+        return
+    _answered_callbacks.add(query.id)
+    await query.answer(text, show_alert=show_alert)
+
+async def edit_if_changed(query, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, **kwargs) -> bool:
+    """Modifica il messaggio del callback solo se testo o tastiera cambiano rispetto all'ultimo invio,
+    altrimenti risponde con un toast. Ritorna True se il messaggio è stato modificato."""
+    key = _callback_message_key(query)
+    if _message_digests.get(key) == _message_digest(text, reply_markup):
+        await answer_callback(query, "Già aggiornato!")
+        return False
+    try:
+        await query.edit_message_text(text=text, reply_markup=reply_markup, **kwargs)
+    except BadRequest as e:
+        # Messaggio non ancora registrato (es. inviato prima di un riavvio) e già identico
+        if "Message is not modified" not in str(e):
+            raise
+        await answer_callback(query, "Già aggiornato!")
+        remember_message(key, text, reply_markup)
+        return False
+    remember_message(key, text, reply_markup)
+    return True
 
 
 # --- CALLBACK HANDLER ---
+# Un ↺ aspetta al più questo tempo il render per poter mostrare "Già aggiornato!"; oltre, la rotellina
+# si ferma comunque e un eventuale render identico resta senza toast.
+REFRESH_TOAST_GRACE = float(os.environ.get("REFRESH_TOAST_GRACE", "0.5"))
+
+def _is_refresh_press(query) -> bool:
+    """True se il bottone premuto è il ↺ del messaggio (o un messaggio inline, di cui non si vede la tastiera)."""
+    if query.message is None or query.message.reply_markup is None:
+        return query.inline_message_id is not None
+    return any(
+        button.text == "↺" and button.callback_data == query.data
+        for row in query.message.reply_markup.inline_keyboard for button in row
+    )
+
+async def _answer_after(query, delay: float):
+    await asyncio.sleep(delay)
+    await asyncio.shield(answer_callback(query))  # una risposta già partita non va interrotta
+
 async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Gestisce tutti i callback del menu /status."""
+    """Gestisce tutti i callback del menu /status. Il callback riceve risposta subito, così la rotellina
+    non aspetta i fetch; solo il ↺ rimanda la risposta (al più REFRESH_TOAST_GRACE) per poter
+    rispondere "Già aggiornato!" quando il contenuto non cambia."""
+    query = update.callback_query
+    late_answer = None
+    try:
+        if _is_refresh_press(query):
+            late_answer = asyncio.create_task(_answer_after(query, REFRESH_TOAST_GRACE))
+        else:
+            await answer_callback(query)
+        await _status_callback(update, context)
+    finally:
+        if late_answer is not None:
+            late_answer.cancel()
+        try:
+            await answer_callback(query)
+        except Exception:
+            pass
+        _answered_callbacks.discard(query.id)
+
+async def _status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     
     data = query.data
     
@@ -2121,7 +4062,8 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = "*Stato Aule*\n\nSeleziona un polo:"
         keyboard = build_polo_keyboard("status:polo:")
         
-        await query.message.edit_text(
+        await edit_if_changed(
+            query,
             text,
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode=ParseMode.MARKDOWN
@@ -2165,34 +4107,33 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                          InlineKeyboardButton("○", callback_data="status:start"),
                          InlineKeyboardButton(" ", callback_data="status:noop")])
         
-        await query.message.edit_text(
+        await edit_if_changed(
+            query,
             text,
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode=ParseMode.MARKDOWN
         )
     
-    # status:tutti_polo:<polo>:<offset> - Stato tutte le aule
+    # status:tutti_polo:<polo>:<offset>[:<pagina>] - Stato tutte le aule
     elif action == "tutti_polo":
         polo = parts[2] if len(parts) > 2 else "fibonacci"
         try:
             offset = int(parts[3]) if len(parts) > 3 else 0
         except Exception:
             offset = 0
+        try:
+            page = int(parts[4]) if len(parts) > 4 else 0
+        except Exception:
+            page = 0
             
         target_date = now + timedelta(days=offset)
         if offset != 0:
             target_date = target_date.replace(hour=0, minute=1, second=0, microsecond=0)
         
-        # Carica eventi
-        events = await fetch_day_events_async(get_calendar_id(polo), target_date)
-        all_rooms = get_aule_polo(polo)
-        biblio_hours = await _fetch_scope_biblio_hours(all_rooms, target_date)
-        text = format_polo_status(polo, events, target_date, biblio_hours=biblio_hours)
-        text = _safe_truncate(text)
-        
-        keyboard = get_smart_back_keyboard(offset, f"status:polo:{polo}", f"status:tutti_polo:{polo}")
+        text, keyboard = await render_occupancy_view('polo', polo, None, None, target_date, offset, page=page)
 
-        await query.message.edit_text(
+        await edit_if_changed(
+            query,
             text,
             reply_markup=keyboard,
             parse_mode=ParseMode.MARKDOWN,
@@ -2200,7 +4141,7 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         context.chat_data[f"occ_{query.message.message_id}"] = {
             'type': 'polo', 'polo': polo, 'edificio': None, 'piano': None,
-            'target_date_iso': target_date.isoformat(), 'offset': offset,
+            'target_date_iso': target_date.isoformat(), 'offset': offset, 'page': page,
         }
 
     # status:day_offset:<aula_id>:<offset> - Cambio giorno
@@ -2215,7 +4156,7 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         aula, polo = find_aula_by_id(aula_id)
         
         if not aula:
-            await query.answer("Aula non trovata", show_alert=True)
+            await answer_callback(query, "Aula non trovata", show_alert=True)
             return
 
         # Calcola data target
@@ -2223,7 +4164,7 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Fetch eventi per QUELLA data
         events = await fetch_day_events_async(get_calendar_id(polo), target_date)
-        status = get_aula_status(aula['nome'], events, target_date, polo=polo, edificio=aula.get('edificio'))
+        status = get_aula_status(aula['nome'], events, target_date, polo=polo, edificio=aula.get('edificio'), match_codes=aula.get('match_codes'))
         
         # Formatta messaggio per il giorno specifico
         # Se offset == 0 usa formato standard, altrimenti formato programma
@@ -2239,6 +4180,7 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             # Usa il nuovo helper
             text = await format_day_schedule(aula, events, target_date)
+        text = _with_notice(text, events_stale_notice(get_calendar_id(polo), target_date))
         
         if action == "day_offset":
             # Determine parent callback for Smart Back
@@ -2251,19 +4193,16 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else: # si_offset
             keyboard = get_day_navigation_keyboard(aula_id, offset)
         
-        # Importante: per messaggi inline, edit_message_text funziona solo se il contenuto cambia
+        # Funziona anche per i messaggi inline (si:); un refresh senza modifiche riceve solo il toast
         try:
-            await query.edit_message_text(
-                text=text,
+            await edit_if_changed(
+                query,
+                text,
                 reply_markup=keyboard,
                 parse_mode=ParseMode.MARKDOWN,
                 disable_web_page_preview=True
             )
         except Exception as e:
-            # Se il messaggio non è cambiato, Telegram dà errore, lo ignoriamo (o mostriamo alert "Già aggiornato")
-            if "Message is not modified" in str(e):
-                await query.answer("Già aggiornato!")
-                return
             logger.error(f"Errore edit message day offset: {e}")
 
     elif action == "edificio":
@@ -2285,15 +4224,10 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if offset != 0:
             target_date = target_date.replace(hour=0, minute=1, second=0, microsecond=0)
         
-        events = await fetch_day_events_async(get_calendar_id(polo), target_date)
-        all_rooms = get_aule_edificio(polo, edificio)
-        biblio_hours = await _fetch_scope_biblio_hours(all_rooms, target_date)
-        text = format_edificio_status(polo, edificio, events, target_date, biblio_hours=biblio_hours)
-        text = _safe_truncate(text)
-        
-        keyboard = get_smart_back_keyboard(offset, f"status:edificio:{polo}:{edificio}", f"status:tutti_edificio:{polo}:{edificio}")
+        text, keyboard = await render_occupancy_view('edificio', polo, edificio, None, target_date, offset)
 
-        await query.message.edit_text(
+        await edit_if_changed(
+            query,
             text,
             reply_markup=keyboard,
             parse_mode=ParseMode.MARKDOWN,
@@ -2318,15 +4252,10 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if offset != 0:
             target_date = target_date.replace(hour=0, minute=1, second=0, microsecond=0)
         
-        events = await fetch_day_events_async(get_calendar_id(polo), target_date)
-        all_rooms = get_aule_edificio(polo, edificio)
-        biblio_hours = await _fetch_scope_biblio_hours(all_rooms, target_date)
-        text = format_piano_status(polo, edificio, piano, events, target_date, biblio_hours=biblio_hours)
-        text = _safe_truncate(text)
-        
-        keyboard = get_smart_back_keyboard(offset, f"status:piano:{polo}:{edificio}:{piano}", f"status:tutti_piano:{polo}:{edificio}:{piano}")
+        text, keyboard = await render_occupancy_view('piano', polo, edificio, piano, target_date, offset)
 
-        await query.message.edit_text(
+        await edit_if_changed(
+            query,
             text,
             reply_markup=keyboard,
             parse_mode=ParseMode.MARKDOWN,
@@ -2337,6 +4266,59 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'target_date_iso': target_date.isoformat(), 'offset': offset,
         }
 
+    # status:week_aula:<aula_id>:<settimana>
+    # status:week_piano:<polo>:<edificio>:<piano>:<settimana>
+    # status:week_edificio:<polo>:<edificio>:<settimana> - Heatmap settimanale
+    elif action in ["week_aula", "week_piano", "week_edificio"]:
+        try:
+            week_offset = max(0, int(parts[-1]))
+        except Exception:
+            week_offset = 0
+
+        if action == "week_aula":
+            aula_id = parts[2] if len(parts) > 2 else ""
+            aula, polo = find_aula_by_id(aula_id)
+            if not aula:
+                await answer_callback(query, "Aula non trovata", show_alert=True)
+                return
+            rooms = [aula]
+            title = aula.get('nome', 'N/D')
+            day_callback = f"status:day_offset:{aula_id}:0"
+        else:
+            polo = parts[2] if len(parts) > 2 else "fibonacci"
+            edificio = parts[3] if len(parts) > 3 else "a"
+            rooms = get_aule_edificio(polo, edificio)
+            if not edificio or edificio == '?' or edificio.lower() == polo.lower():
+                title = get_polo_display_name(polo)
+            else:
+                title = f"{get_edificio_display_name(polo, edificio)} - {get_polo_display_name(polo)}"
+            if action == "week_piano":
+                piano = parts[4] if len(parts) > 5 else "0"
+                rooms = [a for a in rooms if a.get('piano') == piano]
+                title += f" - Piano {piano}"
+                day_callback = f"status:tutti_piano:{polo}:{edificio}:{piano}:0"
+            else:
+                day_callback = f"status:tutti_edificio:{polo}:{edificio}:0"
+
+        start_day = now.date() + timedelta(days=WEEK_DAYS * week_offset)
+        week = await build_week_occupancy(polo, start_day)
+        text = format_week_heatmap(title, rooms, week, start_day)
+        text = _with_notice(text, events_stale_notice(get_calendar_id(polo), now + timedelta(days=WEEK_DAYS * week_offset)))
+
+        keyboard = get_smart_back_keyboard(week_offset, day_callback, ":".join(parts[:-1]))
+        context.chat_data.pop(f"occ_{query.message.message_id}", None)
+
+        try:
+            await edit_if_changed(
+                query,
+                text,
+                reply_markup=keyboard,
+                parse_mode=ParseMode.MARKDOWN,
+                disable_web_page_preview=True
+            )
+        except Exception as e:
+            logger.error(f"Errore edit message settimana: {e}")
+
     # status:piano:<polo>:<edificio>:<piano> - Menu aule piano
     elif action == "piano":
         polo = parts[2] if len(parts) > 2 else "fibonacci"
@@ -2368,7 +4350,7 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 break
         
         if not aula:
-            await query.message.edit_text("Aula non trovata")
+            await edit_if_changed(query, "Aula non trovata")
             return
             
         polo = aula.get('polo')
@@ -2376,7 +4358,7 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         piano = aula.get('piano')
         
         events = await fetch_day_events_async(get_calendar_id(polo), now)
-        status = get_aula_status(aula['nome'], events, now, polo=polo, edificio=edificio)
+        status = get_aula_status(aula['nome'], events, now, polo=polo, edificio=edificio, match_codes=aula.get('match_codes'))
         
         # Trova URL per link MAPPA
         aula_id = aula.get("id")
@@ -2386,12 +4368,14 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         dove_url = f"https://unipi.lamappa.org/{aula_id}" if aula_id else ""
         
         text = await format_single_aula_status(aula, status, now, dove_url)
+        text = _with_notice(text, events_stale_notice(get_calendar_id(polo), now))
         
         # Use navigation keyboard with offset 0 and parent pointer
         parent_callback = f"status:piano:{polo}:{edificio}:{piano}"
         keyboard = get_occupazione_aula_keyboard(aula_id, 0, parent_callback)
         
-        await query.message.edit_text(
+        await edit_if_changed(
+            query,
             text,
             reply_markup=keyboard,
             parse_mode=ParseMode.MARKDOWN,
@@ -2447,7 +4431,8 @@ async def show_edificio_piani_menu(query, polo: str, edificio: str, parent_callb
                      InlineKeyboardButton("○", callback_data=parent_callback),
                      InlineKeyboardButton(" ", callback_data="status:noop")])
     
-    await query.message.edit_text(
+    await edit_if_changed(
+        query,
         text,
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode=ParseMode.MARKDOWN
@@ -2530,7 +4515,8 @@ async def show_piano_aule_menu(query, polo: str, edificio: str, piano: str, page
         nav_row.append(InlineKeyboardButton(" ", callback_data="status:noop"))
     keyboard.append(nav_row)
     
-    await query.message.edit_text(
+    await edit_if_changed(
+        query,
         text,
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode=ParseMode.MARKDOWN
@@ -2591,21 +4577,11 @@ async def handle_time_filter_reply(update: Update, context: ContextTypes.DEFAULT
         tf_end = target_date.replace(hour=23, minute=59, second=0, microsecond=0)
         adjusted_filter = {'type': 'from', 'start': tf_start, 'end': tf_end}
 
-    events = await fetch_day_events_async(get_calendar_id(polo), target_date)
-
-    if occ_type == 'polo':
-        text = format_polo_status(polo, events, target_date, time_filter=adjusted_filter)
-        keyboard = get_smart_back_keyboard(offset, f"status:polo:{polo}", f"status:tutti_polo:{polo}")
-    elif occ_type == 'edificio':
-        text = format_edificio_status(polo, edificio, events, target_date, time_filter=adjusted_filter)
-        keyboard = get_smart_back_keyboard(offset, f"status:edificio:{polo}:{edificio}", f"status:tutti_edificio:{polo}:{edificio}")
-    elif occ_type == 'piano':
-        text = format_piano_status(polo, edificio, piano, events, target_date, time_filter=adjusted_filter)
-        keyboard = get_smart_back_keyboard(offset, f"status:piano:{polo}:{edificio}:{piano}", f"status:tutti_piano:{polo}:{edificio}:{piano}")
-    else:
+    if occ_type not in ('polo', 'edificio', 'piano'):
         return
-
-    text = _safe_truncate(text)
+    # Il filtro cambia l'insieme delle pagine del polo: la pagina della vista non filtrata non vale più
+    occ_ctx['page'] = 0
+    text, keyboard = await render_occupancy_view(occ_type, polo, edificio, piano, target_date, offset, time_filter=adjusted_filter)
 
     # Edit the original occupancy message in place
     try:
@@ -2621,6 +4597,7 @@ async def handle_time_filter_reply(update: Update, context: ContextTypes.DEFAULT
         if "Message is not modified" not in str(e):
             logger.error(f"Errore edit time filter: {e}")
             return
+    remember_message(f"{replied.chat.id}:{replied.message_id}", text, keyboard)
 
     # Delete the user's reply (time input) to keep the chat clean
     try:
@@ -2651,24 +4628,21 @@ async def handle_polo_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             text_clean = text.replace("polo", "").strip()
             if text_clean == kw_clean:
                 now = datetime.now(tz=pytz.timezone('Europe/Rome'))
-                events = await fetch_day_events_async(get_calendar_id(polo_key), now)
-                all_rooms = get_aule_polo(polo_key)
-                biblio_hours = await _fetch_scope_biblio_hours(all_rooms, now)
-                status_text = format_polo_status(polo_key, events, now, biblio_hours=biblio_hours)
-                status_text = _safe_truncate(status_text)
-                keyboard = get_smart_back_keyboard(0, f"status:polo:{polo_key}", f"status:tutti_polo:{polo_key}")
+                status_text, keyboard = await render_occupancy_view('polo', polo_key, None, None, now)
                 sent = await update.message.reply_text(
                     status_text,
                     reply_markup=keyboard,
                     parse_mode=ParseMode.MARKDOWN,
                     disable_web_page_preview=True
                 )
+                remember_message(f"{sent.chat_id}:{sent.message_id}", status_text, keyboard)
                 context.chat_data[f"occ_{sent.message_id}"] = {
                     'type': 'polo', 'polo': polo_key, 'edificio': None, 'piano': None,
                     'target_date_iso': now.isoformat(), 'offset': 0,
                 }
                 return
 
+@with_upstream_priority(PRIORITY_INLINE)
 async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.inline_query.query.lower().strip()
     
@@ -2680,6 +4654,11 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Ma switch_pm serviva per switchare al PM. 
     # V20: button=InlineQueryResultsButton(text="Nessun risultato", start_parameter="empty")
     
+    # GESTIONE libere: AULE LIBERE PER DURATA, POSTI E POLO
+    if query == "libere" or query.startswith("libere "):
+        await update.inline_query.answer(await search_libere_inline(query[6:]), cache_time=0)
+        return
+
     # GESTIONE s: PER STATUS AULA
     if query.startswith("s:"):
         aula_search = query[2:].strip()
@@ -2820,6 +4799,12 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "title": "Aule libere",
                 "desc": "Usa /occupazione nella chat del bot per vedere lo status di tutte le aule",
                 "text": "*COME TROVARE LE AULE LIBERE*\n\nSei alla disperata ricerca di un posto per studiare in questo momento?\nVai nella chat privata del bot e usa il comando apposito:\n\n_Comando:_ `/occupazione`\n\nIl bot controllerà in tempo reale e ti darà una lista delle aule miracolosamente libere ora!"
+            },
+            {
+                "id": "inst_libere",
+                "title": "Cerca Aule Libere",
+                "desc": "libere <durata> <posti> <polo> (es. libere 2h 50 fib)",
+                "text": "*COME CERCARE UN'AULA LIBERA*\n\nTi serve un'aula libera per le prossime ore, con abbastanza posti e vicino a te?\nDigita nella chat:\n`@doveunipibot libere 2h 50 fib`\n\nDurata (`2h`, `1h30`, `90m`), posti minimi (`50`, `20p`), polo e servizi (`proiettore`, `accessibile`, `rete`, `audio`) sono tutti facoltativi.\nPer un orario, un altro giorno o una fascia oraria: `@doveunipibot libere 15 +fib`, `libere domani 14-16 +fib`, `libere giovedì 9:30 2h +ing`.\n\nIl bot ti mostrerà le aule libere ordinate per vicinanza, tempo libero e capienza!"
             }
         ]
         
@@ -3276,9 +5261,9 @@ async def search_aula_status_inline(aula_search: str, interactive: bool = False)
             if offset > 0:
                 # Per giorni futuri usiamo lo start of day per il calcolo status (per vedere eventi)
                 check_time = target_date.replace(hour=0, minute=0, second=1)
-                status = get_aula_status(aula['nome'], events, check_time, polo=polo, edificio=aula.get('edificio'))
+                status = get_aula_status(aula['nome'], events, check_time, polo=polo, edificio=aula.get('edificio'), match_codes=aula.get('match_codes'))
             else:
-                status = get_aula_status(aula['nome'], events, now, polo=polo, edificio=aula.get('edificio'))
+                status = get_aula_status(aula['nome'], events, now, polo=polo, edificio=aula.get('edificio'), match_codes=aula.get('match_codes'))
             
             # --- LINK MAPPA ---
             aula_id = aula.get("id")
@@ -3334,7 +5319,7 @@ async def search_aula_status_inline(aula_search: str, interactive: bool = False)
                 else:
                     status_description = "Libera per il resto della giornata"
                 # Thumbnail verde per libera (CERCHIO)
-                status_thumb = "https://ui-avatars.com/api/?name=X&background=8cacaa&color=8cacaa&rounded=true&size=100"
+                status_thumb = status_thumb_url(True)
             else:
                 busy_suffix = ""
                 if status.get('current_event'):
@@ -3343,12 +5328,13 @@ async def search_aula_status_inline(aula_search: str, interactive: bool = False)
                     busy_suffix = f" • {status['next_events'][0]['nome'][:50]}"
                 status_description = f"Occupata fino alle {status['busy_until'].strftime('%H:%M')}{busy_suffix}"
                 # Thumbnail rosso per occupata (CERCHIO)
-                status_thumb = "https://ui-avatars.com/api/?name=X&background=b04859&color=b04859&rounded=true&size=100"
+                status_thumb = status_thumb_url(False)
             
             # Formatta messaggio status
             # UNICA LOGICA: Mostra sempre il programma completo del giorno, senza header
             # Questo soddisfa la richiesta "mi mostra tutte le lezioni di quel giorno senza scrivere occupata fino a..."
             status_msg = await format_day_schedule(aula, events, target_date, show_title=False)
+            status_msg = _with_notice(status_msg, events_stale_notice(get_calendar_id(polo), fetch_day))
             
             # Per descrizione e thumb manteniamo logica attuale (utile per anteprima)
             if offset > 0:
@@ -3356,10 +5342,10 @@ async def search_aula_status_inline(aula_search: str, interactive: bool = False)
                  if status['next_events'] or status['current_event']:
                      status_description = f"Programma del {target_date.strftime('%d/%m')} - Occupata"
                      # Thumbnail rosso se ci sono eventi (CERCHIO)
-                     status_thumb = "https://ui-avatars.com/api/?name=X&background=b04859&color=b04859&rounded=true&size=100"
+                     status_thumb = status_thumb_url(False)
                  else:
                      status_description = f"Programma del {target_date.strftime('%d/%m')} - Libera"
-                     status_thumb = "https://ui-avatars.com/api/?name=X&background=8cacaa&color=8cacaa&rounded=true&size=100"
+                     status_thumb = status_thumb_url(True)
                      
             # else: REMOVED to keep status_msg = format_day_schedule
             #      status_msg = format_single_aula_status(aula, status, now, dove_url)
@@ -3424,7 +5410,7 @@ async def search_aula_status_inline(aula_search: str, interactive: bool = False)
             # 3. Aggiungi le occupazioni future (SOLO OGGI) o TUTTE (SE OFFSET > 0)
             if status['next_events']:
                 # Thumbnail rosso per occupazioni future (CERCHIO)
-                future_thumb = "https://ui-avatars.com/api/?name=X&background=b04859&color=b04859&rounded=true&size=100"
+                future_thumb = status_thumb_url(False)
                 
                 for i, event in enumerate(status['next_events'][:5]):
                     results.append(
@@ -3446,7 +5432,24 @@ async def search_aula_status_inline(aula_search: str, interactive: bool = False)
     return results
 
 
-def format_biblio_single_message(lib: dict, events: list, week_offset: int, now: datetime) -> tuple[str, InlineKeyboardMarkup]:
+def _biblio_week_block(schedule: LibrarySchedule, week_offset: int, now: datetime) -> str:
+    """Stato attuale (solo con week_offset 0) e orari lunedì-domenica della settimana richiesta."""
+    if week_offset == 0:
+        is_open, closes_at, opens_at = schedule.status(now)
+        if is_open:
+            status_line = f"APERTA - chiude alle {closes_at}"
+        elif opens_at:
+            status_line = f"CHIUSA - apre alle {opens_at}"
+        else:
+            status_line = "CHIUSA"
+        text = f"\n{status_line}\n\n"
+    else:
+        text = "\n" # Spacer
+    today_date = now.date()
+    target_monday = today_date - timedelta(days=today_date.weekday()) + timedelta(weeks=week_offset)
+    return text + "<pre>" + "\n".join(schedule.week_lines(target_monday)) + "</pre>\n\n"
+
+def format_biblio_single_message(lib: dict, schedule: LibrarySchedule, week_offset: int, now: datetime) -> tuple[str, InlineKeyboardMarkup]:
     """Genera messaggio 'Simple' per biblioteca (status e schedule)."""
     nid = lib.get('nid')
     
@@ -3458,76 +5461,8 @@ def format_biblio_single_message(lib: dict, events: list, week_offset: int, now:
     if cap:
             text += f"Capienza: {cap}\n"
             
-    # determine current status (TODAY) - Solo se siamo nella settimana corrente
-    now_str = now.strftime("%H:%M")
-    today_iso = now.strftime("%Y-%m-%d")
-
-    if week_offset == 0:
-        # Filter events for today (ISO match)
-        today_evs = [e for e in events if e.get('date') == today_iso]
-        
-        # Calc logic
-        status_line = "CHIUSA"
-        times_today = []
-        for ev in today_evs:
-            s, e = ev.get('start_time','').strip(), ev.get('end_time','').strip()
-            if s and e: times_today.append((s,e))
-        times_today.sort()
-        
-        if times_today:
-            # Check open/closed
-            is_open = False
-            for start, end in times_today:
-                if now_str >= start and now_str < end:
-                    status_line = f"APERTA - chiude alle {end}"
-                    is_open = True
-                    break
-            
-            if not is_open:
-                # Check if opening later
-                for start, end in times_today:
-                    if start > now_str:
-                        status_line = f"CHIUSA - apre alle {start}"
-                        break
-
-        # 3. STATUS
-        text += f"\n{status_line}\n\n"
-    else:
-        text += "\n" # Spacer
-    
-    # Schedule <pre>
-    # Iterate Mon-Sun
-    today_date = now.date()
-    start_of_current_week = today_date - timedelta(days=today_date.weekday()) # Monday
-    target_monday = start_of_current_week + timedelta(weeks=week_offset)
-
-    schedule_lines = []
-    for i in range(7):
-        day_date = target_monday + timedelta(days=i)
-        day_str = day_date.strftime("%Y-%m-%d")
-        
-        day_name = WEEKDAYS_SHORT[i] # LUN
-        formatted_date = day_date.strftime("%d/%m")
-        
-        day_events = [e for e in events if e.get('date') == day_str]
-        
-        time_range = "Chiusa"
-        if day_events:
-            time_ranges = []
-            for ev in day_events:
-                start = ev.get('start_time','').strip()
-                end = ev.get('end_time','').strip()
-                if start and end:
-                    time_ranges.append(f"{start}-{end}")
-            if time_ranges:
-                    time_range = ", ".join(time_ranges)
-        
-        # Pad day/date/time for alignment
-        line_str = f"{day_name} {formatted_date} {time_range}"
-        schedule_lines.append(line_str)
-        
-    # 4. SCHEDULE
-    text += "<pre>" + "\n".join(schedule_lines) + "</pre>\n\n"
+    # 3-4. STATUS (solo nella settimana corrente) e SCHEDULE
+    text += _biblio_week_block(schedule, week_offset, now)
     
     # 5. LINKS
     links = []
@@ -3564,7 +5499,7 @@ def format_biblio_single_message(lib: dict, events: list, week_offset: int, now:
     return text, full_kb
 
 
-def format_biblio_rich_message(lib: dict, events: list, week_offset: int, now: datetime) -> tuple[str, InlineKeyboardMarkup]:
+def format_biblio_rich_message(lib: dict, schedule: LibrarySchedule, week_offset: int, now: datetime) -> tuple[str, InlineKeyboardMarkup]:
     """Genera messaggio dettagliato per biblioteca (ricerca inline e aggiornamenti)."""
     nid = lib.get('nid')
     
@@ -3591,69 +5526,8 @@ def format_biblio_rich_message(lib: dict, events: list, week_offset: int, now: d
     if isinstance(addr, list): addr = ", ".join(addr)
     if addr: text += f"Indirizzo: {addr.strip()}\n"
     
-    # 2. STATUS LINE (TODAY) - Solo se siamo nella settimana e offset 0?
-    # La logica originale single mostra lo status SOLO se week_offset == 0
-    today_iso = now.strftime("%Y-%m-%d")
-    now_str = now.strftime("%H:%M")
-    
-    if week_offset == 0:
-        # Filter events for today
-        today_evs = [e for e in events if e.get('date') == today_iso]
-        
-        status_line = "CHIUSA"
-        times_today = []
-        for ev in today_evs:
-            s, e = ev.get('start_time','').strip(), ev.get('end_time','').strip()
-            if s and e: times_today.append((s,e))
-        times_today.sort()
-        
-        if times_today:
-            is_open = False
-            for start, end in times_today:
-                if now_str >= start and now_str < end:
-                    status_line = f"APERTA - chiude alle {end}"
-                    is_open = True
-                    break
-            
-            if not is_open:
-                for start, end in times_today:
-                    if start > now_str:
-                        status_line = f"CHIUSA - apre alle {start}"
-                        break
-        
-        text += f"\n{status_line}\n\n"
-    else:
-        text += "\n"
-
-    # 3. SCHEDULE
-    # Calculate target monday
-    today_date = now.date()
-    start_of_current_week = today_date - timedelta(days=today_date.weekday())
-    target_monday = start_of_current_week + timedelta(weeks=week_offset)
-    
-    schedule_lines = []
-    for i in range(7):
-        day_date = target_monday + timedelta(days=i)
-        day_str = day_date.strftime("%Y-%m-%d")
-        day_name = WEEKDAYS_SHORT[i]
-        formatted_date = day_date.strftime("%d/%m")
-        
-        day_events = [e for e in events if e.get('date') == day_str]
-        
-        time_range = "Chiusa"
-        if day_events:
-            time_ranges = []
-            for ev in day_events:
-                start = ev.get('start_time','').strip()
-                end = ev.get('end_time','').strip()
-                if start and end:
-                    time_ranges.append(f"{start}-{end}")
-            if time_ranges:
-                 time_range = ", ".join(time_ranges)
-        
-        schedule_lines.append(f"{day_name} {formatted_date} {time_range}")
-        
-    text += "<pre>" + "\n".join(schedule_lines) + "</pre>\n\n"
+    # 2-3. STATUS LINE (solo nella settimana corrente) e SCHEDULE
+    text += _biblio_week_block(schedule, week_offset, now)
     
     # 4. LINKS
     links = []
@@ -3717,25 +5591,17 @@ async def search_biblioteca_inline(bib_search: str) -> list:
     dt_monday = datetime.combine(start_week, datetime.min.time())
     dt_sunday = datetime.combine(end_week, datetime.min.time())
 
-    fetch_tasks = []
-    for bib in matched:
-        nid = bib.get('nid', '')
-        if nid:
-            fetch_tasks.append(fetch_sba_opening_hours_async(nid, dt_monday, dt_sunday))
-        else:
-            fut = asyncio.get_event_loop().create_future()
-            fut.set_result([])
-            fetch_tasks.append(fut)
-
-    all_hours = await asyncio.gather(*fetch_tasks, return_exceptions=True)
+    schedules = await get_biblio_schedules(
+        list(dict.fromkeys(str(bib['nid']) for bib in matched if bib.get('nid'))), dt_monday, dt_sunday
+    )
 
-    for i, bib in enumerate(matched):
+    for bib in matched:
         nome = bib.get('nome', '')
         capienza = bib.get('capienza', 0)
         nid = bib.get('nid', '')
         bib_id = bib.get('id', str(uuid.uuid4()))
 
-        hours_data = all_hours[i] if not isinstance(all_hours[i], Exception) else []
+        schedule = schedules.get(str(nid), EMPTY_SCHEDULE) if nid else EMPTY_SCHEDULE
 
         # --- Result 1: Library info card (RICH INTERACTIVE) ---
         desc_parts = []
@@ -3751,9 +5617,8 @@ async def search_biblioteca_inline(bib_search: str) -> list:
         info_description = "\n".join(desc_parts) if desc_parts else None
         
         # Generate Rich Text
-        # Note: events=hours_data, week_offset=0
         if nid:
-            rich_text, rich_markup = format_biblio_rich_message(bib, hours_data, 0, now)
+            rich_text, rich_markup = format_biblio_rich_message(bib, schedule, 0, now)
         else:
             # Fallback text if no NID/API
             rich_text = f"*{nome}*\n{capienza} posti" if capienza else f"*{nome}*"
@@ -3777,31 +5642,18 @@ async def search_biblioteca_inline(bib_search: str) -> list:
         )
 
         # --- Result 2: Current status card (Simplified check) ---
-        # Uses get_biblio_status_string which expects events for target date (today) or logic to parse
-        # get_biblio_status_string uses "events" list. The API returns list of {date, start, end}
-        # get_biblio_status_string filters for `dt_view` (today) internaly if logic matches?
-        # Let's check get_biblio_status_string logic again. 
-        # It takes `events`. `fetch_sba` returns list of slots for requested days.
-        # `get_biblio_status_string` takes `events` and filtered them by date??
-        # get_biblio_status_string filters them already?
-        # NO. existing `get_biblio_status_string` does NOT filter by date if it's not today.
-        
-        # We need to filter events for TODAY to pass to get_biblio_status_string for correct status line
-        today_iso = now.strftime("%Y-%m-%d")
-        today_events_only = [e for e in hours_data if e.get('date') == today_iso]
-
         if nid:
-            status_line = get_biblio_status_string(nome, today_events_only, now)
+            status_line = get_biblio_status_string(nome, schedule, now)
             # GENERATE SIMPLE MESSAGE
-            simple_text, simple_markup = format_biblio_single_message(bib, hours_data, 0, now)
+            simple_text, simple_markup = format_biblio_single_message(bib, schedule, 0, now)
 
             # Determine thumb color
             # Libera/Aperta se non è chiusa e non ha una dicitura "apre alle" senza essere già aperta
             is_open_or_future = " - chiude" in status_line or (" - chiusa" not in status_line and " - apre alle" not in status_line)
             if is_open_or_future:
-                status_thumb = "https://ui-avatars.com/api/?name=X&background=8cacaa&color=8cacaa&rounded=true&size=100"
+                status_thumb = status_thumb_url(True)
             else:
-                status_thumb = "https://ui-avatars.com/api/?name=X&background=b04859&color=b04859&rounded=true&size=100"
+                status_thumb = status_thumb_url(False)
 
             status_desc = status_line.split(" - ", 1)[1] if " - " in status_line else status_line
             
@@ -3831,79 +5683,24 @@ async def search_biblioteca_inline(bib_search: str) -> list:
     return results
 
 
-def get_biblio_status_string(name, events, dt_view):
+def get_biblio_status_string(name, schedule: LibrarySchedule, dt_view):
     """
     Format generic line for TUTTE view:
     Nome - chiude alle HH:MM
     Nome - apre alle HH:MM
     Nome - chiusa
+    Nei giorni diversi da oggi: Nome - HH:MM-HH:MM, ...
     """
     now = datetime.now(TZ_ROME)
-    is_today = (dt_view.date() == now.date())
-    
-    if not is_today:
-        # FUTURE/PAST DAYS
-        times = []
-        for ev in events:
-            start = ev.get('start_time', '').strip()
-            end = ev.get('end_time', '').strip()
-            if start and end:
-                times.append((start, end))
-        
-        if not times:
-            return f"{name} - chiusa"
-        
-        # Sort by start
-        times.sort()
-        schedule_str = ", ".join([f"{s}-{e}" for s, e in times])
-        return f"{name} - {schedule_str}"
-
-    # TODAY
-    if not events:
-        return f"{name} - chiusa"
-
-    times = []
-    for ev in events:
-        start = ev.get('start_time', '').strip()
-        end = ev.get('end_time', '').strip()
-        if start and end:
-            times.append((start, end))
-
-    if not times:
-        return f"{name} - chiusa"
-
-    times.sort()
-    current_time_str = now.strftime("%H:%M")
-
-    # Check status
-    for start, end in times:
-        # If interval hasn't started yet
-        if current_time_str < start:
-             return f"{name} - apre alle {start}"
-        
-        # If inside interval
-        if current_time_str >= start and current_time_str < end:
-             return f"{name} - chiude alle {end}"
-    
-    # Check if there is next opening?
-    # Loop again to see if there is a FUTURE opening today
-    # (The previous loop breaks on first future opening, so if we are here,
-    # it means all intervals are either current (handled) or past (not handled yet)
-    # wait.
-    
-    # Correct logic for TODAY:
-    # 1. Is it OPEN right now?
-    for start, end in times:
-        if current_time_str >= start and current_time_str < end:
-            return f"{name} - chiude alle {end}"
-            
-    # 2. Is it opening LATER today?
-    # Find first start > current
-    for start, end in times:
-        if start > current_time_str:
-            return f"{name} - apre alle {start}"
-            
-    # 3. Else Closed (finished for today)
+    if dt_view.date() != now.date():
+        hours = schedule.day_hours(dt_view.date())
+        return f"{name} - {hours}" if hours else f"{name} - chiusa"
+
+    is_open, closes_at, opens_at = schedule.status(now)
+    if is_open:
+        return f"{name} - chiude alle {closes_at}"
+    if opens_at:
+        return f"{name} - apre alle {opens_at}"
     return f"{name} - chiusa"
 
 
@@ -3977,20 +5774,14 @@ async def biblio_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         libs = load_biblioteche_json()
         libs.sort(key=lambda x: x.get('nome', ''))
         
-        # Parallel fetch
-        tasks = []
-        valid_libs = []
-        for lib in libs:
-            nid = lib.get('nid')
-            if nid:
-                valid_libs.append(lib)
-                tasks.append(fetch_sba_opening_hours_async(nid, target_date, target_date))
-        
-        if not tasks:
+        valid_libs = [lib for lib in libs if lib.get('nid')]
+        if not valid_libs:
             await query.message.edit_text("Nessuna biblioteca configurata.")
             return
 
-        results = await asyncio.gather(*tasks)
+        # Orari dalla tabella in memoria (SBA solo per i giorni non coperti)
+        schedules = await get_biblio_schedules([str(lib['nid']) for lib in valid_libs], target_date, target_date)
+        results = [schedules.get(str(lib['nid']), EMPTY_SCHEDULE) for lib in valid_libs]
         
         # HEADER STILE /occupazione
         # "Stato aule alle {HH:MM} del {DD/MM}" (Use "Stato biblioteche" for clarity)
@@ -4061,10 +5852,10 @@ async def biblio_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         dt_monday = datetime.combine(target_monday, datetime.min.time())
         dt_sunday = datetime.combine(target_sunday, datetime.min.time())
         
-        events = await fetch_sba_opening_hours_async(nid, dt_monday, dt_sunday)
+        schedule = await get_biblio_schedule(nid, dt_monday, dt_sunday)
         
         # --- BUILD MESSAGE ---
-        text, full_kb = format_biblio_single_message(lib, events, week_offset, now)
+        text, full_kb = format_biblio_single_message(lib, schedule, week_offset, now)
         
         try:
             if query.message:
@@ -4103,9 +5894,9 @@ async def biblio_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         dt_monday = datetime.combine(target_monday, datetime.min.time())
         dt_sunday = datetime.combine(target_sunday, datetime.min.time())
         
-        events = await fetch_sba_opening_hours_async(nid, dt_monday, dt_sunday)
+        schedule = await get_biblio_schedule(nid, dt_monday, dt_sunday)
         
-        text, markup = format_biblio_rich_message(lib, events, week_offset, now)
+        text, markup = format_biblio_rich_message(lib, schedule, week_offset, now)
         
         try:
             if query.message:
@@ -4124,16 +5915,94 @@ async def biblio_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # --- MAIN ---
+# --- SERVER WEBHOOK ---
+# Stesso server tornado di Application.run_webhook, con in più la rotta delle miniature
+# (PTB non permette di aggiungere rotte al suo server, quindi il ciclo di vita è gestito qui).
+THUMB_CACHE_MAX_AGE = 365 * 24 * 3600  # secondi: i nomi dei file cambiano con THUMB_STYLE
+
+def build_web_app(app: Application, webhook_path: str):
+    import tornado.web
+
+    class WebhookHandler(tornado.web.RequestHandler):
+        async def post(self):
+            try:
+                update = Update.de_json(json.loads(self.request.body), app.bot)
+            except (ValueError, TypeError):
+                self.set_status(400)
+                return
+            await app.update_queue.put(update)
+
+    class ThumbHandler(tornado.web.RequestHandler):
+        def get(self, name):
+            png = thumb_png(name)
+            if png is None:
+                raise tornado.web.HTTPError(404)
+            self.set_header("Content-Type", "image/png")
+            self.set_header("Cache-Control", f"public, max-age={THUMB_CACHE_MAX_AGE}, immutable")
+            self.finish(png)
+
+    return tornado.web.Application(
+        [
+            (rf"{webhook_path}/?", WebhookHandler),
+            (rf"{THUMBS_ROUTE}/([A-Za-z0-9_.-]+\.png)", ThumbHandler),
+        ],
+        log_function=lambda handler: None,  # come il server di PTB: niente access log per ogni update
+    )
+
+async def run_webhook_server(app: Application, port: int, url_path: str, webhook_url: str, public_url: str):
+    """Equivalente di app.run_webhook(listen="0.0.0.0", ...) che serve anche le miniature, con lo stesso
+    ciclo di vita (post_init, post_stop, post_shutdown)."""
+    global _thumbs_base_url
+    from tornado.httpserver import HTTPServer
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    server = None
+    try:
+        await app.initialize()
+        if app.post_init:
+            await app.post_init(app)
+        server = HTTPServer(build_web_app(app, f"/{url_path}"))
+        server.listen(port, address="0.0.0.0")
+        _thumbs_base_url = (os.environ.get("THUMBS_BASE_URL") or public_url).rstrip("/")
+        await app.bot.set_webhook(url=webhook_url)
+        await app.start()
+        await stop.wait()
+    finally:
+        _thumbs_base_url = ""
+        if server is not None:
+            server.stop()
+        if app.running:
+            await app.stop()
+            # come PTB: post_stop solo se stop è stato chiamato
+            if app.post_stop:
+                await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
 def main():
     TOKEN = os.environ.get("TELEGRAM_TOKEN")
     PORT = int(os.environ.get("PORT", "8443"))
     WEBHOOK_URL = os.environ.get("RENDER_EXTERNAL_URL")
+    # Update gestiti in parallelo (opt-in): i callback condividono chat_data (stato occ_* e risposte
+    # al filtro orario) senza lock, quindi di default gli update restano sequenziali
+    CONCURRENT_UPDATES = max(1, int(os.environ.get("CONCURRENT_UPDATES", "1")))
 
     if not TOKEN:
         logger.error("ERRORE: Token mancante.")
         return
 
-    app = Application.builder().token(TOKEN).build()
+    warm_caches_from_disk()
+
+    builder = Application.builder().token(TOKEN)
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(CONCURRENT_UPDATES)
+    app = builder.build()
     
     # Imposta i comandi del bot su Telegram
     async def post_init(application):
@@ -4141,17 +6010,24 @@ def main():
         commands = [
             BotCommand("start", "Messaggio di benvenuto"),
             BotCommand("occupazione", "Aule libere"),
+            BotCommand("libere", "Cerca aule libere per durata, posti e polo"),
             BotCommand("biblioteche", "Orari biblioteche"),
             BotCommand("links", "Link utili"),
             BotCommand("help", "Guida all'uso"),
         ]
         await application.bot.set_my_commands(commands)
     
+    async def post_shutdown(application):
+        await upstream.aclose()
+        persistent_cache.close()
+
     app.post_init = post_init
+    app.post_shutdown = post_shutdown
     
     # Comandi
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("occupazione", occupazione_command))
+    app.add_handler(CommandHandler("libere", libere_command))
     app.add_handler(CommandHandler("biblioteche", biblioteche_command))
     app.add_handler(CommandHandler("links", links_command))
     app.add_handler(CommandHandler("help", help_command))
@@ -4171,18 +6047,18 @@ def main():
     
     # Inline query
     app.add_handler(InlineQueryHandler(inline_query))
-    
+
+    # Prefetch occupazioni e orari biblioteche
+    if app.job_queue:
+        app.job_queue.run_once(prefetch_job, when=5, name="prefetch")
+        app.job_queue.run_repeating(biblio_timetable_job, interval=BIBLIO_REFRESH_INTERVAL, first=5, name="biblio_timetable")
+        app.job_queue.run_repeating(upstream_stats_job, interval=UPSTREAM_STATS_INTERVAL, first=UPSTREAM_STATS_INTERVAL, name="upstream_stats")
 
     if WEBHOOK_URL:
         if app.job_queue:
             app.job_queue.run_repeating(self_ping, interval=840, first=60)
         
-        app.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path=TOKEN,
-            webhook_url=f"{WEBHOOK_URL}/{TOKEN}"
-        )
+        asyncio.run(run_webhook_server(app, PORT, TOKEN, f"{WEBHOOK_URL}/{TOKEN}", WEBHOOK_URL))
     else:
         app.run_polling()
 
@@ -0,0 +1,257 @@
+"""
+Server locale che simula gli upstream del bot (calendario Cineca, orari SBA, WP persone Unipi)
+rispondendo con fixture registrate. Serve per test di carico e benchmark riproducibili offline.
+
+Avvio:
+    python fake_upstream.py --port 8765 --latency 80 --jitter 40 --error-rate 0.02 --scale 3
+
+Poi si avvia il bot puntandolo al server tramite le variabili d'ambiente stampate all'avvio
+(API_URL, SBA_API_URL, UNIPI_PERSONE_URL).
+
+Con --record il server fa da proxy verso gli upstream reali e salva le risposte come fixture.
+
+Fixture (in data/fixtures/ se non indicato diversamente):
+    cineca/<linkCalendarioId>.json  {"dataInizio": "YYYY-MM-DD", "events": [...]}  (default.json se manca)
+    sba/<nid>.json                  [{"date", "start_time", "end_time"}, ...]       (default.json se manca)
+    wp/persone.json                 [{"title": {"rendered"}, "link"}, ...]
+Gli eventi Cineca sono spostati di settimane intere nella finestra richiesta e gli orari SBA
+sono riassegnati per giorno della settimana, così le fixture restano valide in qualunque data.
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.parse
+import urllib.request
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger("fake_upstream")
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "fixtures")
+
+# Percorsi serviti e upstream reali corrispondenti (usati in modalità --record)
+CINECA_PATH = "/api/Impegni/getImpegniCalendarioPubblico"
+SBA_PATH = "/it/opening_hours/instances"
+WP_PERSONE_PATH = "/wp-json/wp/v2/unipi_persone"
+LIVE_URLS = {
+    CINECA_PATH: "https://apache.prod.up.cineca.it" + CINECA_PATH,
+    SBA_PATH: "https://www.sba.unipi.it" + SBA_PATH,
+    WP_PERSONE_PATH: "https://www.unipi.it" + WP_PERSONE_PATH,
+}
+
+def _parse_iso(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def _format_utc(value: datetime) -> str:
+    """Formato usato da Cineca: UTC con millisecondi e suffisso Z."""
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+class FixtureStore:
+    """Carica le fixture da disco (con cache in memoria) e le adatta alla richiesta."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _path(self, kind: str, name: str) -> str:
+        safe = "".join(c for c in name if c.isalnum() or c in "-_") or "default"
+        return os.path.join(self.root, kind, f"{safe}.json")
+
+    def load(self, kind: str, name: str, default=None):
+        with self._lock:
+            for path in (self._path(kind, name), self._path(kind, "default")):
+                if path in self._cache:
+                    return self._cache[path]
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        self._cache[path] = json.load(f)
+                    return self._cache[path]
+        return default
+
+    def save(self, kind: str, name: str, data):
+        path = self._path(kind, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        with self._lock:
+            self._cache[path] = data
+        logger.info(f"Fixture registrata: {path}")
+
+    def cineca_events(self, calendar_id: str, start: datetime, end: datetime, scale: int) -> list:
+        fixture = self.load("cineca", calendar_id, {"events": []})
+        events = fixture.get("events", [])
+        if not events:
+            return []
+        recorded_start = date.fromisoformat(fixture.get("dataInizio") or _parse_iso(events[0]['dataInizio']).date().isoformat())
+        # Settimane intere tra la finestra registrata e quella richiesta (una in più per coprire i bordi)
+        first_week = (start.date() - recorded_start).days // 7 - 1
+        last_week = (end.date() - recorded_start).days // 7 + 1
+        result = []
+        for week in range(first_week, last_week + 1):
+            shift = timedelta(weeks=week)
+            for event in events:
+                event_start = _parse_iso(event['dataInizio']) + shift
+                if not (start <= event_start <= end):
+                    continue
+                for copy_index in range(scale):
+                    shifted = copy.deepcopy(event)
+                    shifted['dataInizio'] = _format_utc(event_start)
+                    shifted['dataFine'] = _format_utc(_parse_iso(event['dataFine']) + shift)
+                    if copy_index:
+                        shifted['id'] = f"{event.get('id', 'ev')}-{copy_index}"
+                    result.append(shifted)
+        return result
+
+    def sba_hours(self, nid: str, from_date: date, to_date: date) -> list:
+        recorded = self.load("sba", nid, [])
+        by_weekday = {}
+        for entry in recorded:
+            try:
+                by_weekday.setdefault(date.fromisoformat(entry['date']).weekday(), []).append(entry)
+            except (KeyError, ValueError):
+                continue
+        result = []
+        day = from_date
+        while day <= to_date:
+            for entry in by_weekday.get(day.weekday(), []):
+                result.append({**entry, 'date': day.isoformat()})
+            day += timedelta(days=1)
+        return result
+
+    def wp_persone(self, search: str, per_page: int, scale: int) -> list:
+        people = self.load("wp", "persone", [])
+        tokens = search.lower().split()
+        matches = [p for p in people if all(t in p.get('title', {}).get('rendered', '').lower() for t in tokens)]
+        return (matches * scale)[:per_page]
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeUpstream/1.0"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, status: int, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _simulate_network(self) -> bool:
+        """Applica latenza ed errori configurati. Ritorna False se la risposta è già stata inviata (errore)."""
+        config = self.server.config
+        delay = config.latency
+        if config.jitter > 0:
+            delay += random.expovariate(1 / config.jitter)  # coda lunga, come gli upstream reali
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if config.error_rate > 0 and random.random() < config.error_rate:
+            self._send_json(config.error_status, {"error": "errore simulato"})
+            return False
+        return True
+
+    def _record(self, method: str, path: str, query: str, body: bytes):
+        url = LIVE_URLS[path] + (f"?{query}" if query else "")
+        request = urllib.request.Request(url, data=body, method=method, headers={'Content-Type': 'application/json;charset=UTF-8'})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def do_POST(self):
+        parsed = urllib.parse.urlsplit(self.path)
+        if parsed.path != CINECA_PATH:
+            self._send_json(404, {"error": "not found"})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        try:
+            payload = json.loads(body or b"{}")
+            calendar_id = payload.get('linkCalendarioId') or "default"
+            start, end = _parse_iso(payload['dataInizio']), _parse_iso(payload['dataFine'])
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {"error": "payload non valido"})
+            return
+        if self.server.config.record:
+            events = self._record("POST", parsed.path, parsed.query, body)
+            self.server.store.save("cineca", calendar_id, {"dataInizio": start.date().isoformat(), "events": events})
+            self._send_json(200, events)
+            return
+        if self._simulate_network():
+            self._send_json(200, self.server.store.cineca_events(calendar_id, start, end, self.server.config.scale))
+
+    def do_GET(self):
+        parsed = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        if parsed.path not in (SBA_PATH, WP_PERSONE_PATH):
+            self._send_json(404, {"error": "not found"})
+            return
+        if self.server.config.record:
+            data = self._record("GET", parsed.path, parsed.query, None)
+            if parsed.path == SBA_PATH:
+                self.server.store.save("sba", params.get('nid', 'default'), data)
+            else:
+                known = {p.get('link'): p for p in self.server.store.load("wp", "persone", [])}
+                known.update({p.get('link'): p for p in data if isinstance(p, dict)})
+                self.server.store.save("wp", "persone", list(known.values()))
+            self._send_json(200, data)
+            return
+        if not self._simulate_network():
+            return
+        if parsed.path == SBA_PATH:
+            try:
+                from_date = date.fromisoformat(params['from_date'])
+                to_date = date.fromisoformat(params.get('to_date', params['from_date']))
+            except (KeyError, ValueError):
+                self._send_json(400, {"error": "date non valide"})
+                return
+            self._send_json(200, self.server.store.sba_hours(params.get('nid', 'default'), from_date, to_date))
+        else:
+            per_page = int(params.get('per_page', 10))
+            self._send_json(200, self.server.store.wp_persone(params.get('search', ''), per_page, self.server.config.scale))
+
+def make_server(host: str, port: int, config: argparse.Namespace) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), FakeUpstreamHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.store = FixtureStore(config.fixtures)
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Upstream finti (Cineca, SBA, WP Unipi) per test offline del bot")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fixtures", default=FIXTURES_DIR, help="cartella delle fixture")
+    parser.add_argument("--latency", type=float, default=0, help="latenza base per risposta (ms)")
+    parser.add_argument("--jitter", type=float, default=0, help="media della latenza aggiuntiva esponenziale (ms)")
+    parser.add_argument("--error-rate", type=float, default=0, help="frazione di risposte in errore (0-1)")
+    parser.add_argument("--error-status", type=int, default=503, help="status HTTP delle risposte in errore")
+    parser.add_argument("--scale", type=int, default=1, help="moltiplica gli eventi Cineca e i risultati WP")
+    parser.add_argument("--record", action="store_true", help="proxy verso gli upstream reali salvando le risposte come fixture")
+    parser.add_argument("--seed", type=int, default=None, help="seed per latenze ed errori riproducibili")
+    config = parser.parse_args()
+    config.scale = max(1, config.scale)
+    if config.seed is not None:
+        random.seed(config.seed)
+
+    server = make_server(config.host, config.port, config)
+    base = f"http://{config.host}:{config.port}"
+    logger.info(f"Fake upstream in ascolto su {base} (fixture: {config.fixtures}{', registrazione' if config.record else ''})")
+    print(f"export API_URL={base}{CINECA_PATH}")
+    print(f"export SBA_API_URL={base}{SBA_PATH}")
+    print(f"export UNIPI_PERSONE_URL={base}{WP_PERSONE_PATH}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Benchmark della cache persistente (PersistentCache, CACHE_DB_PATH): tempo della prima vista di un
+polo dopo un riavvio a cache su disco vuota e piena, e blocco dell'event loop durante la scrittura.
+Ogni fase gira in un processo nuovo, come un riavvio del bot, contro fake_upstream in locale.
+
+Avvio (dalla radice del repository):
+    python scripts/bench_persistent_cache.py --latency 300 --scale 3
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fake_upstream  # noqa: E402
+
+POLO = "fibonacci"
+
+def start_fake_upstream(port: int, latency: float, scale: int) -> str:
+    config = argparse.Namespace(fixtures=fake_upstream.FIXTURES_DIR, latency=latency, jitter=0, error_rate=0,
+                                error_status=503, scale=max(1, scale), record=False)
+    server = fake_upstream.make_server("127.0.0.1", port, config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+async def first_view(bot) -> None:
+    """Fase in un processo nuovo: caricamento dal disco e prima vista del polo."""
+    started = time.perf_counter()
+    bot.warm_caches_from_disk()
+    loaded = time.perf_counter()
+    now = bot.datetime.now(bot.TZ_ROME)
+    events = await bot.fetch_day_events_async(bot.get_calendar_id(POLO), now)
+    bot.format_polo_status(POLO, events, now)
+    done = time.perf_counter()
+    await asyncio.gather(*list(bot._background_tasks))  # la scrittura su disco deve finire prima dell'uscita
+    print(f"warm-load {1000 * (loaded - started):5.0f}ms  prima vista {POLO} {1000 * (done - loaded):5.0f}ms  eventi {len(events)}")
+    await bot.upstream.aclose()
+    bot.persistent_cache.close()
+
+async def loop_lag(bot) -> None:
+    """Fase in un processo nuovo: blocco dell'event loop scrivendo le righe di una finestra di eventi,
+    con put_many sincrono (come prima) e con put_many_background."""
+    now = bot.datetime.now(bot.TZ_ROME)
+    await bot.fetch_day_events_async(bot.get_calendar_id(POLO), now)
+    await asyncio.gather(*list(bot._background_tasks))
+    rows = [(key, ts, [bot._record_to_row(r) for r in events]) for key, (ts, events) in bot._events_cache.items()]
+    rows = (rows * (200 // max(1, len(rows)) + 1))[:200]
+
+    async def measure(write) -> tuple:
+        worst = 0.0
+        running = True
+
+        async def ticker():
+            nonlocal worst
+            while running:
+                tick = time.perf_counter()
+                await asyncio.sleep(0.001)
+                worst = max(worst, time.perf_counter() - tick - 0.001)
+
+        task = asyncio.ensure_future(ticker())
+        await asyncio.sleep(0.01)
+        started = time.perf_counter()
+        write()
+        returned = time.perf_counter() - started
+        await asyncio.gather(*list(bot._background_tasks))
+        await asyncio.sleep(0.01)
+        running = False
+        await task
+        return returned, worst
+
+    sync = await measure(lambda: bot.persistent_cache.put_many("event_records", rows))
+    background = await measure(lambda: bot.persistent_cache.put_many_background("event_records", rows))
+    print(f"{len(rows)} righe: put_many ritorna in {1000 * sync[0]:6.2f}ms (lag max {1000 * sync[1]:5.1f}ms), "
+          f"put_many_background in {1000 * background[0]:6.2f}ms (lag max {1000 * background[1]:5.1f}ms)")
+    await bot.upstream.aclose()
+    bot.persistent_cache.close()
+
+def child(args) -> None:
+    base = start_fake_upstream(args.port, args.latency, args.scale)
+    # Il bot legge la configurazione all'import
+    os.environ.update(API_URL=base + fake_upstream.CINECA_PATH, SBA_API_URL=base + fake_upstream.SBA_PATH, CACHE_DB_PATH=args.db)
+    import bot
+    asyncio.run(first_view(bot) if args.phase == "view" else loop_lag(bot))
+
+def main(args) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, "cache.sqlite3")
+        for label, phase in (("avvio a freddo", "view"), ("avvio con cache", "view"), ("scrittura", "lag")):
+            print(f"{label:16}", end=" ", flush=True)
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--phase", phase, "--db", db, "--port", str(args.port),
+                 "--latency", str(args.latency), "--scale", str(args.scale)],
+                check=True, stderr=subprocess.DEVNULL,
+            )
+        print(f"{'dimensione db':16} {os.path.getsize(db) / 1024:.0f} KB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark della cache persistente su disco")
+    parser.add_argument("--latency", type=float, default=300, help="latenza del fake upstream (ms)")
+    parser.add_argument("--scale", type=int, default=3, help="moltiplica gli eventi delle fixture")
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--phase", choices=("view", "lag"), help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.phase:
+        child(args)
+    else:
+        main(args)
@@ -0,0 +1,89 @@
+"""
+Benchmark del rendering della vista polo (/occupazione): tempo per disegnare tutte le pagine di un polo
+con gli eventi indicizzati per aula (DayEvents, timeline ordinate e bisect) e con la semplice lista di
+record compatti (scansione lineare per ogni aula), più il controllo di equivalenza tra le due strade:
+get_aula_status di ogni aula ogni --step minuti della giornata e il testo delle pagine agli stessi orari.
+Gli eventi arrivano da fake_upstream in locale; il giorno misurato è il più carico della settimana.
+
+Avvio (dalla radice del repository):
+    python scripts/bench_polo_render.py --polo fibonacci --scale 3 --repeat 300
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fake_upstream  # noqa: E402
+
+def start_fake_upstream(port: int, scale: int) -> str:
+    config = argparse.Namespace(fixtures=fake_upstream.FIXTURES_DIR, latency=0, jitter=0, error_rate=0,
+                                error_status=503, scale=max(1, scale), record=False)
+    server = fake_upstream.make_server("127.0.0.1", port, config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+def render_all_pages(bot, polo: str, events, now) -> list:
+    """Tutte le pagine della vista polo, come le sfoglia un utente."""
+    text, _, pages = bot.format_polo_page(polo, events, now)
+    return [text] + [bot.format_polo_page(polo, events, now, page=page)[0] for page in range(1, pages)]
+
+def timed(render, repeat: int) -> float:
+    render()  # prima chiamata fuori misura: indici, piani delle pagine e snapshot già pronti
+    started = time.perf_counter()
+    for _ in range(repeat):
+        render()
+    return 1000 * (time.perf_counter() - started) / repeat
+
+def check_equivalence(bot, polo: str, indexed, linear, day_start, step: int) -> tuple:
+    """(combinazioni aula/orario confrontate, differenze di stato, pagine con testo diverso)."""
+    rooms = bot.get_aule_polo(polo)
+    compared = mismatches = page_mismatches = 0
+    for minute in range(0, 24 * 60, step):
+        now = day_start + bot.timedelta(minutes=minute)
+        for aula in rooms:
+            where = dict(polo=polo, edificio=aula.get('edificio'), match_codes=aula.get('match_codes'))
+            compared += 1
+            mismatches += bot.get_aula_status(aula['nome'], indexed, now, **where) != bot.get_aula_status(aula['nome'], linear, now, **where)
+        page_mismatches += sum(a != b for a, b in zip(render_all_pages(bot, polo, indexed, now), render_all_pages(bot, polo, linear, now)))
+    return compared, mismatches, page_mismatches
+
+async def main(args) -> None:
+    import bot
+    calendar_id = bot.get_calendar_id(args.polo)
+    today = bot.datetime.now(bot.TZ_ROME).replace(hour=0, minute=0, second=0, microsecond=0)
+    days = [today + bot.timedelta(days=offset) for offset in range(bot.WEEK_DAYS)]
+    loaded = [await bot.fetch_day_events_async(calendar_id, day) for day in days]
+    indexed, day_start = max(zip(loaded, days), key=lambda pair: len(pair[0]))
+    linear = list(indexed)
+    await bot.upstream.aclose()
+
+    now = day_start.replace(hour=11, minute=5)
+    pages = len(render_all_pages(bot, args.polo, indexed, now))
+    print(f"{args.polo}: {len(indexed)} eventi il {day_start.strftime('%d/%m')}, {len(bot.get_aule_polo(args.polo))} aule, {pages} pagine")
+    print(f"render completo, timeline + bisect   {timed(lambda: render_all_pages(bot, args.polo, indexed, now), args.repeat):6.2f} ms")
+    print(f"render completo, scansione lineare   {timed(lambda: render_all_pages(bot, args.polo, linear, now), args.repeat):6.2f} ms")
+
+    compared, mismatches, page_mismatches = check_equivalence(bot, args.polo, indexed, linear, day_start, args.step)
+    print(f"equivalenza: {compared} combinazioni aula/orario (ogni {args.step} min), {mismatches} stati diversi, "
+          f"{page_mismatches} pagine diverse")
+    if mismatches or page_mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark del rendering della vista polo")
+    parser.add_argument("--polo", default="fibonacci")
+    parser.add_argument("--scale", type=int, default=3, help="moltiplica gli eventi delle fixture")
+    parser.add_argument("--repeat", type=int, default=300, help="render misurati per variante")
+    parser.add_argument("--step", type=int, default=7, help="passo in minuti del controllo di equivalenza")
+    parser.add_argument("--port", type=int, default=8768)
+    args = parser.parse_args()
+
+    base = start_fake_upstream(args.port, args.scale)
+    # Il bot legge la configurazione all'import: niente cache su disco, upstream locale
+    os.environ.update(API_URL=base + fake_upstream.CINECA_PATH, SBA_API_URL=base + fake_upstream.SBA_PATH, CACHE_DB_PATH="")
+    asyncio.run(main(args))
@@ -0,0 +1,75 @@
+"""
+Benchmark del coalescing delle richieste upstream (_singleflight): N utenti concorrenti chiedono
+gli eventi dello stesso calendario e giorno, a ondate, contro fake_upstream in locale.
+Senza coalescing ogni utente fa la sua chiamata; con il coalescing una sola per ondata.
+
+Avvio (dalla radice del repository):
+    python scripts/bench_singleflight.py --users 50 --waves 10 --latency 300
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fake_upstream  # noqa: E402
+
+def start_fake_upstream(port: int, latency: float) -> str:
+    config = argparse.Namespace(fixtures=fake_upstream.FIXTURES_DIR, latency=latency, jitter=0, error_rate=0,
+                                error_status=503, scale=1, record=False)
+    server = fake_upstream.make_server("127.0.0.1", port, config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+async def run(bot, coalesce: bool, users: int, waves: int) -> None:
+    calls = 0
+    request = bot.upstream.request
+
+    async def counting_request(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+        return await request(*args, **kwargs)
+
+    async def no_singleflight(key, factory):
+        return await factory()
+
+    singleflight = bot._singleflight
+    bot.upstream.request = counting_request
+    if not coalesce:
+        bot._singleflight = no_singleflight
+    calendar_id = bot.get_calendar_id("fibonacci")
+    day = bot.datetime.now(bot.TZ_ROME)
+    started = time.perf_counter()
+    try:
+        for _ in range(waves):
+            bot._events_cache.clear()  # ogni ondata parte a cache fredda
+            await asyncio.gather(*(bot.fetch_day_events_async(calendar_id, day) for _ in range(users)))
+    finally:
+        bot.upstream.request = request
+        bot._singleflight = singleflight
+    elapsed = time.perf_counter() - started
+    print(f"coalescing={'sì' if coalesce else 'no':2}  {calls:4d} chiamate upstream in {elapsed:5.2f}s"
+          f"  -> {calls / elapsed:6.1f} chiamate/s, {users * waves / elapsed:6.1f} richieste/s")
+
+async def main(args) -> None:
+    import bot
+    for coalesce in (False, True):
+        await run(bot, coalesce, args.users, args.waves)
+    await bot.upstream.aclose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark del coalescing delle richieste upstream")
+    parser.add_argument("--users", type=int, default=50, help="richieste concorrenti per ondata")
+    parser.add_argument("--waves", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=300, help="latenza del fake upstream (ms)")
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    base = start_fake_upstream(args.port, args.latency)
+    # Il bot legge la configurazione all'import: niente cache su disco, upstream locale
+    os.environ.update(API_URL=base + fake_upstream.CINECA_PATH, SBA_API_URL=base + fake_upstream.SBA_PATH, CACHE_DB_PATH="")
+    asyncio.run(main(args))